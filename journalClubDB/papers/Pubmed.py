@@ -1,63 +1,149 @@
-# This class require biopython
+# Search results are parsed from efetch xml by pubmed_xml.iter_pubmed_records
 # Example usage:
 # from Pubmed import PubmedInterface
 # x = PubmedInterface()
-# x.getRecords("Cell cycle adaptations of embryonic stem cells",10)
+# x.getRecords("Cell cycle adaptations of embryonic stem cells",0,10)
 # better way
+# paging through results with the NCBI history server, one request per later page:
+# history = x.startSearch("Cell cycle adaptations of embryonic stem cells",10)   # first page
+# x.getPage(history,10,10)                                                          # second page
+# requests to pubmed go through eutils.eutils_client, which reuses connections between requests, and responses
+# are kept in pubmed_cache, which all worker processes share
 
-from Bio import Entrez
-from Bio import Medline
+from django.conf import settings
+from xml.etree import ElementTree
+import io
+import json
+import os
 from papers.models import Citation
+from papers.citation_lookup import get_existing_citation_pks
+from papers.eutils import eutils_client, EutilsError
+from papers.shared_cache import SqliteCache
+from papers.pubmed_xml import PubmedRecord, iter_pubmed_records
+
+PUBMED_CACHE_PATH = getattr(settings, 'PUBMED_CACHE_PATH',
+                            os.path.join(getattr(settings, 'BASE_DIR', '.'), 'pubmed_cache.sqlite3'))
+PUBMED_CACHE_MAX_BYTES = getattr(settings, 'PUBMED_CACHE_MAX_BYTES', 64*2**20)
+
+# search results change as papers are added to pubmed, records of papers rarely change
+ESEARCH_CACHE_TTL = getattr(settings, 'PUBMED_ESEARCH_CACHE_TTL', 60*60)
+EFETCH_CACHE_TTL = getattr(settings, 'PUBMED_EFETCH_CACHE_TTL', 60*60*24*7)
+
+# esearch results (count and IDs) by normalized query, offset and page size, and records by pubmed ID
+pubmed_cache = SqliteCache(PUBMED_CACHE_PATH, PUBMED_CACHE_MAX_BYTES)
+
+# pubmed queries are case insensitive except for the boolean operators
+def normalize_query(search_str):
+    return ' '.join(word if word in ('AND','OR','NOT') else word.lower() for word in search_str.split())
+
+# cache key of the PubmedRecord.dumps() of a pubmed ID
+RECORD_KEY = 'pubmed-record:%d'
+
+# returns list of PubmedRecords of efetch xml
+def parse_records(text):
+    return list(iter_pubmed_records(io.BytesIO(text.encode('utf-8'))))
 
 class PubmedInterface():
 
-    def __init__(self):
-        Entrez.email = "michael.chiang.mc5@gmail.com"
-        self.entries = [] # each entry is a single pubmed result
+    # cache=None sends every request to pubmed
+    def __init__(self, client=eutils_client, cache=pubmed_cache):
+        self.client = client
+        self.cache = cache
+        self.entries = [] # each entry is a single pubmed result, a PubmedRecord
         self.numberSearchResults = 0 # this is the total number of results returned by a pubmed search, not the number of entries stored
+        self.history = None # search session on the NCBI history server, see startSearch
 
     def __str__(self):
         return str(self.entries)
 
+    # also sets numberSearchResults, which esearch reports with every page
+    # two round trips: esearch for count and IDs, then efetch (in parallel batches for long pages), both cached
     def getRecords(self,search_str,retMin,retMax):
-        ids = self.getIDs(search_str,retMin,retMax)
-        handle = Entrez.efetch(db="pubmed", id=ids, rettype="medline",retmode="text")
-        records = Medline.parse(handle)
-        rn = []
-        for record in records:
-            pubmedEntry = PubmedEntry()
-            pubmedEntry.title = record.get("TI",None)
-            pubmedEntry.author = record.get("AU",None)
-            pubmedEntry.journal = record.get("TA",None)
-            pubmedEntry.volume = record.get("VI",None)
-            pubmedEntry.number = record.get("IP",None)
-            pubmedEntry.pages = record.get("PG",None)
-            pubmedEntry.date = record.get("DP", None)
-            pubmedEntry.fullSource = record.get("SO",None)
-            pubmedEntry.keywords = record.get("OT", None)
-            pubmedEntry.abstract = record.get("AB", None)
-            pubmedEntry.doi = record.get("LID", None)
-            pubmedEntry.fullAuthorNames = record.get("FAU", None)
-            pubmedEntry.pubmedID = int(record.get("PMID", None))
-            self.entries.append(pubmedEntry)
+        self.numberSearchResults,ids = self.search(search_str,retMin,retMax)
+        self.addRecords(ids)
+
+    # returns (number of search results,pubmed IDs of results retMin to retMin+retMax)
+    def search(self,search_str,retMin,retMax):
+        if self.cache is None:
+            return self.client.esearch(search_str,retMin,retMax)
+        key = 'esearch:%d:%d:%s' % (retMin,retMax,normalize_query(search_str))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return tuple(json.loads(cached))
+        count,ids = self.client.esearch(search_str,retMin,retMax)
+        self.cache.set(key,json.dumps([count,ids]),ESEARCH_CACHE_TTL)
+        return count,ids
+
+    # runs esearch once and keeps the results on the NCBI history server, then fetches the first retMax records
+    # returns the search session {'search_str','webenv','query_key','count'}, which callers store (e.g., in the
+    # user's session) to fetch later pages with getPage
+    def startSearch(self,search_str,retMax):
+        count,ids,webenv,query_key = self.client.esearch_history(search_str,retMax)
+        self.history = {'search_str':search_str,'webenv':webenv,'query_key':query_key,'count':count}
+        self.numberSearchResults = count
+        self.addRecords(ids)
+        return self.history
+
+    # fetches records retMin to retMin+retMax of a search started with startSearch with a single efetch from the
+    # history server, so results keep the order of the first page and the search is not run again
+    # if NCBI has dropped the session, the search is started again and self.history is the new session
+    def getPage(self,history,retMin,retMax):
+        self.history = history
+        self.numberSearchResults = history['count']
+        key = 'history:%s:%s:%d:%d' % (history['webenv'],history['query_key'],retMin,retMax)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            self.addRecords(json.loads(cached))
+            return
+        try:
+            records = self.fetchPage(history['webenv'],history['query_key'],retMin,retMax)
+        except (EutilsError,ElementTree.ParseError):
+            records = []
+        if len(records) == 0 and retMin < history['count']: # expired session
+            count,ids,webenv,query_key = self.client.esearch_history(history['search_str'],0)
+            self.history = dict(history,webenv=webenv,query_key=query_key,count=count)
+            self.numberSearchResults = count
+            records = self.fetchPage(webenv,query_key,retMin,retMax)
+            key = 'history:%s:%s:%d:%d' % (webenv,query_key,retMin,retMax)
+        if self.cache is not None:
+            self.cache.set_many(dict((RECORD_KEY % record.pubmedID,record.dumps()) for record in records),EFETCH_CACHE_TTL)
+            self.cache.set(key,json.dumps([record.pubmedID for record in records]),ESEARCH_CACHE_TTL)
+        self.entries.extend(records)
+
+    def fetchPage(self,webenv,query_key,retMin,retMax):
+        return parse_records(self.client.efetch_history(webenv,query_key,retMin,retMax,rettype=None,retmode='xml'))
+
+    # returns PubmedRecords of ids, in the order of ids. Only uncached records are fetched
+    def getRecordsByID(self,ids):
+        ids = [int(pubmedID) for pubmedID in ids]
+        records = {}
+        if self.cache is not None:
+            for text in self.cache.get_many(RECORD_KEY % pubmedID for pubmedID in ids).values():
+                record = PubmedRecord.loads(text)
+                records[record.pubmedID] = record
+        missing = [pubmedID for pubmedID in ids if pubmedID not in records]
+        if len(missing) > 0:
+            fetched = [record for text in self.client.efetch(missing,rettype=None,retmode='xml') for record in parse_records(text)]
+            if self.cache is not None:
+                self.cache.set_many(dict((RECORD_KEY % record.pubmedID,record.dumps()) for record in fetched),EFETCH_CACHE_TTL)
+            records.update((record.pubmedID,record) for record in fetched)
+        return [records[pubmedID] for pubmedID in ids if pubmedID in records] # deleted records are not returned
+
+    def addRecords(self,ids):
+        self.entries.extend(self.getRecordsByID(ids))
 
     # retMin starts at 0 (i.e., first search result is indexed as 0)
     def getIDs(self,search_str,retMin,retMax):
-        handle = Entrez.esearch(db="pubmed", term=search_str, retstart=retMin , retmax=retMax)
-        record = Entrez.read(handle)
-        idlist = record["IdList"]
+        count,idlist = self.search(search_str,retMin,retMax)
         return idlist
 
     def countNumberSearchResults(self,search_str):
-        handle = Entrez.egquery(term=search_str)
-        record = Entrez.read(handle)
-        for row in record["eGQueryResult"]:
-            if row["DbName"]=="pubmed":
-                self.numberSearchResults = int(row["Count"])
+        self.numberSearchResults,idlist = self.search(search_str,0,0)
 
     # create list of citations
     def getCitationList(self):
         entries = self.entries
+        existing_pks = get_existing_citation_pks(entry.pubmedID for entry in entries) # at most one query
         citations = []
         for i,entry in enumerate(entries):
             citation = Citation()
@@ -65,7 +151,7 @@ class PubmedInterface():
             for f in field_list:
                 field_entry = str(getattr(entry,f))
                 setattr(citation,f,field_entry)
-            pk = self.checkPreexistingCitations(i)
+            pk = existing_pks.get(entry.pubmedID,-1)
             if pk == -1:
                 citation.preexistingEntry = False
                 setattr(citation,"pk",-i) # hacky way to make sure pk is unique
@@ -79,31 +165,4 @@ class PubmedInterface():
     # returns -1 if no prexisting entry, otherwise returns pk of citation
     def checkPreexistingCitations(self,i):
         entry = self.entries[i]
-        pubmedID = entry.pubmedID
-        try:
-            pk = Citation.objects.get(pubmedID=pubmedID).pk
-        except:
-            return -1
-        else:
-            return pk
-
-
-class PubmedEntry():
-
-    def __init__(self):
-        self.title = None
-        self.author = None
-        self.journal = None
-        self.volume = None
-        self.number = None
-        self.pages = None
-        self.date = None
-        self.fullSource = None
-        self.keywords = None
-        self.abstract = None
-        self.doi = None
-        self.fullAuthorNames = None
-        self.pubmedID = None
-
-    def __str__(self):
-        return "Stores a single pubmed citation"
+        return get_existing_citation_pks([entry.pubmedID]).get(entry.pubmedID,-1)
@@ -0,0 +1,106 @@
+# Pages through all citations for the index page with keyset pagination
+# A page is read with WHERE (sort key) < (sort key of the last citation of the previous page), which uses the
+# indexes on the sort keys, so deep pages are as fast as the first one (OFFSET reads and drops every row before it)
+# Example usage:
+# from papers.catalog import get_catalog_page
+# citations,next_cursor = get_catalog_page('activity')
+# citations,next_cursor = get_catalog_page('activity',after=next_cursor)
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+import calendar
+import datetime
+from .models import Citation, UserProfile
+
+CATALOG_PAGE_SIZE = getattr(settings, 'CATALOG_PAGE_SIZE', 20)
+
+# (name, label) of the index page sort options
+CATALOG_SORTS = (('added','Added'),
+                 ('activity','Recent activity'),
+                 ('discussed','Most discussed'))
+
+# fields of each sort, all descending. pk comes last so that keys are unique (see Citation.Meta.index_together)
+SORT_FIELDS = {'added': ('pk',),
+               'activity': ('last_activity','pk'),
+               'discussed': ('post_count','pk')}
+
+DEFAULT_SORT = 'added'
+
+def is_catalog_sort(name):
+    return name in SORT_FIELDS
+
+# cursors are the values of the sort fields of the last citation on a page, e.g., '1443657600000000:12'
+# datetimes are written as microseconds since the epoch
+def encode_catalog_cursor(citation, sort):
+    values = []
+    for fieldname in SORT_FIELDS[sort]:
+        value = getattr(citation,fieldname)
+        if isinstance(value,datetime.datetime):
+            value = calendar.timegm(value.utctimetuple()) * 10**6 + value.microsecond
+        values.append('%d' % value)
+    return ':'.join(values)
+
+# raises ValueError for malformed cursors, including values too large for the database or for datetimes
+def decode_catalog_cursor(cursor, sort):
+    fieldnames = SORT_FIELDS[sort]
+    values = [int(value) for value in cursor.split(':')]
+    if len(values) != len(fieldnames):
+        raise ValueError('cursor %r does not match sort %r' % (cursor,sort))
+    if any(abs(value) >= 2**63 for value in values):
+        raise ValueError('cursor %r is out of range' % cursor)
+    for i,fieldname in enumerate(fieldnames):
+        if fieldname == 'last_activity':
+            try:
+                values[i] = datetime.datetime(1970,1,1,tzinfo=timezone.utc) + datetime.timedelta(microseconds=values[i])
+            except OverflowError:
+                raise ValueError('cursor %r is out of range' % cursor)
+    return values
+
+# returns Q selecting rows whose (field1, field2, ...) sorts after values in descending order
+def get_keyset_filter(fieldnames, values):
+    keyset_filter = Q()
+    for i,fieldname in enumerate(fieldnames):
+        equal = dict(zip(fieldnames[:i],values[:i]))
+        equal[fieldname + '__lt'] = values[i]
+        keyset_filter |= Q(**equal)
+    return keyset_filter
+
+# adds num_readers (number of user libraries a citation is in) and prefetches tags, shown on the index page
+# num_readers is a correlated subquery rather than annotate(Count('userProfiles')): the join and GROUP BY of
+# annotate would group every citation after the cursor before the page is cut, so pages would slow down as the
+# catalog grows. The subquery only runs for the citations of the page
+def annotate_page(citations):
+    library = UserProfile.library.through._meta
+    num_readers = 'SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s' % (
+        library.db_table,library.db_table,library.get_field('citation').column,
+        Citation._meta.db_table,Citation._meta.pk.column)
+    return citations.extra(select={'num_readers':num_readers}).prefetch_related('tags')
+
+# returns (citations,cursor of next page or None) for one page of citations in sort order
+# two queries per page whatever the page (see annotate_page)
+# after is the cursor returned with the previous page, raises ValueError if it is malformed
+def get_catalog_page(sort=DEFAULT_SORT, after=None, page_size=CATALOG_PAGE_SIZE):
+    fieldnames = SORT_FIELDS[sort]
+    citations = Citation.objects.all()
+    if after is not None:
+        citations = citations.filter(get_keyset_filter(fieldnames,decode_catalog_cursor(after,sort)))
+    citations = citations.order_by(*['-' + fieldname for fieldname in fieldnames])
+    citations = list(annotate_page(citations)[:page_size+1])
+    next_cursor = None
+    if len(citations) > page_size:
+        citations = citations[:page_size]
+        next_cursor = encode_catalog_cursor(citations[-1],sort)
+    return citations,next_cursor
+
+# same as get_catalog_page sorted by 'added', for the citations in citation_pks (a sorted numpy array, see facets.py)
+# the page is cut from citation_pks before the database is queried
+def get_catalog_page_of_pks(citation_pks, after=None, page_size=CATALOG_PAGE_SIZE):
+    if after is not None:
+        citation_pks = citation_pks[citation_pks < decode_catalog_cursor(after,'added')[0]]
+    page_pks = [int(pk) for pk in citation_pks[::-1][:page_size+1]]
+    citations = list(annotate_page(Citation.objects.filter(pk__in=page_pks[:page_size])).order_by('-pk'))
+    next_cursor = None
+    if len(page_pks) > page_size:
+        next_cursor = '%d' % page_pks[page_size-1]
+    return citations,next_cursor
@@ -0,0 +1,57 @@
+# Wire format for citations sent from the search page back to addCitation (see citation_summary_template.html)
+# A citation is encoded as '<version>:<json array of CITATION_FIELDS values, in that order>', signed with
+# django.core.signing so addCitation can trust search results without fetching them from pubmed again
+# Example usage:
+# from papers.citation_codec import encode_citation, decode_citation
+# value = encode_citation(citation)       # e.g., '1:[26000000,"my title",...]:<signature>'
+# fields = decode_citation(value)         # {'pubmedID': 26000000, 'title': 'my title', ...}
+
+from django.conf import settings
+from django.core import signing
+import json
+
+CITATION_CODEC_VERSION = 1
+
+# order of values in the encoded array. Append new fields at the end and bump CITATION_CODEC_VERSION
+CITATION_FIELDS = ('pubmedID','title','authors','journal','journalAbbreviated','volume','number','pages',
+                   'pubDate','keywords','mesh_keywords','abstract','doi','link')
+
+# unsigned values are accepted only if this is False
+CITATION_CODEC_SIGNED = getattr(settings, 'CITATION_CODEC_SIGNED', True)
+
+signer = signing.Signer(salt='papers.citation_codec')
+
+class CitationCodecError(ValueError):
+    pass
+
+# values are whatever parse_pubmedJson left in the fields: strings, numbers, lists and dicts
+def encode_citation(citation, signed=CITATION_CODEC_SIGNED):
+    values = [getattr(citation,fieldname) for fieldname in CITATION_FIELDS]
+    value = '%d:%s' % (CITATION_CODEC_VERSION,json.dumps(values,separators=(',',':'),ensure_ascii=False))
+    if signed:
+        value = signer.sign(value)
+    return value
+
+# returns {fieldname: value}, raises CitationCodecError if value is tampered with or malformed
+def decode_citation(value, signed=CITATION_CODEC_SIGNED):
+    if signed:
+        try:
+            value = signer.unsign(value)
+        except signing.BadSignature:
+            raise CitationCodecError('bad signature')
+    version,sep,payload = value.partition(':')
+    if version != str(CITATION_CODEC_VERSION):
+        raise CitationCodecError('unknown version %r' % version[:10])
+    try:
+        values = json.loads(payload)
+    except ValueError:
+        raise CitationCodecError('payload is not json')
+    if type(values) is not list or len(values) != len(CITATION_FIELDS):
+        raise CitationCodecError('expected a list of %d fields' % len(CITATION_FIELDS))
+    fields = dict(zip(CITATION_FIELDS,values))
+    if fields['pubmedID'] is not None:
+        try:
+            fields['pubmedID'] = int(fields['pubmedID'])
+        except (ValueError,TypeError):
+            raise CitationCodecError('pubmedID is not a number')
+    return fields
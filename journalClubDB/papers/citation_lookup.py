@@ -0,0 +1,73 @@
+# Finds which pubmed search results are already citations in the database, one query per results page
+# Pubmed IDs that are not in the in-process set of known pubmed IDs are misses without asking the database
+# Example usage:
+# from papers.citation_lookup import annotate_existing_citations
+# annotate_existing_citations(citations)     # sets citation.existing_pk to the pk of the saved citation, or -1
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+import threading
+import time
+from .models import Citation
+
+# set to False to always ask the database
+KNOWN_PUBMED_IDS_CACHE = getattr(settings, 'KNOWN_PUBMED_IDS_CACHE', True)
+
+# citations saved by other processes are only seen after the set is reloaded
+KNOWN_PUBMED_IDS_TTL = getattr(settings, 'KNOWN_PUBMED_IDS_TTL', 60*5)
+
+# Set of the pubmed IDs of all citations, loaded with one query and reloaded every ttl seconds
+# Citations saved by this process are added right away (see add_known_pubmed_id). A stale set only
+# shows the import button for a citation another process just saved, and save_if_unique handles that
+class KnownPubmedIds(object):
+    def __init__(self, ttl=KNOWN_PUBMED_IDS_TTL):
+        self.ttl = ttl
+        self.pubmed_ids = None
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.is_stale():
+            with self.lock:
+                if self.is_stale(): # another thread may have reloaded it while we waited
+                    pubmed_ids = set(Citation.objects.exclude(pubmedID=None).values_list('pubmedID',flat=True))
+                    self.pubmed_ids,self.loaded_at = pubmed_ids,time.time()
+        return self.pubmed_ids
+
+    def is_stale(self):
+        return self.pubmed_ids is None or time.time() - self.loaded_at > self.ttl
+
+    def add(self, pubmed_ids):
+        if self.pubmed_ids is not None:
+            self.pubmed_ids.update(pubmed_ids)
+
+    def clear(self):
+        self.pubmed_ids = None
+
+known_pubmed_ids = KnownPubmedIds()
+
+@receiver(post_save, sender=Citation)
+def add_known_pubmed_id(sender, instance, created, **kwargs):
+    if created and instance.pubmedID is not None:
+        known_pubmed_ids.add([int(instance.pubmedID)])
+
+# returns {pubmed ID: pk} of saved citations among pubmed_ids, at most one query
+def get_existing_citation_pks(pubmed_ids):
+    pubmed_ids = set(int(pubmedID) for pubmedID in pubmed_ids if pubmedID is not None and pubmedID != '')
+    if KNOWN_PUBMED_IDS_CACHE:
+        pubmed_ids &= known_pubmed_ids.get()
+    if len(pubmed_ids) == 0:
+        return {}
+    return dict(Citation.objects.filter(pubmedID__in=pubmed_ids).values_list('pubmedID','pk'))
+
+# sets existing_pk of every citation (unsaved search results) to the pk of the matching saved citation, or -1
+# Citation.preExistingEntryExists returns existing_pk when it is set
+def annotate_existing_citations(citations):
+    existing_pks = get_existing_citation_pks(citation.eval('pubmedID') for citation in citations)
+    for citation in citations:
+        pubmedID = citation.eval('pubmedID')
+        citation.existing_pk = -1
+        if pubmedID is not None and pubmedID != '':
+            citation.existing_pk = existing_pks.get(int(pubmedID),-1)
+    return citations
@@ -0,0 +1,162 @@
+# Full-text search over saved citations with BM25 ranking, without an external search server
+# Citation text is tokenized into an inverted index (SearchPosting, SearchDocument) that is updated whenever a
+# citation is saved (see models.update_search_index). A query reads only the postings of its terms and is
+# ranked by the database in a single grouped query, so its cost depends on how common the terms are and not
+# on the number of citations
+# Example usage:
+# from papers.citation_search import search_citations
+# citations = search_citations('worm aging')     # best match first, each with citation.search_score
+# python manage.py rebuild_search_index           # after changing tokenize or FIELD_WEIGHTS
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+import math
+import re
+from .models import Citation, SearchPosting, SearchDocument
+
+# BM25 parameters: k1 controls term frequency saturation, b how much long citations are penalized
+BM25_K1 = getattr(settings, 'SEARCH_BM25_K1', 1.2)
+BM25_B = getattr(settings, 'SEARCH_BM25_B', 0.75)
+
+# a match in the title counts as much as three matches in the abstract
+FIELD_WEIGHTS = (('title',3),
+                 ('keywords',2),
+                 ('mesh_keywords',2),
+                 ('authors',2),
+                 ('journal',1),
+                 ('abstract',1))
+
+# fields stored as python literals of the structures parsed from pubmed
+LITERAL_FIELDS = ('keywords','mesh_keywords','abstract')
+
+# fields read when indexing, so index_citations works on querysets limited with only()
+INDEXED_FIELDS = tuple(fieldname for fieldname,weight in FIELD_WEIGHTS)
+
+# longer queries are cut off, every term adds a CASE branch to the ranking query
+MAX_QUERY_TERMS = 16
+
+# rows per INSERT when writing postings (sqlite limits the size of a multi-row insert)
+INDEX_BATCH_SIZE = 300
+
+# number of citations and total document length change slowly and barely move BM25 scores, so they are cached
+SEARCH_STATS_CACHE_TIMEOUT = getattr(settings, 'SEARCH_STATS_CACHE_TIMEOUT', 60)
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+STOPWORDS = frozenset(('a','an','and','are','as','at','be','by','for','from','in','into','is','it','of','on',
+                       'or','that','the','their','this','to','was','were','which','with'))
+
+# returns list of terms in text: lowercased words, without stopwords and single letters
+def tokenize(text):
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if len(token) > 1 and token not in STOPWORDS:
+            terms.append(token[:SearchPosting._meta.get_field('term').max_length])
+    return terms
+
+# yields all strings in a decoded citation field (abstracts, keywords and MeSH headings are nested dicts/lists)
+def iter_strings(value):
+    if isinstance(value,str):
+        yield value
+    elif isinstance(value,dict):
+        for item in value.values():
+            for string in iter_strings(item):
+                yield string
+    elif isinstance(value,(list,tuple)):
+        for item in value:
+            for string in iter_strings(item):
+                yield string
+
+def get_field_text(citation, fieldname):
+    if fieldname == 'authors':
+        return ' '.join(author.get('first_name','') + ' ' + author.get('last_name','')
+                        for author in citation.get_authors())
+    value = getattr(citation,fieldname)
+    if not value:
+        return ''
+    if fieldname in LITERAL_FIELDS:
+        value = citation.eval(fieldname)
+    return ' '.join(iter_strings(value))
+
+# returns ({term: field-weighted frequency},document length) of a citation
+def get_term_frequencies(citation):
+    frequencies = {}
+    for fieldname,weight in FIELD_WEIGHTS:
+        for term in tokenize(get_field_text(citation,fieldname)):
+            frequencies[term] = frequencies.get(term,0) + weight
+    return frequencies,sum(frequencies.values())
+
+# (re)indexes saved citations, replacing their postings. A few queries for any number of citations
+def index_citations(citations):
+    postings = []
+    documents = []
+    for citation in citations:
+        frequencies,length = get_term_frequencies(citation)
+        postings.extend(SearchPosting(term=term,citation_id=citation.pk,frequency=frequency)
+                        for term,frequency in frequencies.items())
+        documents.append(SearchDocument(citation_id=citation.pk,length=length))
+    citation_pks = [document.citation_id for document in documents]
+    with transaction.atomic():
+        SearchPosting.objects.filter(citation__in=citation_pks).delete()
+        SearchDocument.objects.filter(citation__in=citation_pks).delete()
+        SearchPosting.objects.bulk_create(postings,batch_size=INDEX_BATCH_SIZE)
+        SearchDocument.objects.bulk_create(documents,batch_size=INDEX_BATCH_SIZE)
+    cache.delete('search-stats')
+
+# returns (number of indexed citations,average document length)
+def get_search_stats():
+    stats = cache.get('search-stats')
+    if stats is None:
+        totals = SearchDocument.objects.aggregate(n=Count('citation'),length=Sum('length'))
+        n = totals['n']
+        stats = (n,float(totals['length'] or 0) / n if n > 0 else 0.0)
+        cache.set('search-stats',stats,SEARCH_STATS_CACHE_TIMEOUT)
+    return stats
+
+# returns list of (citation pk,score) of the best matches for query, best first
+# a citation matches if it contains any of the query terms. Two queries plus the cached stats
+def rank_citations(query, limit=20, offset=0):
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS] # unique terms, in query order
+    if len(terms) == 0:
+        return []
+    n,average_length = get_search_stats()
+    if n == 0:
+        return []
+    doc_freqs = dict(SearchPosting.objects.filter(term__in=terms).values('term')
+                     .annotate(n=Count('citation')).values_list('term','n'))
+    terms = [term for term in terms if term in doc_freqs]
+    if len(terms) == 0:
+        return []
+
+    # score = sum over terms of idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+    idf_cases = ' '.join('WHEN %s THEN %s' for term in terms)
+    idf_params = []
+    for term in terms:
+        # n may be stale (see get_search_stats), so keep idf positive
+        idf_params += [term,math.log(1 + (max(n - doc_freqs[term],0) + 0.5) / (doc_freqs[term] + 0.5))]
+    sql = ('SELECT p.citation_id, SUM((CASE p.term %s ELSE 0.0 END) * p.frequency * %%s'
+           ' / (p.frequency + %%s + %%s * d.length)) AS score'
+           ' FROM %s p INNER JOIN %s d ON d.citation_id = p.citation_id'
+           ' WHERE p.term IN (%s)'
+           ' GROUP BY p.citation_id ORDER BY score DESC, p.citation_id DESC LIMIT %%s OFFSET %%s'
+           % (idf_cases,SearchPosting._meta.db_table,SearchDocument._meta.db_table,
+              ', '.join(['%s'] * len(terms))))
+    params = idf_params + [BM25_K1 + 1,BM25_K1 * (1 - BM25_B),BM25_K1 * BM25_B / (average_length or 1)]
+    params += terms + [limit,offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql,params)
+        return [(citation_pk,float(score)) for citation_pk,score in cursor.fetchall()]
+
+# returns list of citations matching query, best first, with their BM25 score in citation.search_score
+def search_citations(query, limit=20, offset=0):
+    ranked = rank_citations(query,limit,offset)
+    citations = Citation.objects.in_bulk([citation_pk for citation_pk,score in ranked])
+    results = []
+    for citation_pk,score in ranked:
+        if citation_pk in citations:
+            citation = citations[citation_pk]
+            citation.search_score = score
+            results.append(citation)
+    return results
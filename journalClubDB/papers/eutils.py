@@ -0,0 +1,103 @@
+# Client for the NCBI E-utilities used by PubmedInterface (esearch and efetch)
+# All requests of a process go through one requests.Session, so connections to NCBI are kept alive and reused
+# instead of opened for every call, and long efetch ID lists are split into batches fetched in parallel
+# Example usage:
+# from papers.eutils import eutils_client
+# count,ids = eutils_client.esearch('cell cycle',retstart=0,retmax=10)   # one round trip gives both
+# texts = eutils_client.efetch(ids)                                      # medline text of the ids, in order
+# count,ids,webenv,query_key = eutils_client.esearch_history('cell cycle',retmax=10)
+# text = eutils_client.efetch_history(webenv,query_key,retstart=10,retmax=10)  # second page, one round trip
+
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+EUTILS_URL = getattr(settings, 'PUBMED_EUTILS_URL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/')
+
+# NCBI asks tools to identify themselves, and allows 10 instead of 3 requests per second with an api key
+EUTILS_EMAIL = getattr(settings, 'PUBMED_EUTILS_EMAIL', 'michael.chiang.mc5@gmail.com')
+EUTILS_TOOL = getattr(settings, 'PUBMED_EUTILS_TOOL', 'journalClubDB')
+EUTILS_API_KEY = getattr(settings, 'PUBMED_EUTILS_API_KEY', None)
+
+# number of requests (and pooled connections) in flight at once, keep within the NCBI rate limit
+EUTILS_MAX_WORKERS = getattr(settings, 'PUBMED_EUTILS_MAX_WORKERS', 3)
+
+# seconds to wait for NCBI to connect or send data
+EUTILS_TIMEOUT = getattr(settings, 'PUBMED_EUTILS_TIMEOUT', 10)
+
+# number of pubmed IDs per efetch request
+EFETCH_BATCH_SIZE = 200
+
+class EutilsError(Exception):
+    pass
+
+class EutilsClient(object):
+    def __init__(self, base_url=EUTILS_URL, max_workers=EUTILS_MAX_WORKERS, timeout=EUTILS_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        # failed connections and NCBI's "too many requests" are retried with backoff
+        retry = Retry(total=2, backoff_factor=0.5, status_forcelist=(429,500,502,503))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    # returns the response of E-utility (e.g., 'esearch'), raises EutilsError if the request fails
+    def get(self, utility, params):
+        params = dict(params,db='pubmed',tool=EUTILS_TOOL,email=EUTILS_EMAIL)
+        if EUTILS_API_KEY:
+            params['api_key'] = EUTILS_API_KEY
+        try:
+            response = self.session.get(self.base_url + utility + '.fcgi',params=params,timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise EutilsError('%s failed: %s' % (utility,e))
+        return response
+
+    # returns (total number of results,list of pubmed IDs of results retstart to retstart+retmax)
+    # esearch reports the count with every page, so no separate counting request is needed
+    def esearch(self, term, retstart=0, retmax=20):
+        result = self.get_esearch_result({'term':term,'retstart':retstart,'retmax':retmax})
+        return int(result['count']),result['idlist']
+
+    # same as esearch for the first retmax results, and also keeps the results on the NCBI history server
+    # returns (count,idlist,webenv,query_key), later pages are fetched with efetch_history
+    def esearch_history(self, term, retmax=20):
+        result = self.get_esearch_result({'term':term,'retstart':0,'retmax':retmax,'usehistory':'y'})
+        try:
+            return int(result['count']),result['idlist'],result['webenv'],result['querykey']
+        except KeyError as e:
+            raise EutilsError('esearch did not return a history session: %r' % e)
+
+    def get_esearch_result(self, params):
+        response = self.get('esearch',dict(params,retmode='json'))
+        try:
+            result = response.json()['esearchresult']
+            result['count'],result['idlist'] # raise KeyError now if missing
+            return result
+        except (ValueError,KeyError) as e:
+            raise EutilsError('unexpected esearch response: %r' % e)
+
+    # returns list of response bodies with the records of ids (medline text, or xml with rettype=None, retmode='xml'),
+    # one per batch of batch_size ids, in the order of ids. Batches are fetched in parallel
+    def efetch(self, ids, rettype='medline', retmode='text', batch_size=EFETCH_BATCH_SIZE):
+        ids = [str(pubmedID) for pubmedID in ids]
+        batches = [ids[i:i+batch_size] for i in range(0,len(ids),batch_size)]
+        def fetch(batch):
+            return self.get('efetch',{'id':','.join(batch),'rettype':rettype,'retmode':retmode}).text
+        if len(batches) <= 1:
+            return [fetch(batch) for batch in batches]
+        return list(self.executor.map(fetch,batches))
+
+    # returns response body with records retstart to retstart+retmax of a search kept on the history server
+    # (see esearch_history), in search order and without sending the IDs. NCBI drops history sessions after
+    # a few hours of inactivity, and then answers with an error instead of records
+    def efetch_history(self, webenv, query_key, retstart, retmax, rettype='medline', retmode='text'):
+        return self.get('efetch',{'WebEnv':webenv,'query_key':query_key,'retstart':retstart,'retmax':retmax,
+                                  'rettype':rettype,'retmode':retmode}).text
+
+# shared by all requests of a process so that connections are reused
+eutils_client = EutilsClient()
@@ -0,0 +1,219 @@
+# Browsing citations by tag, journal, year and MeSH heading
+# Every facet value has a sorted numpy array of the pks of its citations. The arrays are loaded from the
+# tag/citation table and CitationFacet rows (written when a citation is saved, see index_citation_facets), kept
+# in memory, and updated in place when this process saves a citation or changes tags. Other processes reload
+# them every ttl seconds.  Filters are unions within a facet and intersections across facets, and the number
+# of matching citations of every facet value is counted in one vectorized pass per facet
+# Example usage:
+# from papers.facets import facet_index
+# citation_pks,counts = facet_index.browse({'journal':['Science'],'year':['2014','2015']})
+# counts['mesh']      # [('Aging',12),('Mice',7),...], most frequent first
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+import numpy as np
+import re
+import threading
+import time
+from .models import Citation, CitationFacet, Tag
+
+# (name, label) of each facet, in the order they are shown
+FACETS = (('tag','Tag'),
+          ('journal','Journal'),
+          ('year','Year'),
+          ('mesh','MeSH term'))
+
+FACET_NAMES = tuple(name for name,label in FACETS)
+
+# facets stored as CitationFacet rows. Tags come from Tag.citations
+CITATION_FACETS = ('journal','year','mesh')
+
+# facet values are reloaded from the database after this many seconds, to pick up writes of other processes
+FACET_INDEX_TTL = getattr(settings, 'FACET_INDEX_TTL', 60*5)
+
+# number of values of each facet returned by browse, most frequent first
+FACET_VALUE_LIMIT = getattr(settings, 'FACET_VALUE_LIMIT', 20)
+
+YEAR_PATTERN = re.compile(r'\d{4}')
+
+EMPTY = np.zeros(0,dtype=np.int64)
+
+# returns set of (facet,value) of a citation for CITATION_FACETS
+def get_citation_facet_values(citation):
+    values = set()
+    if citation.journal:
+        values.add(('journal',citation.journal[:255]))
+    pubDate = citation.eval('pubDate')
+    if isinstance(pubDate,dict):
+        year = YEAR_PATTERN.search(str(pubDate.get('Year') or pubDate.get('MedlineDate') or ''))
+        if year:
+            values.add(('year',year.group(0)))
+    headings = citation.eval('mesh_keywords') if citation.mesh_keywords else []
+    if isinstance(headings,dict): # a single heading
+        headings = [headings]
+    if isinstance(headings,list):
+        for heading in headings:
+            name = heading.get('DescriptorName') if isinstance(heading,dict) else None
+            if isinstance(name,str) and name != '':
+                values.add(('mesh',name[:255]))
+    return values
+
+# replaces the CitationFacet rows of saved citations, and updates the in-memory index of this process
+def index_citation_facets(citations):
+    citation_pks = [citation.pk for citation in citations]
+    old_values = {}
+    for citation_pk,facet,value in CitationFacet.objects.filter(citation__in=citation_pks).values_list('citation_id','facet','value'):
+        old_values.setdefault(citation_pk,set()).add((facet,value))
+    new_values = dict((citation.pk,get_citation_facet_values(citation)) for citation in citations)
+    with transaction.atomic():
+        CitationFacet.objects.filter(citation__in=citation_pks).delete()
+        CitationFacet.objects.bulk_create([CitationFacet(citation_id=citation_pk,facet=facet,value=value)
+                                           for citation_pk,values in new_values.items()
+                                           for facet,value in values],batch_size=300)
+    removed,added = {},{}
+    for citation_pk,values in new_values.items():
+        old = old_values.get(citation_pk,set())
+        for facet_value in old - values:
+            removed.setdefault(facet_value,[]).append(citation_pk)
+        for facet_value in values - old:
+            added.setdefault(facet_value,[]).append(citation_pk)
+    for (facet,value),pks in removed.items():
+        facet_index.remove(facet,value,pks)
+    for (facet,value),pks in added.items():
+        facet_index.add(facet,value,pks)
+
+# sorted pk arrays of the values of one facet
+class FacetPostings(object):
+    def __init__(self, postings):
+        self.postings = postings # {value: sorted array of citation pks}
+        self.flat = None
+
+    # returns (values sorted by name,citation pks of all values,value number of each pk), rebuilt after changes
+    def get_flat(self):
+        flat = self.flat
+        if flat is None:
+            values = sorted(self.postings)
+            arrays = [self.postings[value] for value in values]
+            pks = np.concatenate(arrays) if len(arrays) > 0 else EMPTY
+            numbers = np.repeat(np.arange(len(values)),[len(array) for array in arrays])
+            flat = self.flat = (values,pks,numbers)
+        return flat
+
+    # returns list of (value,count) of the limit values with the most citations in matches (a boolean array
+    # indexed by citation pk, or None for all citations), most frequent first and then by name
+    # counts of all values are computed at once with bincount over the flat arrays
+    def count(self, matches, limit):
+        values,pks,numbers = self.get_flat()
+        if matches is None:
+            counts = np.bincount(numbers,minlength=len(values))
+        else:
+            inside = pks < len(matches) # pks above the largest matching pk do not match
+            counts = np.bincount(numbers[inside][matches[pks[inside]]],minlength=len(values))
+        order = np.argsort(-counts,kind='mergesort')[:limit] # stable, so ties stay sorted by name
+        return [(values[i],int(counts[i])) for i in order if counts[i] > 0]
+
+class FacetIndex(object):
+    def __init__(self, ttl=FACET_INDEX_TTL):
+        self.ttl = ttl
+        self.facets = None # {facet: FacetPostings}
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.is_stale():
+            with self.lock:
+                if self.is_stale(): # another thread may have reloaded it while we waited
+                    rows = {}
+                    tag_rows = Tag.citations.through.objects.values_list('tag__name','citation_id')
+                    for name,citation_pk in tag_rows.iterator():
+                        rows.setdefault('tag',{}).setdefault(name,[]).append(citation_pk)
+                    for facet,value,citation_pk in CitationFacet.objects.values_list('facet','value','citation_id').iterator():
+                        rows.setdefault(facet,{}).setdefault(value,[]).append(citation_pk)
+                    facets = {}
+                    for facet in FACET_NAMES:
+                        postings = rows.get(facet,{})
+                        facets[facet] = FacetPostings(dict((value,np.unique(np.array(pks,dtype=np.int64)))
+                                                           for value,pks in postings.items()))
+                    self.facets,self.loaded_at = facets,time.time()
+        return self.facets
+
+    def is_stale(self):
+        return self.facets is None or time.time() - self.loaded_at > self.ttl
+
+    def clear(self):
+        self.facets = None
+
+    # add and remove do nothing until the index is loaded, it is then read from the database
+    def add(self, facet, value, citation_pks):
+        facets = self.facets
+        if facets is not None:
+            postings = facets[facet]
+            postings.postings[value] = np.union1d(postings.postings.get(value,EMPTY),np.array(citation_pks,dtype=np.int64))
+            postings.flat = None
+
+    def remove(self, facet, value, citation_pks):
+        facets = self.facets
+        if facets is not None and value in facets[facet].postings:
+            postings = facets[facet]
+            remaining = np.setdiff1d(postings.postings[value],np.array(citation_pks,dtype=np.int64),assume_unique=True)
+            if len(remaining) > 0:
+                postings.postings[value] = remaining
+            else:
+                del postings.postings[value]
+            postings.flat = None
+
+    # returns (sorted array of pks of the citations matching filters or None if there are no filters,
+    #          {facet: [(value,count)] of the most frequent values among the matching citations})
+    # filters is {facet: list of values}, citations match if they have any of the values of every facet
+    def browse(self, filters, limit=FACET_VALUE_LIMIT):
+        facets = self.load()
+        matching_pks = None
+        for facet,values in filters.items():
+            postings = facets[facet].postings
+            union = EMPTY
+            for value in values:
+                union = np.union1d(union,postings.get(value,EMPTY))
+            if matching_pks is None:
+                matching_pks = union
+            else:
+                matching_pks = np.intersect1d(matching_pks,union,assume_unique=True)
+        matches = None
+        if matching_pks is not None:
+            # boolean array indexed by citation pk
+            matches = np.zeros(int(matching_pks[-1]) + 1 if len(matching_pks) > 0 else 0,dtype=bool)
+            matches[matching_pks] = True
+        counts = dict((facet,facets[facet].count(matches,limit)) for facet in FACET_NAMES)
+        return matching_pks,counts
+
+facet_index = FacetIndex()
+
+# tags added to or removed from citations, from either side (tag.citations, citation.tags)
+@receiver(m2m_changed, sender=Tag.citations.through)
+def update_tag_facets(sender, instance, action, reverse, pk_set, **kwargs):
+    if facet_index.facets is None or action not in ('post_add','post_remove','post_clear'):
+        return
+    if action == 'post_clear': # cleared rows are not reported
+        facet_index.clear()
+        return
+    if reverse: # instance is a Citation, pk_set holds tag pks
+        changes = [(name,[instance.pk]) for name in Tag.objects.filter(pk__in=pk_set).values_list('name',flat=True)]
+    else:       # instance is a Tag, pk_set holds citation pks
+        changes = [(instance.name,list(pk_set))]
+    for name,citation_pks in changes:
+        if action == 'post_add':
+            facet_index.add('tag',name,citation_pks)
+        else:
+            facet_index.remove('tag',name,citation_pks)
+
+# renamed or deleted tags and deleted citations are not tracked, the index is reloaded instead
+@receiver(post_save, sender=Tag)
+def clear_facets_on_tag_save(sender, instance, created, **kwargs):
+    if not created:
+        facet_index.clear()
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Citation)
+def clear_facets_on_delete(sender, **kwargs):
+    facet_index.clear()
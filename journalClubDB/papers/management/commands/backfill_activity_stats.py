@@ -0,0 +1,27 @@
+# Recomputes the denormalized post_count and last_activity of every Thread and Citation from their posts
+# Usage: python manage.py backfill_activity_stats
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+from papers.models import Citation, Thread, Post
+
+class Command(BaseCommand):
+    help = 'Fills Thread/Citation.post_count and last_activity from their posts'
+
+    def handle(self, *args, **options):
+        # one aggregate query per column, grouped by thread and by citation
+        counted_posts = Post.objects.filter(node_depth__gt=0,deleted=False)
+        with transaction.atomic():
+            for model,key in ((Thread,'thread'),(Citation,'thread__owner')):
+                post_counts = dict(counted_posts.values_list(key).annotate(Count('pk')).order_by())
+                last_activity = dict(Post.objects.values_list(key).annotate(Max('time_created')).order_by())
+                rows = list(model.objects.values_list('pk','post_count','last_activity'))
+                num_updated = 0
+                for pk,post_count,time in rows:
+                    new_post_count = post_counts.get(pk,0)
+                    new_time = last_activity.get(pk,time) # keep creation time of objects without posts
+                    if (post_count,time) != (new_post_count,new_time):
+                        model.objects.filter(pk=pk).update(post_count=new_post_count,last_activity=new_time)
+                        num_updated += 1
+                self.stdout.write('Updated %d of %d %s rows' % (num_updated,len(rows),model.__name__))
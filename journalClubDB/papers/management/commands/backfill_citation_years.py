@@ -0,0 +1,29 @@
+# Fills Citation.year_published of citations saved before it was precomputed in save()
+# Safe to run more than once, rows that already have year_published filled in are skipped
+# Usage: python manage.py backfill_citation_years [--chunk-size 500]
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from papers.models import Citation
+
+class Command(BaseCommand):
+    help = 'Precomputes Citation.year_published from pubDate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of citations filled in per transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        pks = list(Citation.objects.filter(year_published='').values_list('pk',flat=True))
+        num_filled = 0
+        for i in range(0,len(pks),chunk_size):
+            with transaction.atomic():
+                for citation in Citation.objects.filter(pk__in=pks[i:i+chunk_size]).only('pk','pubDate'):
+                    year_published = Citation.format_year_published(citation.eval('pubDate'))
+                    if not year_published:
+                        continue
+                    # update() instead of save() so only the year column is written
+                    Citation.objects.filter(pk=citation.pk).update(year_published=year_published)
+                    num_filled += 1
+        self.stdout.write('Filled in the year of %d of %d citations' % (num_filled,len(pks)))
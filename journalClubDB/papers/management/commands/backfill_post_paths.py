@@ -0,0 +1,28 @@
+# Fills in Post.path for posts created before materialized paths were added
+# Usage: python manage.py backfill_post_paths
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from papers.models import Post
+
+class Command(BaseCommand):
+    help = 'Computes the materialized ancestry path of every post'
+
+    def handle(self, *args, **options):
+        # a post's path only depends on its mother's path, so process posts in order of node depth
+        rows = Post.objects.order_by('node_depth').values_list('pk','mother_id','node_depth','path')
+        paths = {}
+        depths = {}
+        num_updated = 0
+        with transaction.atomic():
+            for pk,mother_id,node_depth,old_path in rows:
+                depths[pk] = node_depth
+                if mother_id is None or depths.get(mother_id,0) == 0:
+                    path = ''
+                else:
+                    path = paths[mother_id] + Post.path_segment(mother_id)
+                paths[pk] = path
+                if path != old_path:
+                    Post.objects.filter(pk=pk).update(path=path)
+                    num_updated += 1
+        self.stdout.write('Updated %d of %d post paths' % (num_updated,len(paths)))
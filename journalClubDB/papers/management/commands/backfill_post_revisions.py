@@ -0,0 +1,38 @@
+# Moves the legacy json edit history stored in Post.text into PostRevision rows and Post.current_text
+# Usage: python manage.py backfill_post_revisions [--chunk-size 500]
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from papers.models import Post, PostRevision
+
+class Command(BaseCommand):
+    help = 'Converts the json edit history of each post into PostRevision rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of posts converted per transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        # posts that already have revisions were created or converted after the switch, skip them
+        pks = list(Post.objects.exclude(text='').filter(revisions__isnull=True).values_list('pk',flat=True))
+        num_revisions = 0
+        for i in range(0,len(pks),chunk_size):
+            with transaction.atomic():
+                revisions = []
+                for post in Post.objects.filter(pk__in=pks[i:i+chunk_size]).only('pk','text'):
+                    try:
+                        edits = post.get_undecoded_textTupleVector()
+                    except ValueError:
+                        self.stderr.write('post %d: edit history is not valid json, skipped' % post.pk)
+                        continue
+                    if len(edits) == 0:
+                        continue
+                    for text,editor_pk,date_added,editor_name in edits:
+                        revisions.append(PostRevision(post_id=post.pk,text=text,editor_id=editor_pk,
+                                                      editor_name=editor_name,time_created=date_added))
+                    text,editor_pk,date_added,editor_name = edits[-1]
+                    Post.objects.filter(pk=post.pk).update(current_text=text,current_editor=editor_pk,current_time=date_added)
+                PostRevision.objects.bulk_create(revisions)
+                num_revisions += len(revisions)
+        self.stdout.write('Created %d revisions for %d posts' % (num_revisions,len(pks)))
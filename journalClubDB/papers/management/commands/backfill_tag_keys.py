@@ -0,0 +1,38 @@
+# Fills Tag.key, merges tags whose names only differ in case or spacing, and recounts Tag.citation_count
+# Tags whose key is still NULL do not conflict, so the unique key column can be added before running this
+# Safe to run more than once
+# Usage: python manage.py backfill_tag_keys
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from papers.models import Tag
+
+class Command(BaseCommand):
+    help = 'Merges duplicate tags, fills Tag.key and recounts Tag.citation_count'
+
+    def handle(self, *args, **options):
+        TagCitation = Tag.citations.through
+        keepers = {}
+        num_merged = 0
+        for pk,name in Tag.objects.order_by('pk').values_list('pk','name'):
+            key = Tag.normalize_key(name)
+            if key not in keepers:
+                keepers[key] = pk
+                continue
+            # the oldest tag with the key is kept. citation_count is recounted below
+            with transaction.atomic():
+                keeper_citation_pks = set(TagCitation.objects.filter(tag_id=keepers[key]).values_list('citation_id',flat=True))
+                TagCitation.objects.bulk_create([TagCitation(tag_id=keepers[key],citation_id=citation_pk)
+                                                 for citation_pk in TagCitation.objects.filter(tag_id=pk).values_list('citation_id',flat=True)
+                                                 if citation_pk not in keeper_citation_pks])
+                TagCitation.objects.filter(tag_id=pk).delete()
+                Tag.objects.filter(pk=pk).delete()
+            self.stdout.write('tag %d -> %d' % (pk,keepers[key]))
+            num_merged += 1
+
+        counts = dict(Tag.objects.annotate(n=Count('citations')).values_list('pk','n'))
+        with transaction.atomic():
+            for key,pk in keepers.items():
+                Tag.objects.filter(pk=pk).update(key=key,citation_count=counts.get(pk,0))
+        self.stdout.write('%d duplicate tags merged, %d tags' % (num_merged,len(keepers)))
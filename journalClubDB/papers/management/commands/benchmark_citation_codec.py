@@ -0,0 +1,39 @@
+# Compares the citation wire format of citation_codec.py with the old str(__dict__)/ast.literal_eval format
+# Usage: python manage.py benchmark_citation_codec [--abstract-size 5000] [--repeat 1000]
+
+from django.core.management.base import BaseCommand
+import ast
+import timeit
+from papers.models import Citation
+from papers.citation_codec import encode_citation, decode_citation, CITATION_FIELDS
+
+class Command(BaseCommand):
+    help = 'Times encoding and decoding of a search result citation with the old and new wire formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--abstract-size', type=int, default=5000,
+                            help='Number of characters in the abstract of the test citation')
+        parser.add_argument('--repeat', type=int, default=1000,
+                            help='Number of round trips timed for each format')
+
+    def handle(self, *args, **options):
+        # looks like a citation parsed from pubmed by Citation.parse_pubmedJson
+        citation = Citation(pubmedID=26000000,title='A study of worms',journal='Science',
+                            journalAbbreviated='Science',volume='1',number='2',pages='3-4',doi='10.1000/182',
+                            pubDate={'Year':'2015','Month':'Jan'},keywords=['worms','aging'],
+                            abstract=('worms are cool. ' * options['abstract_size'])[:options['abstract_size']],
+                            authors=[{'first_name':'Michael C','initials':'MC','last_name':'Chiang'}] * 10)
+
+        # old format was str(citation.__dict__), limited to the same fields so both carry the same data
+        legacy_fields = dict((fieldname,getattr(citation,fieldname)) for fieldname in CITATION_FIELDS)
+
+        def legacy_round_trip():
+            ast.literal_eval(str(legacy_fields))
+
+        def codec_round_trip():
+            decode_citation(encode_citation(citation))
+
+        for name,round_trip,size in (('str/literal_eval',legacy_round_trip,len(str(legacy_fields))),
+                                     ('citation_codec',codec_round_trip,len(encode_citation(citation)))):
+            seconds = timeit.timeit(round_trip,number=options['repeat'])
+            self.stdout.write('%-18s %8.1f us per round trip, %d bytes' % (name,1e6*seconds/options['repeat'],size))
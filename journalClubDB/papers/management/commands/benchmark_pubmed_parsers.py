@@ -0,0 +1,118 @@
+# Compares pubmed_xml.iter_pubmed_records with the parsers it replaces: Bio.Medline.parse of medline text
+# (PubmedInterface) and iter_pubmed_xml with Citation.pubmedJson_to_dict (import_pubmed), and reading records back
+# from the shared pubmed cache, which held medline text and now holds PubmedRecord.dumps()
+# Usage: python manage.py benchmark_pubmed_parsers [--articles 10000] [--abstract-size 1500]
+
+from django.core.management.base import BaseCommand
+import io
+import time
+import tracemalloc
+from papers.models import Citation
+from papers.pubmed_import import iter_pubmed_xml
+from papers.pubmed_xml import iter_pubmed_records, PubmedRecord
+
+ARTICLE_XML = '''<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">%(pmid)d</PMID>
+<Article PubModel="Print"><Journal><JournalIssue CitedMedium="Internet"><Volume>347</Volume><Issue>6217</Issue>
+<PubDate><Year>2015</Year><Month>Jan</Month><Day>2</Day></PubDate></JournalIssue><Title>Science</Title>
+<ISOAbbreviation>Science</ISOAbbreviation></Journal><ArticleTitle>A study of worms %(pmid)d</ArticleTitle>
+<Pagination><MedlinePgn>1-2</MedlinePgn></Pagination><ELocationID EIdType="doi" ValidYN="Y">10.1126/science.%(pmid)d</ELocationID>
+<Abstract><AbstractText>%(abstract)s</AbstractText></Abstract><AuthorList CompleteYN="Y">%(authors)s</AuthorList>
+</Article><MedlineJournalInfo><MedlineTA>Science</MedlineTA></MedlineJournalInfo>
+<KeywordList Owner="NOTNLM"><Keyword MajorTopicYN="N">aging</Keyword><Keyword MajorTopicYN="N">worms</Keyword></KeywordList>
+</MedlineCitation></PubmedArticle>
+'''
+
+AUTHOR_XML = '<Author ValidYN="Y"><LastName>Chiang%d</LastName><ForeName>Michael C</ForeName><Initials>MC</Initials></Author>'
+
+ARTICLE_MEDLINE = '''PMID- %(pmid)d
+TI  - A study of worms %(pmid)d
+LID - 10.1126/science.%(pmid)d [doi]
+AB  - %(abstract)s
+%(authors)sTA  - Science
+VI  - 347
+IP  - 6217
+PG  - 1-2
+DP  - 2015 Jan 2
+OT  - aging
+OT  - worms
+SO  - Science. 2015 Jan 2;347(6217):1-2. doi: 10.1126/science.%(pmid)d.
+
+'''
+
+AUTHOR_MEDLINE = 'FAU - Chiang%d, Michael C\nAU  - Chiang%d MC\n'
+
+class Command(BaseCommand):
+    help = 'Times parsing of a large efetch response with the streaming xml parser and the older parsers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=10000,
+                            help='Number of articles in the test response')
+        parser.add_argument('--abstract-size', type=int, default=1500,
+                            help='Number of characters in the abstract of each article')
+        parser.add_argument('--authors', type=int, default=6,
+                            help='Number of authors of each article')
+
+    def handle(self, *args, **options):
+        abstract = ('worms are cool. ' * options['abstract_size'])[:options['abstract_size']]
+        xml_articles,medline_articles = [],[]
+        for pmid in range(1,options['articles']+1):
+            authors = range(options['authors'])
+            xml_articles.append(ARTICLE_XML % {'pmid':pmid,'abstract':abstract,
+                                               'authors':''.join(AUTHOR_XML % i for i in authors)})
+            medline_articles.append(ARTICLE_MEDLINE % {'pmid':pmid,'abstract':abstract,
+                                                       'authors':''.join(AUTHOR_MEDLINE % (i,i) for i in authors)})
+        xml = '<?xml version="1.0" ?>\n<PubmedArticleSet>\n%s</PubmedArticleSet>\n' % ''.join(xml_articles)
+        xml_bytes = xml.encode('utf-8') # as received from pubmed
+        medline = ''.join(medline_articles)
+
+        def parse_xml_records():
+            return iter_pubmed_records(io.BytesIO(xml_bytes))
+
+        def parse_xml_json():
+            citation = Citation()
+            return (citation.pubmedJson_to_dict(article) for article in iter_pubmed_xml(io.BytesIO(xml_bytes)))
+
+        def parse_medline():
+            from Bio import Medline # optional, only installed with biopython
+            return Medline.parse(io.StringIO(medline))
+
+        cached_records = [record.dumps() for record in parse_xml_records()]
+
+        def load_records():
+            return (PubmedRecord.loads(text) for text in cached_records)
+
+        def load_medline():
+            from Bio import Medline
+            return (Medline.read(io.StringIO(text)) for text in medline_articles)
+
+        for name,parse in (('pubmed_xml',parse_xml_records),
+                           ('iter_pubmed_xml+json',parse_xml_json),
+                           ('Bio.Medline',parse_medline),
+                           ('cached PubmedRecord',load_records),
+                           ('cached Bio.Medline',load_medline)):
+            try:
+                seconds,peak,kept = self.measure(parse)
+            except ImportError as e:
+                self.stdout.write('%-22s skipped: %s' % (name,e))
+                continue
+            self.stdout.write('%-22s %8.1f us per article, peak %6.1f MB streaming, %6.1f MB for all records'
+                              % (name,1e6*seconds/options['articles'],peak/2**20,kept/2**20))
+
+    # returns (seconds to parse all records,peak bytes allocated while streaming them,bytes of the list of all records)
+    def measure(self, parse):
+        t0 = time.time()
+        for record in parse():
+            pass
+        seconds = time.time() - t0
+        tracemalloc.start()
+        try:
+            for record in parse():
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            start = tracemalloc.get_traced_memory()[0]
+            records = list(parse())
+            kept = tracemalloc.get_traced_memory()[0] - start
+            del records # referenced until measured
+        finally:
+            tracemalloc.stop()
+        return seconds,peak,kept
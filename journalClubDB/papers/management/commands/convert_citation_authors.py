@@ -0,0 +1,35 @@
+# Converts Citation.authors from python literals to json and fills the formatted author_list columns
+# Safe to run more than once, rows that already have author_list filled in are skipped
+# Usage: python manage.py convert_citation_authors [--chunk-size 500]
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import json
+from papers.models import Citation
+
+class Command(BaseCommand):
+    help = 'Stores Citation.authors as json and precomputes author_list and author_list_truncated'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of citations converted per transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        pks = list(Citation.objects.filter(author_list='').values_list('pk',flat=True))
+        num_converted = 0
+        for i in range(0,len(pks),chunk_size):
+            with transaction.atomic():
+                for citation in Citation.objects.filter(pk__in=pks[i:i+chunk_size]).only('pk','authors'):
+                    try:
+                        authors = citation.get_authors()
+                        author_list = Citation.format_author_list(authors)
+                        author_list_truncated = Citation.format_author_list_truncated(authors)
+                    except (ValueError,SyntaxError,KeyError,TypeError):
+                        self.stderr.write('citation %d: authors could not be parsed, skipped' % citation.pk)
+                        continue
+                    # update() instead of save() so only the author columns are written
+                    Citation.objects.filter(pk=citation.pk).update(authors=json.dumps(authors),author_list=author_list,
+                                                                   author_list_truncated=author_list_truncated)
+                    num_converted += 1
+        self.stdout.write('Converted authors of %d of %d citations' % (num_converted,len(pks)))
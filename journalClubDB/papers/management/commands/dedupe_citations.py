@@ -0,0 +1,88 @@
+# Merges citations that share a pubmed ID or DOI into the oldest one and fills Citation.normalized_doi
+# Run with --merge-only on an existing database before the unique pubmedID/normalized_doi indexes are created
+# (only pk, pubmedID and doi are read), then without it once the normalized_doi column exists
+# Usage: python manage.py dedupe_citations [--merge-only] [--dry-run]
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from papers.models import Citation, Thread, Post, PersonalNote, PaperOfTheWeekInfo
+from papers.thread_cache import bump_thread_version
+
+class Command(BaseCommand):
+    help = 'Merges duplicate citations (same pubmed ID or DOI) and fills Citation.normalized_doi'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--merge-only', action='store_true', default=False,
+                            help='Do not fill normalized_doi (the column does not exist yet)')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report duplicates without merging them')
+
+    def handle(self, *args, **options):
+        rows = list(Citation.objects.order_by('pk').values_list('pk','pubmedID','doi'))
+        dois = dict((pk,Citation.normalize_doi(doi)) for pk,pubmedID,doi in rows)
+
+        # citations sharing an identifier are merged into the first (oldest) citation with that identifier
+        keeper_of = {}
+        first_with = {}
+        for pk,pubmedID,doi in rows:
+            for identifier in (('pmid',pubmedID),('doi',dois[pk])):
+                if identifier[1] is None:
+                    continue
+                if identifier in first_with:
+                    keeper = first_with[identifier]
+                    while keeper in keeper_of: # keeper was itself merged into another citation
+                        keeper = keeper_of[keeper]
+                    if keeper != pk and pk not in keeper_of:
+                        keeper_of[pk] = keeper
+                else:
+                    first_with[identifier] = pk
+
+        for duplicate,keeper in sorted(keeper_of.items()):
+            self.stdout.write('citation %d -> %d' % (duplicate,keeper))
+            if not options['dry_run']:
+                with transaction.atomic():
+                    self.merge(Citation.objects.only('pk').get(pk=duplicate),Citation.objects.only('pk').get(pk=keeper))
+        if len(keeper_of) > 0 and not options['dry_run']:
+            call_command('backfill_activity_stats',stdout=self.stdout)
+
+        if not options['merge_only'] and not options['dry_run']:
+            with transaction.atomic():
+                for pk,pubmedID,doi in rows:
+                    if pk not in keeper_of:
+                        Citation.objects.filter(pk=pk).update(normalized_doi=dois[pk])
+        self.stdout.write('%d duplicate citations %s' % (len(keeper_of),'found' if options['dry_run'] else 'merged'))
+
+    # moves discussions, notes, tags and library entries of duplicate to keeper, then deletes duplicate
+    def merge(self, duplicate, keeper):
+        keeper_threads = dict((thread.order,thread) for thread in Thread.objects.filter(owner=keeper))
+        for thread in Thread.objects.filter(owner=duplicate):
+            keeper_thread = keeper_threads.get(thread.order)
+            if keeper_thread is None:
+                Thread.objects.filter(pk=thread.pk).update(owner=keeper)
+                continue
+            # replies of the duplicate thread are hung under the base node of the keeper thread
+            # Post.path does not include the base node, so paths stay valid
+            base = Post.objects.filter(thread=thread,node_depth=0).first()
+            keeper_base = Post.objects.filter(thread=keeper_thread,node_depth=0).first()
+            if base is not None and keeper_base is not None:
+                Post.objects.filter(mother=base).update(mother=keeper_base)
+                Post.objects.filter(thread=thread).exclude(pk=base.pk).update(thread=keeper_thread)
+            else:
+                Post.objects.filter(thread=thread).update(thread=keeper_thread)
+            thread.delete()
+            bump_thread_version(keeper_thread.pk)
+
+        for note in PersonalNote.objects.filter(citation=duplicate):
+            keeper_note = PersonalNote.objects.filter(citation=keeper,user=note.user_id).first()
+            if keeper_note is None:
+                PersonalNote.objects.filter(pk=note.pk).update(citation=keeper)
+            else:
+                PersonalNote.objects.filter(pk=keeper_note.pk).update(text=keeper_note.text + note.text)
+                note.delete()
+        PaperOfTheWeekInfo.objects.filter(citation=duplicate).update(citation=keeper)
+        for tag in duplicate.tags.all():
+            tag.citations.add(keeper)
+        for userProfile in duplicate.userProfiles.all():
+            userProfile.library.add(keeper)
+        duplicate.delete()
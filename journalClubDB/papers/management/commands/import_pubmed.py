@@ -0,0 +1,45 @@
+# Imports citations in bulk from pubmed efetch xml files, xml2json style json files, or lists of pubmed IDs
+# Citations that are already in the database (same pubmedID) are skipped
+# Usage: python manage.py import_pubmed [--chunk-size 500] [--pmids ids.txt] [file.xml|file.json ...]
+
+from django.core.management.base import BaseCommand, CommandError
+from itertools import chain
+import io
+import time
+from papers.eutils import eutils_client, EFETCH_BATCH_SIZE, EUTILS_MAX_WORKERS
+from papers.pubmed_import import iter_pubmed_file, iter_pubmed_xml, citations_from_articles, bulk_create_citations
+
+# number of pubmed IDs fetched at once, as parallel efetch requests of EFETCH_BATCH_SIZE IDs
+FETCH_GROUP_SIZE = EFETCH_BATCH_SIZE * EUTILS_MAX_WORKERS
+
+class Command(BaseCommand):
+    help = 'Creates citations, their discussion threads and base node posts from pubmed data in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help='pubmed efetch xml (.xml) or xml2json style json (.json) files')
+        parser.add_argument('--pmids', action='append', default=[],
+                            help='File with one pubmed ID per line, fetched from pubmed')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of citations created per transaction')
+
+    def handle(self, *args, **options):
+        if len(options['files']) == 0 and len(options['pmids']) == 0:
+            raise CommandError('Give at least one file or --pmids file')
+        t0 = time.time()
+        articles = chain(chain.from_iterable(iter_pubmed_file(path) for path in options['files']),
+                         chain.from_iterable(self.fetch_pmids(path) for path in options['pmids']))
+        citations,errors = citations_from_articles(articles)
+        for error in errors:
+            self.stderr.write('skipped %s' % error)
+        num_created = bulk_create_citations(citations,options['chunk_size'])
+        self.stdout.write('Created %d of %d citations in %.1f s' % (num_created,len(citations),time.time()-t0))
+
+    # yields json articles of the pubmed IDs listed in path
+    def fetch_pmids(self, path):
+        with open(path) as f:
+            pmids = [line.strip() for line in f if line.strip()]
+        for i in range(0,len(pmids),FETCH_GROUP_SIZE):
+            for text in eutils_client.efetch(pmids[i:i+FETCH_GROUP_SIZE],rettype=None,retmode='xml'):
+                for article in iter_pubmed_xml(io.StringIO(text)):
+                    yield article
@@ -0,0 +1,30 @@
+# Rewrites the CitationFacet rows (journal, year and MeSH headings) of all citations, see facets.py
+# Run after creating the CitationFacet table, or after changing get_citation_facet_values
+# Usage: python manage.py rebuild_facet_index [--chunk-size 500]
+
+from django.core.management.base import BaseCommand
+import time
+from papers.models import Citation, CitationFacet
+from papers.facets import index_citation_facets
+
+class Command(BaseCommand):
+    help = 'Rewrites the journal, year and MeSH facet values of all citations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of citations indexed per transaction')
+
+    def handle(self, *args, **options):
+        t0 = time.time()
+        citations = Citation.objects.only('pk','journal','pubDate','mesh_keywords').order_by('pk')
+        last_pk = 0
+        num_indexed = 0
+        while True:
+            chunk = list(citations.filter(pk__gt=last_pk)[:options['chunk_size']])
+            if len(chunk) == 0:
+                break
+            index_citation_facets(chunk)
+            num_indexed += len(chunk)
+            last_pk = chunk[-1].pk
+        self.stdout.write('Indexed %d citations (%d facet values) in %.1f s'
+                          % (num_indexed,CitationFacet.objects.count(),time.time()-t0))
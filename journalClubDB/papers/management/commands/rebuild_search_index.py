@@ -0,0 +1,34 @@
+# Rebuilds the full-text search index (see citation_search.py) from all citations
+# Run after creating the SearchPosting/SearchDocument tables, or after changing tokenize or FIELD_WEIGHTS
+# Usage: python manage.py rebuild_search_index [--chunk-size 500]
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import time
+from papers.models import Citation, SearchPosting, SearchDocument
+from papers.citation_search import index_citations, INDEXED_FIELDS
+
+class Command(BaseCommand):
+    help = 'Reindexes the title, abstract, keywords, MeSH terms, journal and authors of all citations for search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of citations indexed per transaction')
+
+    def handle(self, *args, **options):
+        t0 = time.time()
+        with transaction.atomic():
+            SearchPosting.objects.all().delete()
+            SearchDocument.objects.all().delete()
+        citations = Citation.objects.only(*INDEXED_FIELDS).order_by('pk')
+        last_pk = 0
+        num_indexed = 0
+        while True:
+            chunk = list(citations.filter(pk__gt=last_pk)[:options['chunk_size']])
+            if len(chunk) == 0:
+                break
+            index_citations(chunk)
+            num_indexed += len(chunk)
+            last_pk = chunk[-1].pk
+        self.stdout.write('Indexed %d citations (%d postings) in %.1f s'
+                          % (num_indexed,SearchPosting.objects.count(),time.time()-t0))
@@ -0,0 +1,37 @@
+# Recomputes the denormalized vote counts on Post from the upvoters/downvoters tables and fixes any drift
+# Usage: python manage.py reconcile_vote_counts [--dry-run]
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from papers.models import Post
+
+class Command(BaseCommand):
+    help = 'Fixes Post.upvote_count, downvote_count and vote_score where they disagree with the vote tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report drifted posts without fixing them')
+
+    def handle(self, *args, **options):
+        post_table = Post._meta.db_table
+        count_sql = 'SELECT COUNT(*) FROM {0} WHERE {0}.post_id = {1}.id'
+        posts = Post.objects.extra(select={
+            'actual_upvotes': count_sql.format(Post.upvoters.through._meta.db_table,post_table),
+            'actual_downvotes': count_sql.format(Post.downvoters.through._meta.db_table,post_table),
+        }).only('pk','upvote_count','downvote_count','vote_score')
+
+        num_drifted = 0
+        with transaction.atomic():
+            for post in posts.select_for_update():
+                actual_score = post.actual_upvotes - post.actual_downvotes
+                if (post.upvote_count,post.downvote_count,post.vote_score) == (post.actual_upvotes,post.actual_downvotes,actual_score):
+                    continue
+                num_drifted += 1
+                self.stdout.write('post %d: %d/%d/%d -> %d/%d/%d' % (post.pk,
+                                  post.upvote_count,post.downvote_count,post.vote_score,
+                                  post.actual_upvotes,post.actual_downvotes,actual_score))
+                if not options['dry_run']:
+                    Post.objects.filter(pk=post.pk).update(upvote_count=post.actual_upvotes,
+                                                           downvote_count=post.actual_downvotes,
+                                                           vote_score=actual_score)
+        self.stdout.write('%d drifted posts %s' % (num_drifted,'found' if options['dry_run'] else 'fixed'))
@@ -1,63 +1,119 @@
 from django.db import models
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.utils import timezone
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 import json
 from bson import json_util
 import ast
+import re
 import datetime
 import pdb # TODO: remove
+from .ranking import RANKING_CHOICES, DEFAULT_RANKING
+from .citation_codec import encode_citation, decode_citation
+
+# e.g., 10.1016/j.cell.2015.01.001, see Citation.normalize_doi
+DOI_PATTERN = re.compile(r'10\.\d{4,9}/\S+')
 
 # This is internal journalclubDB citation data (as opposed to external pubmed citation data)
 class Citation(models.Model):
     def __str__(self):
         return self.title
 
+    # number of posts in all threads, excluding base nodes and deleted posts (see update_activity_stats)
     def num_posts(self):
-        return sum([t.num_posts() for t in self.thread_set.all()])
+        return self.post_count
 
     def time_last_post(self):
-        tMax = None
-        for t in self.thread_set.all():
-            if tMax is None:
-                tMax = t.time_last_post()
-            else:
-                if t.time_last_post() > tMax:
-                    tMax = t.time_last_post()
-        return tMax
+        return self.last_activity
+
+    # authors are stored as a json list of {'first_name','initials','last_name'} dicts
+    # author_list, author_list_truncated and year_published are formatted once in save(), so listings do not
+    # parse authors or pubDate
+    def save(self, *args, **kwargs):
+        self.fill_derived_fields()
+        super(Citation, self).save(*args, **kwargs)
+
+    # fills author_list, author_list_truncated, year_published and normalized_doi
+    # called by save(). Call it yourself before bulk_create
+    def fill_derived_fields(self):
+        self.normalized_doi = Citation.normalize_doi(self.doi)
+        authors = self.get_authors()
+        self.authors = json.dumps(authors)
+        self.author_list = Citation.format_author_list(authors)
+        self.author_list_truncated = Citation.format_author_list_truncated(authors)
+        self.year_published = Citation.format_year_published(self.eval('pubDate'))
+
+    # returns list of author dicts. authors is a list for citations parsed from pubmed, a json string for
+    # saved citations, or a python literal for rows not yet converted by convert_citation_authors
+    # any other string (e.g., typed in by hand) is kept as the last name of a single author
+    def get_authors(self):
+        return self.get_decoded('authors',Citation.decode_authors)
+
+    @staticmethod
+    def decode_authors(authors):
+        if not authors:
+            return []
+        if isinstance(authors,str):
+            try:
+                decoded = json.loads(authors)
+            except (ValueError,RecursionError):
+                decoded = Citation.decode_literal(authors)
+            if not isinstance(decoded,list) or not all(isinstance(author,dict) for author in decoded):
+                return [{'first_name':'','initials':'','last_name':authors}]
+            authors = decoded
+        return list(authors)
 
     def get_author_list_truncated(self):
-        authors = self.eval('authors')
+        if self.author_list_truncated:
+            return self.author_list_truncated
+        return Citation.format_author_list_truncated(self.get_authors()) # citation has not been saved
+
+    def get_author_list(self):
+        if self.author_list:
+            return self.author_list
+        return Citation.format_author_list(self.get_authors()) # citation has not been saved
+
+    # e.g., 'MC Chiang' or 'Chiang et al'
+    @staticmethod
+    def format_author_list_truncated(authors):
+        if len(authors) == 0:
+            return ''
         if len(authors) is 1: # case where there is only one author
             author = authors[0]
-            return author['initials'] + ' ' + author['last_name']
+            return (author['initials'] + ' ' + author['last_name']).strip()
         else:   # case where there are multiple authors
             return authors[0]['last_name'] + ' et al'
-    def get_author_list(self):
-        authors = self.eval('authors')
+
+    # e.g., 'Michael C. Chiang, John Smith, and Jane Doe.'
+    @staticmethod
+    def format_author_list(authors):
+        if len(authors) == 0:
+            return ''
         if len(authors) is 1: # case where there is only one author
-            author = authors[0]
-            if author['first_name'][-2] == ' ':
-                full_name = author['first_name'] + '. ' + author['last_name']
-            else:
-                full_name = author['first_name'] + ' ' + author['last_name']
-            return full_name
-        else:   # case where there are multiple authors TODO: implement this
+            return Citation.format_author_name(authors[0])
+        else:   # case where there are multiple authors
             rn = ''
             for author in authors[:-1]:
-                if author['first_name'][-2] == ' ':
-                    rn += author['first_name'] + '. ' + author['last_name']
-                else:
-                    rn += author['first_name'] + ' ' + author['last_name']
+                rn += Citation.format_author_name(author)
                 rn += ", "
             # last name is special case
             rn += "and "
-            author = authors[-1]
-            if author['first_name'][-2] == ' ':
-                rn += author['first_name'] + '. ' + author['last_name']
-            else:
-                rn += author['first_name'] + ' ' + author['last_name']
+            rn += Citation.format_author_name(authors[-1])
             rn += '.'
             return rn
 
+    @staticmethod
+    def format_author_name(author):
+        if author['first_name'] == '':
+            return author['last_name']
+        if author['first_name'][-2:-1] == ' ': # first name ends with a middle initial
+            return author['first_name'] + '. ' + author['last_name']
+        else:
+            return author['first_name'] + ' ' + author['last_name']
+
     def filled_field(self,fieldname):
         if not getattr(self,fieldname): # check if NoneType
             return False
@@ -65,16 +121,47 @@ class Citation(models.Model):
             return False
         return True
 
-    # Returns -1 if no preexisting Citation object with matching pubmed ID
+    # Returns -1 if no preexisting Citation object with matching pubmed ID or DOI
     # Returns pk of preexisting object otherwise
+    # search results are annotated in bulk by citation_lookup.annotate_existing_citations
     def preExistingEntryExists(self):
-        my_pk = self.eval('pubmedID')
-        try:
-            citation = Citation.objects.get(pubmedID=my_pk)
-        except:
+        if 'existing_pk' in self.__dict__:
+            return self.existing_pk
+        pk = self.get_existing_pk()
+        if pk is None:
             return -1
-        else:
-            return citation.pk
+        return pk
+
+    # returns pk of the saved citation with the same pubmed ID or DOI, or None (single indexed query)
+    def get_existing_pk(self):
+        identifiers = Q()
+        pubmedID = self.eval('pubmedID')
+        if pubmedID is not None and pubmedID != '':
+            identifiers |= Q(pubmedID=int(pubmedID))
+        doi = Citation.normalize_doi(self.doi)
+        if doi is not None:
+            identifiers |= Q(normalized_doi=doi)
+        if not identifiers:
+            return None
+        return Citation.objects.filter(identifiers).values_list('pk',flat=True).first()
+
+    # returns the doi found in ELocationID (a string, a list of strings, or a literal of either) lowercased and
+    # without prefixes (e.g., 'doi: 10.1016/J.CELL.2015.01.001' -> '10.1016/j.cell.2015.01.001'), or None
+    @staticmethod
+    def normalize_doi(doi):
+        if not doi:
+            return None
+        if isinstance(doi,str):
+            doi = Citation.decode_literal(doi)
+        if isinstance(doi,dict):
+            doi = list(doi.values())
+        if not isinstance(doi,list):
+            doi = [doi]
+        for value in doi:
+            match = DOI_PATTERN.search(str(value))
+            if match:
+                return match.group(0).rstrip('.').lower()
+        return None
 
     def get_source(self):
         source = "<i>" + self.journal +"</i>"
@@ -90,38 +177,60 @@ class Citation(models.Model):
     def get_journal(self):
         return self.journal
     def get_year_published(self):
-        date_dict = self.eval('pubDate')
-        try:
-            year = date_dict['Year']
-        except:
-             year = date_dict['MedlineDate']
-        return year
+        if self.year_published:
+            return self.year_published
+        return Citation.format_year_published(self.eval('pubDate')) # citation has not been saved
+
+    # e.g., '2015', or '2014 Dec-2015 Jan' for pubDates without a year. '' if pubDate is not a date dict
+    @staticmethod
+    def format_year_published(date_dict):
+        if not isinstance(date_dict,dict):
+            return ''
+        return str(date_dict.get('Year') or date_dict.get('MedlineDate') or '')
+    # see citation_codec.py. deserialize raises CitationCodecError if the string is malformed or tampered with
     def serialize(self):
-        d = self.__dict__
-        d.pop("_state", None)
-        return str(d)
+        return encode_citation(self)
     def deserialize(self,str):
-        d = ast.literal_eval(str)
+        d = decode_citation(str)
         for key in d.keys():
-            if key == 'id' or key == 'pk' or key == '_state':
-                continue
             setattr(self,key,d[key])
+    # returns field decoded as a python literal (e.g., pubDate dict), or the field itself if it is not a literal
     def eval(self,fieldname):
-        try:
-            rn = ast.literal_eval(getattr(self,fieldname))
-        except:
-            rn = getattr(self,fieldname)
-        return rn
+        return self.get_decoded(fieldname,Citation.decode_literal)
 
+    @staticmethod
+    def decode_literal(value):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError,SyntaxError,TypeError,MemoryError,RecursionError):
+            return value
+
+    # returns decode(value of field), decoding each field once per instance
+    # decoded values are shared between callers, so do not modify them
+    def get_decoded(self,fieldname,decode):
+        decoded_fields = self.__dict__.setdefault('_decoded_fields',{})
+        decoded_field = decoded_fields.setdefault(fieldname,{})
+        if decode not in decoded_field:
+            decoded_field[decode] = decode(getattr(self,fieldname))
+        return decoded_field[decode]
+
+    # assigning to a field (including from refresh_from_db and deserialize) drops its decoded values
+    def __setattr__(self,name,value):
+        decoded_fields = self.__dict__.get('_decoded_fields')
+        if decoded_fields:
+            decoded_fields.pop(name,None)
+        super(Citation, self).__setattr__(name,value)
+
+    # (title, description, order) of the discussion threads every citation gets
+    default_threads = (("Explain Like I'm Five","Easy to understand summary of the paper",1),
+                       ("Methodology","Description of innovative methodologies",2),
+                       ("Results","Description of main results of the paper",3),
+                       ("Historical Context","How does the paper fit into the pre-existing literature",4))
+
+    # see also pubmed_import.bulk_create_citations, which does the same for many citations at once
     def create_associated_threads_posts(self):
         # TODO: add error checking to make sure not already created
-        thread_titles = ["Explain Like I'm Five","Methodology","Results","Historical Context"]
-        thread_descriptions = ["Easy to understand summary of the paper",
-                               "Description of innovative methodologies",
-                               "Description of main results of the paper",
-                               "How does the paper fit into the pre-existing literature"]
-        ordering = [1,2,3,4]
-        for title,description,order in zip(thread_titles,thread_descriptions,ordering):
+        for title,description,order in Citation.default_threads:
             thread = Thread()
             setattr(thread,'owner',self)
             setattr(thread,'title',title)
@@ -133,18 +242,26 @@ class Citation(models.Model):
                         isReplyToPost=False,text="",node_depth=0)
             post.save()
 
-    # saves object if it does not already exist in database (based on pubmed ID)
+    # saves object if it does not already exist in database (based on pubmed ID or DOI)
     # also creates associated threads and posts
     # returns pk of self, or of matching db entry
+    # safe to call from concurrent requests: pubmedID and normalized_doi are unique, so if another request
+    # saves the same citation first, the insert fails and the other request's citation is returned
     def save_if_unique(self):
+        pk = self.get_existing_pk()
+        if pk is not None:
+            return pk
         try:
-            citation = Citation.objects.get(pubmedID=self.pubmedID)
-        except: # does not exist in database
-            self.save()
-            self.create_associated_threads_posts()
-            return self.pk
-        else:
-            return citation.pk
+            with transaction.atomic():
+                self.save()
+                self.create_associated_threads_posts()
+        except IntegrityError:
+            self.pk = None
+            pk = self.get_existing_pk()
+            if pk is None: # failed for some other reason
+                raise
+            return pk
+        return self.pk
 
 
     # parses a json string from pubmed into self
@@ -237,7 +354,10 @@ class Citation(models.Model):
         return parsed_data
 
     title = models.TextField(blank=True,null=True)
-    authors = models.TextField(blank=True,null=True)
+    authors = models.TextField(blank=True,null=True) # json, see get_authors
+    author_list = models.TextField(blank=True,default='') # formatted in save()
+    author_list_truncated = models.TextField(blank=True,default='') # formatted in save()
+    year_published = models.TextField(blank=True,default='') # formatted in save()
     journal = models.TextField(blank=True,null=True)
     journalAbbreviated = models.TextField(blank=True,null=True)
     volume = models.TextField(blank=True,null=True)
@@ -248,8 +368,16 @@ class Citation(models.Model):
     mesh_keywords = models.TextField(blank=True,null=True)
     abstract = models.TextField(blank=True,null=True)
     doi = models.TextField(blank=True,null=True)
-    pubmedID = models.PositiveIntegerField(blank=True,null=True)
+    pubmedID = models.PositiveIntegerField(blank=True,null=True,unique=True)
+    normalized_doi = models.CharField(max_length=255,blank=True,null=True,unique=True) # see normalize_doi
     link = models.TextField(blank=True,null=True) # link to pdf
+    # denormalized from posts of all threads by update_activity_stats, see backfill_activity_stats
+    post_count = models.PositiveIntegerField(default=0)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # keyset pagination of the index page, see catalog.py
+        index_together = [('last_activity','id'),('post_count','id')]
 
 # Discussion thread for a particular citation
 # Possible categories: ELI5, Methodology, Results, Discussion, Historical context
@@ -257,23 +385,22 @@ class Thread(models.Model):
     def __str__(self):
         return str(self.owner) + ' - ' + self.title
 
+    # number of posts, excluding the base node and deleted posts (see update_activity_stats)
     def num_posts(self):
-        return self.post_set.count()
+        return self.post_count
 
     def time_last_post(self):
-        tMax = None
-        for p in self.post_set.all():
-            if tMax is None:
-                tMax = p.time_created
-            else:
-                if p.time_created > tMax:
-                    tMax = p.time_created
-        return tMax
+        return self.last_activity
 
     owner = models.ForeignKey(Citation)
     title = models.TextField(blank=True)
     description = models.TextField(blank=True)
     order = models.PositiveIntegerField()
+    version = models.PositiveIntegerField(default=0) # incremented whenever posts change, see thread_cache.py
+    ranking = models.CharField(max_length=20,choices=RANKING_CHOICES,default=DEFAULT_RANKING) # how replies are sorted, see ranking.py
+    # denormalized from posts by update_activity_stats, see backfill_activity_stats
+    post_count = models.PositiveIntegerField(default=0)
+    last_activity = models.DateTimeField(default=timezone.now)
 
 class PersonalNote(models.Model):
     def __str__(self):
@@ -302,18 +429,80 @@ class PersonalNote(models.Model):
 
 class Post(models.Model):
     def __str__(self):
-        return self.text
+        return self.current_text
     time_created = models.DateTimeField(auto_now_add=True)
     creator = models.ForeignKey(User, blank=True, null=True)
     thread = models.ForeignKey(Thread)
     isReplyToPost = models.BooleanField()   # TODO: This may be unnecessary
     mother = models.ForeignKey('self', blank=True, null=True)
-    text = models.TextField() # json serialized
+    text = models.TextField() # legacy json serialized edit history, moved to PostRevision by backfill_post_revisions
+    # most recent revision of the post. Older revisions are stored in PostRevision and only loaded to show the edit history
+    current_text = models.TextField(blank=True, default='')
+    current_editor = models.ForeignKey(User, blank=True, null=True, related_name='+')
+    current_time = models.DateTimeField(blank=True, null=True)
     node_depth = models.PositiveIntegerField() # base node posts have a node depth of 0
     deleted = models.BooleanField(default=False)
     # to access upvoted posts from User instance, user.upvoted.all()
     upvoters   = models.ManyToManyField(User, blank=True, related_name="upvoted")
     downvoters = models.ManyToManyField(User, blank=True, related_name="downvoted")
+    # materialized path: pks of all ancestors below the base node, oldest first, e.g. '0000000012/0000000034/'
+    # base node and depth 1 posts have an empty path. Filled in on first save
+    path = models.TextField(blank=True, default='', db_index=True)
+    # denormalized vote counts, kept in sync with upvoters/downvoters by update_vote_counts (see below)
+    upvote_count = models.IntegerField(default=0)
+    downvote_count = models.IntegerField(default=0)
+    vote_score = models.IntegerField(default=0) # upvote_count - downvote_count
+
+    vote_count_fields = ('upvote_count','downvote_count','vote_score')
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            if self.mother_id is not None and self.path == '':
+                self.path = self.path_for_child_of(self.mother)
+        elif not kwargs.get('update_fields') and not kwargs.get('force_insert'):
+            # vote counts are only ever written with F() expressions, never from a possibly stale instance
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in Post.vote_count_fields]
+        super(Post, self).save(*args, **kwargs)
+        # revisions added with add_post before the post had a pk
+        for revision in self.__dict__.pop('_unsaved_revisions',[]):
+            revision.post = self
+            revision.save()
+
+    # path segment used for post pk in materialized paths. Fixed width so that paths sort by ancestry
+    @staticmethod
+    def path_segment(pk):
+        return '%010d/' % pk
+
+    @staticmethod
+    def path_for_child_of(mother):
+        if mother.node_depth == 0:
+            return ''
+        return mother.path + Post.path_segment(mother.pk)
+
+    # pks of ancestors below the base node, oldest first
+    def get_ancestor_pks(self):
+        return [int(segment) for segment in self.path.split('/') if segment != '']
+
+    # returns list of ancestors below the base node, oldest first (single query)
+    def get_ancestors(self):
+        ancestors = Post.objects.in_bulk(self.get_ancestor_pks())
+        return [ancestors[pk] for pk in self.get_ancestor_pks() if pk in ancestors]
+
+    # returns queryset of all replies below this post (not including this post)
+    def get_replies(self):
+        if self.node_depth == 0:
+            return Post.objects.filter(thread=self.thread_id).exclude(pk=self.pk)
+        return Post.objects.filter(path__startswith=self.path + Post.path_segment(self.pk))
+
+    # returns queryset of this post and all replies below it
+    def get_subtree(self):
+        if self.node_depth == 0:
+            return Post.objects.filter(thread=self.thread_id)
+        return Post.objects.filter(models.Q(pk=self.pk) | models.Q(path__startswith=self.path + Post.path_segment(self.pk)))
+
+    def num_replies(self):
+        return self.get_replies().count()
 
     # score is a measure of post quality
     # TODO: Make score based on user quality, i.e., professors have more weight
@@ -321,13 +510,28 @@ class Post(models.Model):
         if self.deleted:
             return -999999
         else:
-            return len(self.upvoters.all()) - len(self.downvoters.all())
+            return self.vote_score
+
+    # hides the post (its text and replies are kept) and removes it from thread and citation post counts
+    # returns False if the post was already deleted
+    def mark_deleted(self):
+        if Post.objects.filter(pk=self.pk,deleted=False).update(deleted=True) == 0:
+            return False
+        self.deleted = True
+        update_activity_stats(self,-1)
+        return True
 
+    # adds a new revision of the post text. Call save() afterwards to store the current text
     def add_post(self,text,editor_pk,date_added,editor_name):
-        text_tuple_vector = self.get_undecoded_textTupleVector()
-        t = (text,editor_pk,date_added,editor_name)
-        text_tuple_vector.append(t)
-        self.text = json.dumps(text_tuple_vector, default=json_util.default)
+        self.current_text = text
+        self.current_editor_id = editor_pk
+        self.current_time = date_added
+        revision = PostRevision(text=text,editor_id=editor_pk,editor_name=editor_name,time_created=date_added)
+        if self.pk is None: # revision is stored when the post is first saved
+            self.__dict__.setdefault('_unsaved_revisions',[]).append(revision)
+        else:
+            revision.post = self
+            revision.save()
 
     def notify_mother_author(self):
         # get mother post
@@ -351,6 +555,11 @@ class Post(models.Model):
         mother_user_profile.save()
         return
 
+    # returns edit history, oldest first.  Not used to display threads, which only need current_text
+    def get_revisions(self):
+        return self.revisions.order_by('time_created','pk')
+
+    # decodes the legacy json edit history in self.text. Only used by backfill_post_revisions
     # v[i] = (text , editor/creator.pk , date)
     def get_undecoded_textTupleVector(self):
         if self.text == '':
@@ -370,11 +579,148 @@ class Post(models.Model):
             rn = []
         return rn
 
+# Keeps Post.upvote_count, downvote_count and vote_score in sync with the upvoters/downvoters tables.
+# Django sends m2m_changed inside the transaction of the m2m change, so counts and votes commit together.
+# Works from both sides, e.g., post.upvoters.add(user) and user.upvoted.add(post)
+@receiver(m2m_changed, sender=Post.upvoters.through)
+@receiver(m2m_changed, sender=Post.downvoters.through)
+def update_vote_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_remove','pre_clear'):
+        # remove/clear do not report which votes actually existed, so look them up before they are deleted
+        votes = sender.objects.all()
+        if reverse: # instance is a User, pk_set holds post pks
+            votes = votes.filter(user_id=instance.pk)
+        else:       # instance is a Post, pk_set holds user pks
+            votes = votes.filter(post_id=instance.pk)
+        if action == 'pre_remove':
+            votes = votes.filter(**{('post_id__in' if reverse else 'user_id__in'): pk_set})
+        instance._removed_vote_post_pks = list(votes.values_list('post_id',flat=True))
+        return
+    elif action == 'post_add':
+        if reverse:
+            post_pks = list(pk_set)
+        else:
+            post_pks = [instance.pk] * len(pk_set)
+        sign = 1
+    elif action in ('post_remove','post_clear'):
+        post_pks = instance.__dict__.pop('_removed_vote_post_pks',[])
+        sign = -1
+    else:
+        return
+
+    if sender is Post.upvoters.through:
+        count_field,score_sign = 'upvote_count',1
+    else:
+        count_field,score_sign = 'downvote_count',-1
+    # group posts by number of votes changed so that each group is a single UPDATE
+    deltas = {}
+    for post_pk in post_pks:
+        deltas[post_pk] = deltas.get(post_pk,0) + 1
+    groups = {}
+    for post_pk,n in deltas.items():
+        groups.setdefault(n,[]).append(post_pk)
+    for n,group in groups.items():
+        Post.objects.filter(pk__in=group).update(**{count_field: F(count_field) + sign*n,
+                                                    'vote_score': F('vote_score') + score_sign*sign*n})
+    # keep the post instance that was changed in sync as well
+    if not reverse and instance.pk in deltas:
+        n = deltas[instance.pk]
+        setattr(instance,count_field,getattr(instance,count_field) + sign*n)
+        instance.vote_score += score_sign*sign*n
+
+# keeps post_count and last_activity of threads and citations up to date when posts are created or deleted
+# base nodes are not counted (they are created with the citation and never shown), but their creation counts
+# as activity.  Posts created with bulk_create bypass this, run backfill_activity_stats afterwards
+def update_activity_stats(post, delta, time=None):
+    fields = {'post_count': F('post_count') + delta}
+    if time is not None:
+        fields['last_activity'] = time
+    Thread.objects.filter(pk=post.thread_id).update(**fields)
+    Citation.objects.filter(thread=post.thread_id).update(**fields)
+
+@receiver(post_save, sender=Post)
+def update_activity_on_create(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        update_activity_stats(instance, 1 if instance.node_depth > 0 else 0, instance.time_created)
+
+@receiver(post_delete, sender=Post)
+def update_activity_on_delete(sender, instance, **kwargs):
+    if instance.node_depth > 0 and not instance.deleted:
+        update_activity_stats(instance, -1)
+
+# A single version of the text of a post. v1 is the original post, later revisions are edits
+class PostRevision(models.Model):
+    def __str__(self):
+        return self.text
+    post = models.ForeignKey(Post, related_name="revisions")
+    text = models.TextField(blank=True)
+    editor = models.ForeignKey(User, blank=True, null=True)
+    editor_name = models.TextField(blank=True)
+    time_created = models.DateTimeField()
+
 class Tag(models.Model): # use http://jquery-plugins.net/bootstrap-tags-input
     def __str__(self):
         return self.name
     name = models.TextField()
+    key = models.CharField(max_length=255,blank=True,null=True,unique=True) # normalized name, see normalize_key
     citations  = models.ManyToManyField(Citation, blank=True, related_name="tags")  # to access tags from Citation instance, citation.tags.all()
+    citation_count = models.PositiveIntegerField(default=0) # kept in sync with citations by update_tag_counts
+
+    def save(self, *args, **kwargs):
+        self.key = Tag.normalize_key(self.name)
+        super(Tag, self).save(*args, **kwargs)
+
+    # e.g., '  Cell  Biology ' -> 'cell biology'. Tags with the same key are the same tag
+    @staticmethod
+    def normalize_key(name):
+        return ' '.join(name.lower().split())[:255]
+
+    # returns the tag with the key of name, creating it if needed. Safe to call from concurrent requests
+    @staticmethod
+    def get_or_create_by_name(name):
+        key = Tag.normalize_key(name)
+        tag = Tag.objects.filter(key=key).first()
+        if tag is not None:
+            return tag
+        try:
+            with transaction.atomic():
+                tag = Tag(name=' '.join(name.split()))
+                tag.save()
+        except IntegrityError: # created by another request since the lookup
+            tag = Tag.objects.get(key=key)
+        return tag
+
+# Keeps Tag.citation_count in sync with the tag/citation table, from both sides (tag.citations, citation.tags)
+@receiver(m2m_changed, sender=Tag.citations.through)
+def update_tag_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_remove','pre_clear'):
+        # remove/clear do not report which rows actually existed, so look them up before they are deleted
+        if reverse: # instance is a Citation, pk_set holds tag pks
+            rows = sender.objects.filter(citation_id=instance.pk)
+        else:       # instance is a Tag, pk_set holds citation pks
+            rows = sender.objects.filter(tag_id=instance.pk)
+        if action == 'pre_remove':
+            rows = rows.filter(**{('tag_id__in' if reverse else 'citation_id__in'): pk_set})
+        instance._removed_tag_pks = list(rows.values_list('tag_id',flat=True))
+        return
+    elif action == 'post_add': # pk_set only holds rows that were actually added
+        tag_pks = list(pk_set) if reverse else [instance.pk] * len(pk_set)
+        sign = 1
+    elif action in ('post_remove','post_clear'):
+        tag_pks = instance.__dict__.pop('_removed_tag_pks',[])
+        sign = -1
+    else:
+        return
+    deltas = {}
+    for tag_pk in tag_pks:
+        deltas[tag_pk] = deltas.get(tag_pk,0) + sign
+    for tag_pk,delta in deltas.items():
+        Tag.objects.filter(pk=tag_pk).update(citation_count=F('citation_count') + delta)
+
+# deleting a citation deletes its tag rows without sending m2m_changed
+@receiver(pre_delete, sender=Citation)
+def update_tag_counts_on_delete(sender, instance, **kwargs):
+    Tag.objects.filter(citations=instance.pk).update(citation_count=F('citation_count') - 1)
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User)
@@ -409,3 +755,38 @@ class PaperOfTheWeekInfo(models.Model):
     citation = models.ForeignKey(Citation)
     paperOfTheWeek = models.ForeignKey(PaperOfTheWeek)
     order = models.FloatField()
+
+# Inverted index of citation text for full-text search, see citation_search.py
+# One posting per (term, citation) with the field-weighted number of occurrences of the term in the citation
+class SearchPosting(models.Model):
+    term = models.CharField(max_length=64)
+    citation = models.ForeignKey(Citation, related_name="search_postings")
+    frequency = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('term','citation') # also the index used to look up the postings of a term
+
+# field-weighted number of terms of an indexed citation (BM25 document length)
+class SearchDocument(models.Model):
+    citation = models.OneToOneField(Citation, primary_key=True, related_name="search_document")
+    length = models.PositiveIntegerField()
+
+# journal, year and MeSH headings of a citation, used to browse citations by facet, see facets.py
+# tags are read from the tag/citation table
+class CitationFacet(models.Model):
+    citation = models.ForeignKey(Citation, related_name="facets")
+    facet = models.CharField(max_length=20)
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('facet','value','citation')
+
+# keeps the search and facet indexes up to date when citations are saved. Deleted citations lose their rows by
+# cascade. Citations created with bulk_create are indexed by pubmed_import.bulk_create_citations
+@receiver(post_save, sender=Citation)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        from .citation_search import index_citations # both import this module
+        from .facets import index_citation_facets
+        index_citations([instance])
+        index_citation_facets([instance])
@@ -0,0 +1,180 @@
+# Builds ordered discussion threads (trees of Post objects) in memory
+# Example usage:
+# from papers.post_tree import get_thread_posts, iter_greedy_thread_events
+# posts = get_thread_posts(thread.pk)              # 1 query, regardless of thread size
+# events = iter_greedy_thread_events(posts)        # 0 queries
+# for event in events: ...                         # event.kind is 'open', 'post' or 'close'
+
+from collections import namedtuple
+from itertools import chain
+from django.db.models import Q
+from django.utils import timezone
+import calendar
+import datetime
+from .models import Post
+from .ranking import rank_posts, DEFAULT_RANKING
+
+# returns a list of every post in a thread, loaded with a single query
+# creator and thread/citation are joined in because post templates display them
+def get_thread_posts(thread_pk):
+    return list(select_post_related(Post.objects.filter(thread=thread_pk)))
+
+def select_post_related(queryset):
+    return queryset.select_related('creator','thread__owner')
+
+# children_map[pk] gives the children of post pk, in no particular order
+def get_children_map(post_list):
+    children_map = {}
+    for post in post_list:
+        children_map.setdefault(post.mother_id,[]).append(post)
+    return children_map
+
+# A single step of a depth-first walk over a post tree. kind is one of:
+# 'open'  - a subtree starts (template opens a box)
+# 'post'  - the post at the top of the subtree
+# 'close' - the subtree ends (template closes the box)
+TreeEvent = namedtuple('TreeEvent', ['kind','depth','post'])
+
+# yields open/post/close TreeEvents for a tree of posts, without recursion (deep threads are fine)
+# Ordering is greedy: children are sorted by score, ties are broken by most recent post first
+# Input post_list should constitute a full tree (or a chain of posts) whose topmost post is the root
+# With include_root=False, events of the root itself are skipped (used to hide the dummy base node)
+# post_list is not queried again (scores are read from Post.vote_score), so load it with get_thread_posts
+# scores, e.g. from ranking.rank_posts, replaces Post.score() as the sort key: {post pk: score}
+def iter_greedy_thread_events(post_list, include_root=True, scores=None):
+    post_list = list(post_list)
+    if len(post_list) == 0:
+        return
+    children_map = get_children_map(post_list)
+    root = min(post_list, key=lambda post: post.node_depth)
+
+    # stack holds posts whose subtree has yet to be opened, and close events of open subtrees
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if type(item) is TreeEvent:
+            yield item
+            continue
+        post = item
+        is_hidden = post is root and not include_root
+        if not is_hidden:
+            yield TreeEvent('open',post.node_depth,None)
+            yield TreeEvent('post',post.node_depth,post)
+            stack.append(TreeEvent('close',post.node_depth,None))
+        if scores is None:
+            children = sorted(children_map.get(post.pk,[]), key=lambda child: (child.score(),child.pk))
+        else:
+            children = sorted(children_map.get(post.pk,[]), key=lambda child: (scores[child.pk],child.pk))
+        stack.extend(children) # highest score ends up on top of the stack, so it is opened first
+
+def order_greedy_post_list_with_indents(post_list, include_root=True, scores=None):
+    return list(iter_greedy_thread_events(post_list, include_root, scores))
+
+# Threads are paginated by depth 1 post. Like iter_greedy_thread_events, pages put deleted posts last
+# and sort the rest by score and pk, highest first.  A cursor is the
+# (deleted, score, pk) of the last depth 1 post on the previous page, serialized as e.g. '0:12:345'
+# score is Post.vote_score, or the score given by the ranking strategy the thread is shown with.
+# Cursors of ranked pages also hold the time the scores were computed at, in microseconds since the epoch,
+# e.g., '0:0.25:345:1443657600000000', so that later pages rank with the same time as the first one
+def encode_thread_cursor(post, score=None, ranked_at=None):
+    if score is None:
+        score = post.vote_score
+    cursor = '%d:%r:%d' % (post.deleted,score,post.pk)
+    if ranked_at is not None:
+        cursor += ':%d' % (calendar.timegm(ranked_at.utctimetuple()) * 10**6 + ranked_at.microsecond)
+    return cursor
+
+# returns (deleted,score,pk,microseconds since the epoch of the ranking time or None)
+# raises ValueError for malformed cursors
+def decode_thread_cursor(cursor):
+    values = cursor.split(':')
+    if len(values) not in (3,4):
+        raise ValueError('malformed thread cursor %r' % cursor)
+    ranked_at = int(values[3]) if len(values) == 4 else None
+    if ranked_at is not None:
+        get_cursor_time(ranked_at) # out of range times are malformed too
+    return bool(int(values[0])),float(values[1]),int(values[2]),ranked_at
+
+def get_cursor_time(microseconds):
+    try:
+        return datetime.datetime(1970,1,1,tzinfo=timezone.utc) + datetime.timedelta(microseconds=microseconds)
+    except OverflowError:
+        raise ValueError('cursor time %d is out of range' % microseconds)
+
+# returns (events,cursor of next page or None) for one page of depth 1 subtrees of a thread
+# Two queries: one for the page of depth 1 posts, one for all replies below them (through Post.path)
+# ranking is one of ranking.RANKERS, strategies other than raw score are paged by get_ranked_thread_page
+# now is the time first pages of ranked threads are ranked at, defaults to the current time
+def get_thread_page(thread_pk, after=None, page_size=20, ranking=DEFAULT_RANKING, now=None):
+    if ranking != 'raw':
+        return get_ranked_thread_page(thread_pk, after, page_size, ranking, now)
+    depth1_posts = Post.objects.filter(thread=thread_pk,node_depth=1)
+    if after is not None:
+        deleted,vote_score,pk,dummy = decode_thread_cursor(after)
+        depth1_posts = depth1_posts.filter(Q(deleted__gt=deleted) |
+                                           Q(deleted=deleted,vote_score__lt=vote_score) |
+                                           Q(deleted=deleted,vote_score=vote_score,pk__lt=pk))
+    depth1_posts = depth1_posts.order_by('deleted','-vote_score','-pk')
+    depth1_posts = list(select_post_related(depth1_posts)[:page_size+1])
+    next_cursor = None
+    if len(depth1_posts) > page_size:
+        depth1_posts = depth1_posts[:page_size]
+        next_cursor = encode_thread_cursor(depth1_posts[-1])
+    if len(depth1_posts) == 0:
+        return iter([]),None
+
+    subtree_filter = Q()
+    for post in depth1_posts:
+        subtree_filter |= Q(path__startswith=Post.path_segment(post.pk))
+    replies_by_subtree = {}
+    for reply in select_post_related(Post.objects.filter(subtree_filter,thread=thread_pk)):
+        replies_by_subtree.setdefault(reply.get_ancestor_pks()[0],[]).append(reply)
+
+    events = chain.from_iterable(iter_greedy_thread_events([post] + replies_by_subtree.get(post.pk,[]))
+                                 for post in depth1_posts)
+    return events,next_cursor
+
+# same as get_thread_page, for rankings that are not stored in the database (scores depend on subtrees or
+# on time), so the whole thread is loaded and ranked in memory.  One query
+# later pages are ranked at the time of the first page (kept in the cursor), so scores that decay with time
+# (hot) do not move posts across pages
+def get_ranked_thread_page(thread_pk, after, page_size, ranking, now=None):
+    if after is not None:
+        deleted,score,pk,ranked_at = decode_thread_cursor(after)
+        if ranked_at is not None:
+            now = get_cursor_time(ranked_at)
+    if now is None:
+        now = timezone.now()
+    posts = get_thread_posts(thread_pk)
+    scores = rank_posts(posts, ranking, now)
+    depth1_posts = [post for post in posts if post.node_depth == 1]
+    depth1_posts.sort(key=lambda post: (scores[post.pk],post.pk), reverse=True)
+    if after is not None:
+        depth1_posts = [post for post in depth1_posts if (scores[post.pk],post.pk) < (score,pk)]
+    next_cursor = None
+    if len(depth1_posts) > page_size:
+        depth1_posts = depth1_posts[:page_size]
+        next_cursor = encode_thread_cursor(depth1_posts[-1],scores[depth1_posts[-1].pk],now)
+
+    page_pks = set(post.pk for post in depth1_posts)
+    replies_by_subtree = {}
+    for post in posts:
+        if post.node_depth > 1 and post.get_ancestor_pks()[0] in page_pks:
+            replies_by_subtree.setdefault(post.get_ancestor_pks()[0],[]).append(post)
+
+    events = chain.from_iterable(iter_greedy_thread_events([post] + replies_by_subtree.get(post.pk,[]), scores=scores)
+                                 for post in depth1_posts)
+    return events,next_cursor
+
+# returns {'up': set of post pks, 'down': set of post pks} that user voted on, among posts matching post_filter
+# e.g., get_viewer_votes(request.user, thread__in=threads).  One query per vote direction
+# returns None for anonymous users.  Used by the post_vote_state template tag
+def get_viewer_votes(user, **post_filter):
+    if not user.is_authenticated():
+        return None
+    post_filter = dict(('post__'+key,value) for key,value in post_filter.items())
+    viewer_votes = {}
+    for direction,through in (('up',Post.upvoters.through),('down',Post.downvoters.through)):
+        votes = through.objects.filter(user_id=user.pk, **post_filter)
+        viewer_votes[direction] = set(votes.values_list('post_id',flat=True))
+    return viewer_votes
@@ -0,0 +1,157 @@
+# Imports many pubmed citations at once, see management command import_pubmed
+# Citations are created with bulk_create together with their default threads and base node posts, a few
+# queries per chunk instead of ~9 queries per citation (save_if_unique + create_associated_threads_posts)
+# Example usage:
+# from papers.pubmed_import import iter_pubmed_file, citations_from_articles, bulk_create_citations
+# citations = citations_from_articles(iter_pubmed_file('pubmed_result.xml'))
+# num_created = bulk_create_citations(citations)
+
+from django.db import transaction, IntegrityError
+from xml.etree import ElementTree
+import json
+from .models import Citation, Thread, Post
+from .citation_lookup import known_pubmed_ids
+from .citation_search import index_citations
+from .facets import index_citation_facets
+
+# sqlite allows at most 999 parameters per query, keep pubmedID__in lookups below that
+LOOKUP_CHUNK_SIZE = 900
+
+# converts a pubmed xml element to the json structure xml2json.js produces on the search page, which is
+# what Citation.parse_pubmedJson expects:
+# elements with text become strings (attributes are dropped), other elements become dicts of their
+# children and attributes, and repeated children become lists
+# the text of an element includes inline markup, e.g., <ArticleTitle><i>C. elegans</i> longevity</ArticleTitle>
+def element_to_json(element):
+    if has_text(element):
+        return ''.join(element.itertext()).strip()
+    obj = dict(element.attrib)
+    for child in element:
+        value = element_to_json(child)
+        if child.tag not in obj:
+            obj[child.tag] = value
+        elif type(obj[child.tag]) is list:
+            obj[child.tag].append(value)
+        else:
+            obj[child.tag] = [obj[child.tag],value]
+    return obj
+
+# tags pubmed uses for markup inside titles and abstracts
+INLINE_MARKUP_TAGS = frozenset(('i','b','u','sup','sub'))
+
+# True for elements with text of their own, or with text between their children, or that only hold markup
+def has_text(element):
+    if (element.text or '').strip():
+        return True
+    children = list(element)
+    if any((child.tail or '').strip() for child in children):
+        return True
+    return len(children) > 0 and all(child.tag in INLINE_MARKUP_TAGS for child in children)
+
+# yields one json article ({'MedlineCitation': ...}) per PubmedArticle of a pubmed xml document
+def iter_pubmed_xml(source):
+    for event,element in ElementTree.iterparse(source):
+        if element.tag == 'PubmedArticle':
+            yield element_to_json(element)
+            element.clear()
+
+# yields json articles from a file of pubmed efetch xml, or of json as produced by xml2json.js
+def iter_pubmed_file(path):
+    if path.endswith('.xml'):
+        for article in iter_pubmed_xml(path):
+            yield article
+        return
+    with open(path) as f:
+        data = json.load(f)
+    if type(data) is dict:
+        data = data.get('PubmedArticleSet',data)
+        data = data.get('PubmedArticle',data)
+    if type(data) is not list:
+        data = [data]
+    for article in data:
+        yield article
+
+# returns (citations,errors) from json articles. errors lists articles that could not be parsed
+def citations_from_articles(articles):
+    citations = []
+    errors = []
+    for i,article in enumerate(articles):
+        citation = Citation()
+        try:
+            citation.parse_pubmedJson(article)
+            citation.pubmedID = int(citation.pubmedID)
+        except (KeyError,TypeError,ValueError) as e:
+            errors.append('article %d: %r' % (i,e))
+            continue
+        citations.append(citation)
+    return citations,errors
+
+# returns set of values of Citation field fieldname (pubmedID or normalized_doi) that are already used
+# one query per LOOKUP_CHUNK_SIZE values
+def get_existing_values(fieldname, values):
+    values = [value for value in values if value is not None]
+    existing = set()
+    for i in range(0,len(values),LOOKUP_CHUNK_SIZE):
+        chunk = values[i:i+LOOKUP_CHUNK_SIZE]
+        existing.update(Citation.objects.filter(**{fieldname+'__in': chunk}).values_list(fieldname,flat=True))
+    return existing
+
+# saves citations that are not in the database yet (by pubmedID or DOI), with their default threads and base nodes
+# every chunk is one transaction of 5 queries and the search and facet indexing, plus the lookups of existing pubmed IDs and DOIs
+# returns number of citations created
+def bulk_create_citations(citations, chunk_size=500):
+    unique_citations = []
+    pubmed_ids = set()
+    dois = set()
+    for citation in citations: # first one wins, like save_if_unique
+        citation.fill_derived_fields()
+        if citation.pubmedID in pubmed_ids or citation.normalized_doi in dois:
+            continue
+        unique_citations.append(citation)
+        pubmed_ids.add(citation.pubmedID)
+        if citation.normalized_doi is not None:
+            dois.add(citation.normalized_doi)
+    existing_pubmed_ids = get_existing_values('pubmedID',pubmed_ids)
+    existing_dois = get_existing_values('normalized_doi',dois)
+    new_citations = [c for c in unique_citations
+                     if c.pubmedID not in existing_pubmed_ids and c.normalized_doi not in existing_dois]
+
+    num_created = 0
+    chunk_size = min(chunk_size,LOOKUP_CHUNK_SIZE)
+    for i in range(0,len(new_citations),chunk_size):
+        chunk = new_citations[i:i+chunk_size]
+        try:
+            with transaction.atomic():
+                create_citation_chunk(chunk)
+            num_created += len(chunk)
+            known_pubmed_ids.add(citation.pubmedID for citation in chunk) # bulk_create sends no post_save
+        except IntegrityError:
+            # another process saved some of these citations after they were looked up, go one by one
+            for citation in chunk:
+                citation.pk = None
+                if citation.save_if_unique() == citation.pk:
+                    num_created += 1
+    return num_created
+
+# citations must have their derived fields filled in (see Citation.fill_derived_fields)
+def create_citation_chunk(citations):
+    Citation.objects.bulk_create(citations)
+    # bulk_create does not set pks on every database, so read them back
+    pks = dict(Citation.objects.filter(pubmedID__in=[c.pubmedID for c in citations]).values_list('pubmedID','pk'))
+    for citation in citations:
+        citation.pk = pks[citation.pubmedID]
+    citation_pks = list(pks.values())
+
+    threads = [Thread(owner_id=citation_pk,title=title,description=description,order=order)
+               for citation_pk in citation_pks
+               for title,description,order in Citation.default_threads]
+    Thread.objects.bulk_create(threads)
+    thread_pks = Thread.objects.filter(owner__in=citation_pks).values_list('pk',flat=True)
+
+    # base node posts have no text, no path and no revisions, so nothing in Post.save() is skipped
+    Post.objects.bulk_create([Post(thread_id=thread_pk,isReplyToPost=False,text="",node_depth=0)
+                              for thread_pk in thread_pks])
+
+    # bulk_create sends no post_save, so index the citations for search and browsing here
+    index_citations(citations)
+    index_citation_facets(citations)
@@ -0,0 +1,135 @@
+# Streaming parser of pubmed efetch xml (retmode=xml) into PubmedRecords, the search results of PubmedInterface
+# Articles are read with iterparse and dropped from the tree as soon as their record is built, so memory stays
+# flat however many articles a response holds, and records keep their fields in __slots__ instead of a dict
+# Fields have the values of the medline tags PubmedInterface used to read (e.g., author is AU, doi is LID)
+# Example usage:
+# from papers.pubmed_xml import iter_pubmed_records
+# for record in iter_pubmed_records(io.StringIO(efetch_xml)):
+#     record.pubmedID, record.title, record.author      # 26000000, 'A study of worms', ['Chiang MC']
+# Benchmark: python manage.py benchmark_pubmed_parsers
+
+from xml.etree import ElementTree
+import json
+
+# (medline tag) of each field
+RECORD_FIELDS = ('pubmedID',        # PMID, an int
+                 'title',           # TI
+                 'author',          # AU, list of 'LastName Initials'
+                 'fullAuthorNames', # FAU, list of 'LastName, ForeName'
+                 'journal',         # TA
+                 'volume',          # VI
+                 'number',          # IP
+                 'pages',           # PG
+                 'date',            # DP, e.g., '2015 Jan 2'
+                 'fullSource',      # SO, e.g., 'Science. 2015 Jan 2;347(6217):1-2. doi: 10.1126/science.1.'
+                 'keywords',        # OT, list
+                 'abstract',        # AB
+                 'doi')             # LID, e.g., '10.1126/science.1 [doi]'
+
+class PubmedRecord(object):
+    # preexistingEntry(_pk) are set by views.checkPubmedEntriesForPreexistingCitations
+    __slots__ = RECORD_FIELDS + ('preexistingEntry','preexistingEntry_pk')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self,name,fields.get(name))
+
+    def __str__(self):
+        return "Stores a single pubmed citation"
+
+    # compact json of the fields, for the shared pubmed cache
+    def dumps(self):
+        return json.dumps([getattr(self,name) for name in RECORD_FIELDS],separators=(',',':'))
+
+    @staticmethod
+    def loads(text):
+        return PubmedRecord(**dict(zip(RECORD_FIELDS,json.loads(text))))
+
+# returns text of element including inline markup (e.g., <i> in titles), or None
+def get_text(element):
+    if element is None:
+        return None
+    return ''.join(element.itertext()).strip()
+
+# returns child of element with tag path[0], its child with tag path[1], ..., or None
+# (element.find with a path such as 'Journal/JournalIssue' goes through the slower ElementPath module)
+def find(element, *path):
+    for tag in path:
+        if element is None:
+            return None
+        element = element.find(tag)
+    return element
+
+def findtext(element, *path):
+    element = find(element,*path)
+    return element.text if element is not None else None
+
+# returns list of children of find(element,*path)
+def children(element, *path):
+    element = find(element,*path)
+    return list(element) if element is not None else []
+
+# returns PubmedRecord of a PubmedArticle element
+def article_to_record(element):
+    medline = element.find('MedlineCitation')
+    article = medline.find('Article')
+    record = PubmedRecord()
+    record.pubmedID = int(medline.findtext('PMID'))
+    record.title = get_text(article.find('ArticleTitle'))
+
+    authors,full_names = [],[]
+    for author in children(article,'AuthorList'):
+        last_name = author.findtext('LastName')
+        if last_name is None: # groups like <CollectiveName>
+            continue
+        initials,first_name = author.findtext('Initials'),author.findtext('ForeName')
+        authors.append(last_name + ' ' + initials if initials else last_name)
+        full_names.append(last_name + ', ' + first_name if first_name else last_name)
+    record.author = authors or None
+    record.fullAuthorNames = full_names or None
+
+    record.journal = findtext(medline,'MedlineJournalInfo','MedlineTA')
+    issue = find(article,'Journal','JournalIssue')
+    if issue is not None:
+        record.volume = issue.findtext('Volume')
+        record.number = issue.findtext('Issue')
+        pubDate = issue.find('PubDate')
+        if pubDate is not None: # Year Month Day, or MedlineDate
+            record.date = ' '.join(part.text for part in pubDate if part.text) or None
+    record.pages = findtext(article,'Pagination','MedlinePgn')
+
+    keywords = [get_text(keyword) for keyword in children(medline,'KeywordList')]
+    record.keywords = keywords or None
+    sections = []
+    for section in children(article,'Abstract'):
+        if section.tag == 'AbstractText':
+            label = section.get('Label')
+            text = get_text(section)
+            sections.append(label + ': ' + text if label else text)
+    record.abstract = ' '.join(sections) or None
+
+    doi = None
+    for location in article.findall('ELocationID'):
+        if location.get('EIdType') == 'doi':
+            doi = location.text
+            break
+    record.doi = doi + ' [doi]' if doi else None
+
+    source = '%s. %s' % (record.journal,record.date)
+    if record.volume:
+        source += ';' + record.volume
+    if record.number:
+        source += '(%s)' % record.number
+    if record.pages:
+        source += ':' + record.pages
+    record.fullSource = source + '.' + (' doi: %s.' % doi if doi else '')
+    return record
+
+# yields PubmedRecord of each PubmedArticle of a pubmed xml document (a file name or file object, bytes are
+# cheaper to stream than str). Each article is cleared once parsed, like pubmed_import.iter_pubmed_xml, and only
+# its empty element stays in the tree. Error responses (e.g., <ERROR>) have no articles
+def iter_pubmed_records(source):
+    for event,element in ElementTree.iterparse(source):
+        if element.tag == 'PubmedArticle':
+            yield article_to_record(element)
+            element.clear()
@@ -0,0 +1,97 @@
+# Ranking strategies used to order sibling posts of a discussion thread
+# Each strategy scores every post of a thread at once: vote counts and timestamps are read into numpy arrays
+# and scores are computed in one vectorized pass, without any queries
+# Example usage:
+# from papers.ranking import rank_posts
+# posts = get_thread_posts(thread.pk)
+# scores = rank_posts(posts, 'wilson')                        # {post pk: score}
+# events = iter_greedy_thread_events(posts, scores=scores)    # siblings sorted by score, highest first
+
+import numpy as np
+from django.utils import timezone
+
+# same score Post.score() gives deleted posts, so deleted posts sink to the bottom under every strategy
+DELETED_SCORE = -999999
+
+# z value of the 95% confidence interval used by the wilson strategy
+WILSON_Z = 1.96
+
+# how fast posts lose their score under the hot strategy, score / (age in hours + 2)**HOT_GRAVITY
+HOT_GRAVITY = 1.8
+
+# arrays holding the vote counts and time of each post of post_list, in the same order
+class PostArrays(object):
+    def __init__(self, post_list, now=None):
+        if now is None:
+            now = timezone.now()
+        self.pks = [post.pk for post in post_list]
+        self.upvotes = np.array([post.upvote_count for post in post_list], dtype=float)
+        self.downvotes = np.array([post.downvote_count for post in post_list], dtype=float)
+        self.deleted = np.array([post.deleted for post in post_list], dtype=bool)
+        self.depths = np.array([post.node_depth for post in post_list], dtype=int)
+        times = [post.time_created or now for post in post_list] # unsaved posts count as brand new
+        self.ages = np.array([(now - time).total_seconds() for time in times], dtype=float)
+        self.timestamps = np.array([time.timestamp() for time in times], dtype=float)
+        # index of each post's mother in post_list, -1 if the mother is not in post_list
+        index = dict((pk,i) for i,pk in enumerate(self.pks))
+        self.mothers = np.array([index.get(post.mother_id,-1) for post in post_list], dtype=int)
+
+def raw_scores(arrays):
+    return arrays.upvotes - arrays.downvotes
+
+# highest raw score found anywhere in the subtree of each post, so a post with a good reply rises with it
+# mothers are updated one depth level at a time, deepest level first
+def aggregate_scores(arrays):
+    scores = np.where(arrays.deleted, DELETED_SCORE, raw_scores(arrays))
+    for depth in sorted(set(arrays.depths), reverse=True):
+        level = (arrays.depths == depth) & (arrays.mothers >= 0)
+        np.maximum.at(scores, arrays.mothers[level], scores[level])
+    return scores
+
+# lower bound of the wilson score interval of the fraction of upvotes
+# posts with few votes are ranked conservatively, posts without votes score 0
+def wilson_scores(arrays):
+    n = arrays.upvotes + arrays.downvotes
+    safe_n = np.maximum(n, 1)
+    p = arrays.upvotes / safe_n
+    z2 = WILSON_Z**2
+    lower = (p + z2/(2*safe_n) - WILSON_Z*np.sqrt((p*(1-p) + z2/(4*safe_n))/safe_n)) / (1 + z2/safe_n)
+    return np.where(n > 0, lower, 0)
+
+# raw score decayed by age, so recent posts with a few votes rank above old posts with many
+def hot_scores(arrays):
+    age_hours = np.maximum(arrays.ages, 0) / 3600
+    return raw_scores(arrays) / (age_hours + 2)**HOT_GRAVITY
+
+def newest_scores(arrays):
+    return arrays.timestamps
+
+RANKERS = {
+    'raw': raw_scores,
+    'aggregate': aggregate_scores,
+    'wilson': wilson_scores,
+    'hot': hot_scores,
+    'newest': newest_scores,
+}
+
+RANKING_CHOICES = (
+    ('raw', 'Top'),
+    ('aggregate', 'Best discussion'),
+    ('wilson', 'Best'),
+    ('hot', 'Hot'),
+    ('newest', 'Newest'),
+)
+
+DEFAULT_RANKING = 'raw'
+
+def is_ranking(name):
+    return name in RANKERS
+
+# returns {post pk: score} for every post in post_list, using strategy name (one of RANKERS)
+def rank_posts(post_list, name=DEFAULT_RANKING, now=None):
+    post_list = list(post_list)
+    if len(post_list) == 0:
+        return {}
+    arrays = PostArrays(post_list, now)
+    scores = np.where(arrays.deleted, DELETED_SCORE, RANKERS[name](arrays))
+    return dict(zip(arrays.pks, scores.tolist()))
@@ -0,0 +1,100 @@
+# Speculative prefetch of the next page of PubMed search results (see views.search0)
+# After a page is served, the next one is fetched from the NCBI history server and parsed in a background thread,
+# and kept in memory until the user asks for it, so clicking "next" does not wait for NCBI. Each user has at
+# most one prefetched page, which is dropped (and its fetch cancelled if not started) when the user moves to
+# another search or page. Records fetched in the background also land in the shared pubmed_cache
+# Example usage:
+# from papers.search_prefetch import search_prefetcher
+# search_prefetcher.prefetch(session_key,history,10,10)     # returns at once
+# pubmed = search_prefetcher.get(session_key,history,10,10)  # PubmedInterface with the page, or None
+
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import logging
+import threading
+import time
+from .Pubmed import PubmedInterface, pubmed_cache
+from .eutils import eutils_client
+
+logger = logging.getLogger(__name__)
+
+# number of pages fetched at once by a process, on top of the requests of the users
+PREFETCH_MAX_WORKERS = getattr(settings, 'PUBMED_PREFETCH_MAX_WORKERS', 2)
+
+# number of users whose prefetched page is kept, the least recently active are dropped first
+PREFETCH_MAX_USERS = getattr(settings, 'PUBMED_PREFETCH_MAX_USERS', 200)
+
+# prefetched pages not asked for within this many seconds are dropped
+PREFETCH_TTL = getattr(settings, 'PUBMED_PREFETCH_TTL', 60*10)
+
+# seconds to wait for a prefetch that is still running before fetching the page again
+PREFETCH_WAIT = getattr(settings, 'PUBMED_PREFETCH_WAIT', 10)
+
+class Prefetch(object):
+    def __init__(self, key, future):
+        self.key = key # (webenv,query_key,retMin,retMax)
+        self.future = future
+        self.started_at = time.time()
+
+class SearchPrefetcher(object):
+    def __init__(self, client=eutils_client, cache=pubmed_cache, max_workers=PREFETCH_MAX_WORKERS,
+                 max_users=PREFETCH_MAX_USERS, ttl=PREFETCH_TTL):
+        self.client = client
+        self.cache = cache
+        self.max_users = max_users
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.prefetches = OrderedDict() # {user key: Prefetch}, least recently active user first
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(history, retMin, retMax):
+        return (history['webenv'],history['query_key'],retMin,retMax)
+
+    # fetches records retMin to retMin+retMax of the search history (see PubmedInterface.startSearch) in the
+    # background for user_key (e.g., the session key), replacing the page prefetched before for that user
+    def prefetch(self, user_key, history, retMin, retMax):
+        key = self.get_key(history,retMin,retMax)
+        with self.lock:
+            prefetch = self.prefetches.get(user_key)
+            if prefetch is not None and prefetch.key == key:
+                return
+            self.cancel_locked(user_key)
+            self.prefetches[user_key] = Prefetch(key,self.executor.submit(self.fetch_page,history,retMin,retMax))
+            while len(self.prefetches) > self.max_users:
+                self.cancel_locked(next(iter(self.prefetches)))
+
+    def fetch_page(self, history, retMin, retMax):
+        pubmed = PubmedInterface(self.client,self.cache)
+        pubmed.getPage(history,retMin,retMax)
+        return pubmed
+
+    # returns PubmedInterface with the prefetched page of user_key if it is records retMin to retMin+retMax of the
+    # search history, or None. A prefetch that is still running is waited for at most wait seconds
+    # the page is handed out once, views change its entries
+    def get(self, user_key, history, retMin, retMax, wait=PREFETCH_WAIT):
+        with self.lock:
+            prefetch = self.prefetches.get(user_key)
+            if prefetch is None or prefetch.key != self.get_key(history,retMin,retMax):
+                return None
+            del self.prefetches[user_key]
+        if time.time() - prefetch.started_at > self.ttl:
+            return None
+        try:
+            return prefetch.future.result(wait)
+        except Exception: # the page is fetched again by the caller
+            logger.warning('prefetch of %r failed',prefetch.key,exc_info=True)
+            return None
+
+    # drops the prefetched page of user_key, e.g., when the user starts another search
+    def cancel(self, user_key):
+        with self.lock:
+            self.cancel_locked(user_key)
+
+    def cancel_locked(self, user_key):
+        prefetch = self.prefetches.pop(user_key,None)
+        if prefetch is not None:
+            prefetch.future.cancel() # does nothing if the fetch is running, its result is then dropped
+
+search_prefetcher = SearchPrefetcher()
@@ -0,0 +1,186 @@
+# Key/value cache in a sqlite file, shared by all worker processes of the server (see Pubmed.pubmed_cache)
+# Entries expire after their ttl, and when the stored values grow past max_bytes the least recently used
+# entries are evicted. Lookups only read the file, except to refresh access times older than ACCESS_RESOLUTION.
+# Hits and misses are counted in each process and added to the file every COUNTER_FLUSH_INTERVAL seconds or
+# COUNTER_FLUSH_OPERATIONS lookups, so stats() covers all processes up to their last flush
+# Example usage:
+# cache = SqliteCache('/tmp/cache.sqlite3',max_bytes=10*2**20)
+# cache.set_many({'a':'1','b':'2'},ttl=60)
+# cache.get_many(['a','c'])      # {'a':'1'}, counts one hit and one miss
+# cache.stats()                  # {'hits':1,'misses':1,'evictions':0,'entries':2,'bytes':2}
+
+import os
+import sqlite3
+import threading
+import time
+
+# sqlite allows at most 999 parameters per query
+MAX_KEYS_PER_QUERY = 900
+
+# the access time of an entry is only written if it is older than this, so that most hits do not write
+ACCESS_RESOLUTION = 60
+
+# counts of a process are written to the file after this many seconds or lookups
+COUNTER_FLUSH_INTERVAL = 30
+COUNTER_FLUSH_OPERATIONS = 100
+
+COUNTER_NAMES = ('hits','misses')
+
+class SqliteCache(object):
+    def __init__(self, path, max_bytes=64*2**20, timeout=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.local = threading.local() # sqlite connections cannot be shared between threads
+        self.counts = dict.fromkeys(COUNTER_NAMES,0) # not yet written to the file
+        self.pid = os.getpid()
+        self.operations = 0
+        self.flushed_at = time.time()
+        self.counts_lock = threading.Lock()
+
+    # returns the connection of this thread, created (with the tables) on first use and after a fork
+    def connect(self):
+        connection = getattr(self.local,'connection',None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path,timeout=self.timeout)
+            connection.execute('PRAGMA journal_mode=WAL') # readers do not block the writer
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, '
+                               'size INTEGER, expires REAL, accessed REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            # the total size of the values is kept in counters, summed once for files without it
+            if connection.execute("SELECT 1 FROM counters WHERE name = 'bytes'").fetchone() is None:
+                with connection:
+                    connection.execute("INSERT OR IGNORE INTO counters (name, value) "
+                                       "SELECT 'bytes', COALESCE(SUM(size), 0) FROM entries")
+            with self.counts_lock:
+                if self.pid != os.getpid(): # forked, the counts of the parent process are not ours
+                    self.counts,self.operations,self.pid = dict.fromkeys(COUNTER_NAMES,0),0,os.getpid()
+            self.local.connection,self.local.pid = connection,os.getpid()
+        return connection
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    # returns {key: value} of the keys that are cached and not expired
+    # only reads, unless some of the hits were last accessed more than ACCESS_RESOLUTION seconds ago
+    def get_many(self, keys):
+        keys = list(keys)
+        connection = self.connect()
+        now = time.time()
+        values = {}
+        stale_keys = []
+        for i in range(0,len(keys),MAX_KEYS_PER_QUERY):
+            chunk = keys[i:i+MAX_KEYS_PER_QUERY]
+            rows = connection.execute('SELECT key, value, accessed FROM entries WHERE expires > ? AND key IN (%s)'
+                                      % ','.join('?' * len(chunk)),[now] + chunk)
+            for key,value,accessed in rows:
+                values[key] = value
+                if accessed < now - ACCESS_RESOLUTION:
+                    stale_keys.append(key)
+        if len(stale_keys) > 0:
+            with connection:
+                for i in range(0,len(stale_keys),MAX_KEYS_PER_QUERY):
+                    chunk = stale_keys[i:i+MAX_KEYS_PER_QUERY]
+                    connection.execute('UPDATE entries SET accessed = ? WHERE key IN (%s)'
+                                       % ','.join('?' * len(chunk)),[now] + chunk)
+        self.count(hits=len(values),misses=len(keys) - len(values))
+        return values
+
+    def set(self, key, value, ttl):
+        self.set_many({key: value},ttl)
+
+    # stores {key: value} (strings) for ttl seconds, then evicts least recently used entries if over max_bytes
+    def set_many(self, values, ttl):
+        if len(values) == 0:
+            return
+        connection = self.connect()
+        now = time.time()
+        keys = list(values)
+        with connection:
+            replaced = 0 # sizes of the entries overwritten, found by primary key
+            for i in range(0,len(keys),MAX_KEYS_PER_QUERY):
+                chunk = keys[i:i+MAX_KEYS_PER_QUERY]
+                replaced += connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries WHERE key IN (%s)'
+                                               % ','.join('?' * len(chunk)),chunk).fetchone()[0]
+            connection.executemany('INSERT OR REPLACE INTO entries (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                                   [(key,value,len(value),now + ttl,now) for key,value in values.items()])
+            self.add_bytes(connection,sum(len(value) for value in values.values()) - replaced)
+            self.evict(connection,now)
+
+    def get_bytes(self, connection):
+        row = connection.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()
+        return row[0] if row is not None else 0
+
+    def add_bytes(self, connection, n):
+        connection.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('bytes', 0)")
+        connection.execute("UPDATE counters SET value = value + ? WHERE name = 'bytes'",[n])
+
+    # deletes expired entries, then least recently used ones until the values fit in max_bytes
+    # runs in the transaction of set_many, and reads only the entries it deletes (through the indexes)
+    def evict(self, connection, now):
+        size = self.get_bytes(connection)
+        if size <= self.max_bytes:
+            return
+        expired = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries WHERE expires <= ?',[now]).fetchone()[0]
+        connection.execute('DELETE FROM entries WHERE expires <= ?',[now])
+        size -= expired
+        evicted,evicted_size = [],0
+        for key,entry_size in connection.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            if size - evicted_size <= self.max_bytes:
+                break
+            evicted.append(key)
+            evicted_size += entry_size
+        for i in range(0,len(evicted),MAX_KEYS_PER_QUERY):
+            chunk = evicted[i:i+MAX_KEYS_PER_QUERY]
+            connection.execute('DELETE FROM entries WHERE key IN (%s)' % ','.join('?' * len(chunk)),chunk)
+        self.add_bytes(connection,-expired - evicted_size)
+        if len(evicted) > 0: # in the transaction that writes anyway
+            connection.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('evictions', 0)")
+            connection.execute("UPDATE counters SET value = value + ? WHERE name = 'evictions'",[len(evicted)])
+
+    # adds to the counts of this process, and writes them to the file when due
+    def count(self, **counts):
+        with self.counts_lock:
+            for name,n in counts.items():
+                self.counts[name] += n
+            self.operations += 1
+            due = (self.operations >= COUNTER_FLUSH_OPERATIONS or
+                   time.time() - self.flushed_at > COUNTER_FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    # writes the counts of this process to the file
+    def flush(self):
+        with self.counts_lock:
+            counts = self.counts
+            self.counts = dict.fromkeys(COUNTER_NAMES,0)
+            self.operations,self.flushed_at = 0,time.time()
+        counts = [(name,n) for name,n in counts.items() if n > 0]
+        if len(counts) == 0:
+            return
+        connection = self.connect()
+        with connection:
+            for name,n in counts:
+                connection.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)',[name])
+                connection.execute('UPDATE counters SET value = value + ? WHERE name = ?',[n,name])
+
+    # returns {'hits','misses','evictions','entries','bytes'}, counted over all processes since the last clear()
+    # counts of other processes are included up to their last flush
+    def stats(self):
+        self.flush()
+        connection = self.connect()
+        stats = dict.fromkeys(COUNTER_NAMES + ('evictions','bytes'),0)
+        stats.update(connection.execute('SELECT name, value FROM counters').fetchall())
+        stats['entries'] = connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return stats
+
+    def clear(self):
+        with self.counts_lock:
+            self.counts = dict.fromkeys(COUNTER_NAMES,0)
+        connection = self.connect()
+        with connection:
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM counters')
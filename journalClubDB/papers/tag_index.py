@@ -0,0 +1,61 @@
+# Prefix search of tag names for the tag autocomplete on the detail page
+# All tag keys are kept in a sorted list in memory, loaded with one query and reloaded when a tag is saved in
+# this process or every ttl seconds, so a lookup is a binary search and never touches the database
+# Example usage:
+# from papers.tag_index import tag_index
+# tag_index.complete('cell')      # [('Cell Biology',12),('cell cycle',3)], most used tags first
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import bisect
+import heapq
+import threading
+import time
+from .models import Tag
+
+# tags created by other processes show up after the index is reloaded
+TAG_INDEX_TTL = getattr(settings, 'TAG_INDEX_TTL', 60)
+
+class TagIndex(object):
+    def __init__(self, ttl=TAG_INDEX_TTL):
+        self.ttl = ttl
+        self.keys = None   # sorted tag keys
+        self.tags = None   # (name,citation count) of the tag of each key
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.is_stale():
+            with self.lock:
+                if self.is_stale(): # another thread may have reloaded it while we waited
+                    rows = Tag.objects.exclude(key=None).order_by('key').values_list('key','name','citation_count')
+                    keys,tags = [],[]
+                    for key,name,citation_count in rows:
+                        keys.append(key)
+                        tags.append((name,citation_count))
+                    self.keys,self.tags,self.loaded_at = keys,tags,time.time()
+        return self.keys,self.tags
+
+    def is_stale(self):
+        return self.keys is None or time.time() - self.loaded_at > self.ttl
+
+    def clear(self):
+        self.keys = None
+
+    # returns list of (name,citation count) of at most limit tags whose key starts with prefix, most used first
+    def complete(self, prefix, limit=10):
+        keys,tags = self.load()
+        prefix = Tag.normalize_key(prefix)
+        if prefix == '':
+            return []
+        start = bisect.bisect_left(keys,prefix)
+        end = bisect.bisect_left(keys,prefix + '\uffff',start)
+        return heapq.nsmallest(limit,tags[start:end],key=lambda tag: (-tag[1],tag[0].lower()))
+
+tag_index = TagIndex()
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def clear_tag_index(sender, **kwargs):
+    tag_index.clear()
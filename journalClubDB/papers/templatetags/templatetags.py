@@ -1,8 +1,9 @@
-from django.template import Library
+from django.template import Library, Node, TemplateSyntaxError
 from datetime import datetime, timedelta, timezone
 from django.utils.timesince import timesince
 register = Library()
 from papers.models import UserProfile
+from papers.viewer_blocks import viewer_block_start, viewer_block_end, viewer_block_matches, VOTE_CONDITIONS
 
 @register.filter
 def post_upvoted_by_user(post,user_pk):
@@ -26,6 +27,73 @@ def post_downvoted_by_user(post,user_pk):
     """
     return post.downvoters.filter(id=user_pk).exists()
 
+@register.assignment_tag(takes_context=True)
+def post_vote_state(context,post):
+    """
+    Usage (in template):
+    {% post_vote_state p as vote %}
+    {% if vote == 'up' %} ... {% elif vote == 'down' %} ... {% endif %}
+
+    Returns 'up', 'down' or '' for the logged in user.  Reads the viewer_votes sets
+    from the view (see post_tree.get_viewer_votes) when they are in the context,
+    otherwise falls back to querying post_upvoted_by_user/post_downvoted_by_user
+    """
+    viewer_votes = context.get('viewer_votes')
+    if viewer_votes is not None:
+        if post.pk in viewer_votes['up']:
+            return 'up'
+        elif post.pk in viewer_votes['down']:
+            return 'down'
+        return ''
+    user = context.get('user')
+    if user is None or not user.is_authenticated():
+        return ''
+    elif post_upvoted_by_user(post,user.pk):
+        return 'up'
+    elif post_downvoted_by_user(post,user.pk):
+        return 'down'
+    return ''
+
+class ViewerBlockNode(Node):
+    def __init__(self, condition, arg, nodelist):
+        self.condition = condition
+        self.arg = arg
+        self.nodelist = nodelist
+
+    def render(self, context):
+        condition = self.condition.resolve(context)
+        arg = self.arg.resolve(context) if self.arg is not None else None
+        nonce = context.get('viewer_block_nonce')
+        if nonce: # decided per viewer when the shared html is served
+            pk = getattr(arg,'pk',arg)
+            return viewer_block_start(nonce,condition,pk) + self.nodelist.render(context) + \
+                   viewer_block_end(nonce,condition,pk)
+        user = context.get('user')
+        vote = post_vote_state(context,arg) if condition in VOTE_CONDITIONS and user is not None and user.is_authenticated() else ''
+        if viewer_block_matches(condition,getattr(arg,'pk',arg),user,vote):
+            return self.nodelist.render(context)
+        return ''
+
+@register.tag
+def viewer_block(parser,token):
+    """
+    Usage (in template):
+    {% viewer_block 'member' %} ... {% endviewer_block %}              logged in users
+    {% viewer_block 'anonymous' %} ... {% endviewer_block %}
+    {% viewer_block 'owner' p.creator_id %} ... {% endviewer_block %}  the user with that pk
+    {% viewer_block 'upvoted' p %} ... {% endviewer_block %}           also not_upvoted, downvoted, not_downvoted
+
+    Renders the content if the viewer matches.  In html shared by all viewers (viewer_block_nonce in the context, see
+    thread_cache.py) the content is wrapped in markers instead, and kept or dropped for each viewer later
+    """
+    bits = token.split_contents()
+    if len(bits) not in (2,3):
+        raise TemplateSyntaxError("%r takes a condition and an optional argument" % bits[0])
+    nodelist = parser.parse(('endviewer_block',))
+    parser.delete_first_token()
+    arg = parser.compile_filter(bits[2]) if len(bits) == 3 else None
+    return ViewerBlockNode(parser.compile_filter(bits[1]),arg,nodelist)
+
 @register.filter
 def reply_notifications(user):
   """
@@ -84,57 +152,28 @@ def first_author( full_author_list ):
   else:
       return last_name + ' et al'
 
+# The following filters read post_tree.TreeEvent objects, e.g., {% if event|is_indent %}
 @register.filter
-def is_depth_divisible_by_two( text ):
-    indent_prefix = 'in-'
-    dedent_prefix = 'out-'
-    if text.startswith(indent_prefix):
-        depth = int(text[len(indent_prefix):])
-    elif text.startswith(dedent_prefix):
-        depth = int(text[len(dedent_prefix):])
-    return depth % 2 == 0
+def is_depth_divisible_by_two( event ):
+    return event.depth % 2 == 0
 
 @register.filter
-def is_depth_one( text ):
-    indent_prefix = 'in-'
-    dedent_prefix = 'out-'
-    if text.startswith(indent_prefix):
-        depth = int(text[len(indent_prefix):])
-    elif text.startswith(dedent_prefix):
-        depth = int(text[len(dedent_prefix):])
-    return depth == 1
+def is_depth_one( event ):
+    return event.depth == 1
 
 @register.filter
-def is_depth_two( text ):
-    indent_prefix = 'in-'
-    dedent_prefix = 'out-'
-    if text.startswith(indent_prefix):
-        depth = int(text[len(indent_prefix):])
-    elif text.startswith(dedent_prefix):
-        depth = int(text[len(dedent_prefix):])
-    return depth == 2
-
-# returns True if text is indent
+def is_depth_two( event ):
+    return event.depth == 2
+
+# returns True if event opens a subtree
 @register.filter
-def is_indent( text ):
-    indent_prefix = 'in-'
-    if type(text) is not str:
-        return False
-    elif text.startswith(indent_prefix):
-        return True
-    else:
-        return False
-
-# returns True if text is dedent
+def is_indent( event ):
+    return getattr(event,'kind',None) == 'open'
+
+# returns True if event closes a subtree
 @register.filter
-def is_dedent( text ):
-    dedent_prefix = 'out-'
-    if type(text) is not str:
-        return False
-    elif text.startswith(dedent_prefix):
-        return True
-    else:
-        return False
+def is_dedent( event ):
+    return getattr(event,'kind',None) == 'close'
 
 @register.filter
 def parse_full_names( full_names ):
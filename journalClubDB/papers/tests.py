@@ -1,23 +1,54 @@
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.core.urlresolvers import reverse
+from django.template import Template, Context
+from django.utils import timezone
+from io import StringIO
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import tempfile
+from xml.etree import ElementTree
+import threading
+from unittest import mock
+from bson import json_util
 import datetime
+import json
 from django.contrib.auth.models import AnonymousUser, User
 
-from .models import Citation, Thread, Post
+from .models import Citation, Thread, Post, Tag, UserProfile
 from .views import order_post_list
+from .post_tree import get_thread_posts, iter_greedy_thread_events, TreeEvent, get_viewer_votes, \
+                       get_thread_page, encode_thread_cursor
+from .ranking import rank_posts
+from .citation_codec import decode_citation, CitationCodecError
+from .citation_lookup import known_pubmed_ids, annotate_existing_citations
+from .citation_search import search_citations, tokenize
+from .catalog import get_catalog_page
+from .tag_index import tag_index
+from .facets import facet_index
+from .eutils import EutilsClient, EutilsError
+from .Pubmed import PubmedInterface
+from .shared_cache import SqliteCache
+from .pubmed_xml import iter_pubmed_records, PubmedRecord
+from .pubmed_import import element_to_json
+from .search_prefetch import SearchPrefetcher
+from .thread_cache import get_thread_html, get_thread_cache_key, bump_thread_version, CSRF_TOKEN_PLACEHOLDER
 
 class postScoreTests(TestCase):
 
     def setUp(self):
         # create a citation
-        citation = Citation(title="my citation",author='michael',journal='science',
-                            volume='1',number='2',pages='3-4',date='2015',
-                            fullSource='science(1),3-4,2015',keywords='worms',
-                            abstract='worms are cool',doi='102:324522',
-                            fullAuthorNames='Michael Chiang', pubmedID='12345')
+        citation = Citation(title="my citation",authors='Michael Chiang',journal='science',
+                            volume='1',number='2',pages='3-4',pubDate='2015',keywords='worms',
+                            abstract='worms are cool',doi='102:324522',pubmedID=12345)
         citation.save()
 
         # create a thread linked to citation
-        thread = Thread(owner=citation, title="discussion")
+        thread = Thread(owner=citation, title="discussion", order=1)
         thread.save()
 
         # create users
@@ -69,13 +100,927 @@ class postScoreTests(TestCase):
         tree = Post.objects.filter(thread=thread)
         ordered_tree,tree = order_post_list(tree)
 
-        idx_post1 = tree.filter(text__lt = "user1's first post").count()
-        idx_post2 = tree.filter(text__lt = "user2's first reply").count()
-        post1 = tree[idx_post1]
-        post2 = tree[idx_post2]
+        post1 = [p for p in tree if p.text == "user1's first post"][0]
+        post2 = [p for p in tree if p.text == "user2's first reply to user 1"][0]
         self.assertEqual(post1.aggregate_score_tmp,1)
         self.assertEqual(post2.aggregate_score_tmp,1)
         self.assertEqual(ordered_tree[0].text,'master')
         self.assertEqual(ordered_tree[1].text,"user1's first post")
         self.assertEqual(ordered_tree[2].text,"user2's first reply to user 1")
         self.assertEqual(ordered_tree[3].text,"user2's first post")
+
+class threadTreeTests(TestCase):
+
+    def setUp(self):
+        citation = Citation(title="my citation", pubmedID=12345)
+        citation.save()
+        self.user = User.objects.create_user(username='user1', email='user1@gmail.com', password='password1')
+        self.thread = Thread(owner=citation, title="discussion", order=1)
+        self.thread.save()
+        self.base = Post(time_created=datetime.datetime.now(),thread=self.thread,
+                         isReplyToPost=False,text="",node_depth=0)
+        self.base.save()
+
+    def add_reply(self,mother,text):
+        post = Post(time_created=datetime.datetime.now(),creator=self.user,thread=self.thread,
+                    isReplyToPost=True,mother=mother,text=text,node_depth=mother.node_depth+1)
+        post.save()
+        return post
+
+    # Tests that replies are nested under their mother post and siblings are sorted by score
+    def test_greedy_order(self):
+        low = self.add_reply(self.base,"low")
+        high = self.add_reply(self.base,"high")
+        reply = self.add_reply(low,"reply to low")
+        high.upvoters.add(self.user)
+
+        events = iter_greedy_thread_events(get_thread_posts(self.thread.pk))
+        self.assertEqual([(e.kind,e.depth,e.post) for e in events],
+                         [('open',0,None),('post',0,self.base),
+                            ('open',1,None),('post',1,high),('close',1,None),
+                            ('open',1,None),('post',1,low),
+                              ('open',2,None),('post',2,reply),('close',2,None),
+                            ('close',1,None),
+                          ('close',0,None)])
+
+    # Tests that threads deeper than the recursion limit can be ordered
+    def test_deep_thread(self):
+        posts = [Post(pk=1,node_depth=0,thread=self.thread)]
+        for i in range(2,3001):
+            posts.append(Post(pk=i,mother_id=i-1,node_depth=i-1,thread=self.thread))
+        events = list(iter_greedy_thread_events(posts,include_root=False))
+        self.assertEqual(len(events),3*2999)
+        self.assertEqual(events[1].post.pk,2)
+        self.assertEqual(events[-1],TreeEvent('close',1,None))
+
+    # Tests that loading and ordering a thread costs one query no matter how large it is
+    def test_query_count(self):
+        mother = self.base
+        for i in range(30):
+            mother = self.add_reply(mother if i % 3 else self.base,"post %d" % i)
+            mother.upvoters.add(self.user)
+        with self.assertNumQueries(1):
+            events = list(iter_greedy_thread_events(get_thread_posts(self.thread.pk)))
+            for event in events:
+                if event.kind == 'post':
+                    event.post.score()
+                    event.post.creator
+                    event.post.thread.owner
+        self.assertEqual(len(events), 3*31)
+
+    # Tests that ancestors and subtrees are read through the materialized path
+    def test_materialized_path(self):
+        a = self.add_reply(self.base,"a")
+        b = self.add_reply(a,"b")
+        c = self.add_reply(b,"c")
+        d = self.add_reply(a,"d")
+        other = self.add_reply(self.base,"other")
+        self.assertEqual(a.path,'')
+        self.assertEqual(c.path,Post.path_segment(a.pk)+Post.path_segment(b.pk))
+        with self.assertNumQueries(1):
+            self.assertEqual(c.get_ancestors(),[a,b])
+        with self.assertNumQueries(1):
+            self.assertEqual(set(a.get_subtree()),set([a,b,c,d]))
+        with self.assertNumQueries(1):
+            self.assertEqual(a.num_replies(),3)
+        self.assertEqual(self.base.num_replies(),5)
+        self.assertEqual(other.num_replies(),0)
+
+    # Tests that the current text is stored on the post and older revisions are kept separately
+    def test_revisions(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        post = Post(thread=self.thread,creator=self.user,isReplyToPost=True,mother=self.base,node_depth=1)
+        post.add_post("first",self.user.pk,now,self.user.username)
+        post.save()
+        post.add_post("second",self.user.pk,now+datetime.timedelta(minutes=1),self.user.username)
+        post.save()
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.current_text,"second")
+        self.assertEqual(post.current_editor,self.user)
+        self.assertEqual([r.text for r in post.get_revisions()],["first","second"])
+
+    # Tests that backfill_post_revisions converts the legacy json edit history
+    def test_backfill_revisions(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        history = [("old",self.user.pk,now,"user1"),("new",self.user.pk,now,"user1")]
+        post = self.add_reply(self.base,json.dumps(history,default=json_util.default))
+        call_command('backfill_post_revisions',stdout=StringIO())
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.current_text,"new")
+        self.assertEqual([r.text for r in post.get_revisions()],["old","new"])
+
+    # Tests that thread html is served from the cache until the thread version changes
+    def test_thread_html_cache(self):
+        cache.clear()
+        first = self.add_reply(self.base,"")
+        request = RequestFactory().get('/')
+        request.user = self.user
+        html,num_depth1_posts,next_cursor = get_thread_html(request,self.thread)
+        self.assertIn('id="post-%d"' % first.pk, html)
+        self.assertNotIn(CSRF_TOKEN_PLACEHOLDER, html)
+        self.assertEqual(num_depth1_posts,1)
+
+        second = self.add_reply(self.base,"")
+        viewer_votes = get_viewer_votes(self.user, thread=self.thread.pk)
+        with self.assertNumQueries(0):
+            html,num_depth1_posts,next_cursor = get_thread_html(request,self.thread,viewer_votes=viewer_votes)
+        self.assertNotIn('id="post-%d"' % second.pk, html)
+
+        bump_thread_version(self.thread.pk)
+        thread = Thread.objects.get(pk=self.thread.pk)
+        html,num_depth1_posts,next_cursor = get_thread_html(request,thread)
+        self.assertIn('id="post-%d"' % second.pk, html)
+        self.assertEqual(num_depth1_posts,2)
+
+    # Tests that one cached html serves all viewers, each with their own votes and edit/delete links
+    def test_shared_thread_html(self):
+        cache.clear()
+        other = User.objects.create_user(username='user2', email='user2@gmail.com', password='password2')
+        post = self.add_reply(self.base,"")
+        post.upvoters.add(other)
+        requests = {}
+        for user in (self.user,other,AnonymousUser()):
+            requests[user.pk] = RequestFactory().get('/')
+            requests[user.pk].user = user
+        html,dummy,dummy = get_thread_html(requests[self.user.pk],self.thread)
+        self.assertIn('id="up-%d" class="up-arrow' % post.pk, html)
+        self.assertIn('>edit</a>', html)
+        self.assertNotIn('<!--viewer:', html)
+
+        with self.assertNumQueries(2): # the viewer's votes, html is not rendered again
+            html,dummy,dummy = get_thread_html(requests[other.pk],self.thread)
+        self.assertIn('id="up-%d" class="upvoted-arrow' % post.pk, html)
+        self.assertNotIn('>edit</a>', html)
+        self.assertNotIn('class="activate-login-modal-vote pointer"', html)
+
+        with self.assertNumQueries(0):
+            html,dummy,dummy = get_thread_html(requests[None],self.thread)
+        self.assertIn('class="activate-login-modal-vote pointer"', html)
+        self.assertNotIn('class="up-arrow pointer"', html)
+        self.assertNotIn('>edit</a>', html)
+
+    # Tests that viewer markers and the csrf placeholder typed into post text are served as typed
+    def test_forged_viewer_markers(self):
+        cache.clear()
+        text = '<!--viewer:bogus:-->hi<!--/viewer:bogus:--><!--viewer:member:-->members<!--/viewer:member:-->' + \
+               CSRF_TOKEN_PLACEHOLDER
+        post = self.add_reply(self.base,"")
+        Post.objects.filter(pk=post.pk).update(current_text=text)
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        html,dummy,dummy = get_thread_html(request,self.thread)
+        self.assertIn(text,html)
+
+    # Tests that depth 1 posts are paginated by score with a cursor and each page costs two queries
+    def test_thread_pages(self):
+        posts = [self.add_reply(self.base,"post %d" % i) for i in range(5)]
+        reply = self.add_reply(posts[0],"reply")
+        posts[0].upvoters.add(self.user)
+        posts[3].downvoters.add(self.user)
+        expected = [posts[0],posts[4],posts[2],posts[1],posts[3]]
+
+        pages = []
+        after = None
+        while True:
+            with self.assertNumQueries(2):
+                events,after = get_thread_page(self.thread.pk,after,page_size=2)
+                events = list(events)
+            pages.append([e.post for e in events if e.kind == 'post'])
+            if after is None:
+                break
+        self.assertEqual(pages,[[posts[0],reply,posts[4]],[posts[2],posts[1]],[posts[3]]])
+        self.assertEqual([e.post for e in iter_greedy_thread_events(get_thread_posts(self.thread.pk),include_root=False)
+                          if e.kind == 'post'],[posts[0],reply]+expected[1:])
+
+        response = self.client.get(reverse('papers:thread_page',args=[self.thread.pk]),{'after':'bad'})
+        self.assertEqual(response.status_code,400)
+        response = self.client.get(reverse('papers:thread_page',args=[self.thread.pk+1]))
+        self.assertEqual(response.status_code,404)
+        self.assertEqual(get_thread_cache_key(self.thread,'0:1:%d' % posts[4].pk,'raw'),
+                         get_thread_cache_key(self.thread,'00:1.0:%d' % posts[4].pk,'raw'))
+        response = self.client.get(reverse('papers:thread_page',args=[self.thread.pk]),
+                                   {'after':encode_thread_cursor(posts[4])})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertIn('id="post-%d"' % posts[2].pk, data['html'])
+        self.assertNotIn('id="post-%d"' % posts[4].pk, data['html'])
+        self.assertEqual(data['next'],None)
+
+    # Tests that each ranking strategy orders siblings as expected
+    def test_rankings(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        def make_post(pk,up,down,hours_old,mother_id=0,node_depth=1):
+            return Post(pk=pk,mother_id=mother_id,node_depth=node_depth,upvote_count=up,downvote_count=down,
+                        time_created=now-datetime.timedelta(hours=hours_old))
+        posts = [make_post(0,0,0,100,None,0),
+                 make_post(1,10,0,48),   # many votes, old
+                 make_post(2,3,0,1),     # few votes, recent
+                 make_post(3,60,40,72),  # most votes, controversial
+                 make_post(4,0,1,0),     # newest, but with a great reply
+                 make_post(5,50,0,0,4,2)]
+        def order(name):
+            scores = rank_posts(posts,name,now)
+            return [e.post.pk for e in iter_greedy_thread_events(posts,include_root=False,scores=scores)
+                    if e.kind == 'post' and e.depth == 1]
+        self.assertEqual(order('raw'),[3,1,2,4])
+        self.assertEqual(order('aggregate'),[4,3,1,2])
+        self.assertEqual(order('wilson'),[1,3,2,4])
+        self.assertEqual(order('hot'),[2,1,3,4])
+        self.assertEqual(order('newest'),[4,2,1,3])
+
+        # ranked threads are paged like threads ranked by raw score
+        pages = []
+        after = None
+        for post in self.thread.post_set.exclude(pk=self.base.pk):
+            post.delete()
+        for i in range(3):
+            self.add_reply(self.add_reply(self.base,"post %d" % i),"reply %d" % i)
+        while True:
+            events,after = get_thread_page(self.thread.pk,after,page_size=2,ranking='newest')
+            pages.append([e.post.text for e in events if e.kind == 'post'])
+            if after is None:
+                break
+        self.assertEqual(pages,[["post 2","reply 2","post 1","reply 1"],["post 0","reply 0"]])
+
+    # Tests that later pages of hot threads are ranked at the time of the first page
+    def test_hot_pages_over_time(self):
+        now = timezone.now()
+        old = self.add_reply(self.base,"old")
+        new = self.add_reply(self.base,"new")
+        Post.objects.filter(pk=old.pk).update(upvote_count=10,time_created=now-datetime.timedelta(hours=10))
+        Post.objects.filter(pk=new.pk).update(upvote_count=1,time_created=now)
+        events,after = get_thread_page(self.thread.pk,page_size=1,ranking='hot',now=now)
+        self.assertEqual([e.post.text for e in events if e.kind == 'post'],["new"])
+        # ten hours later "old" ranks above "new", but page 2 still follows the ranking of page 1
+        later = now + datetime.timedelta(hours=10)
+        events,after = get_thread_page(self.thread.pk,after,page_size=1,ranking='hot',now=later)
+        self.assertEqual([e.post.text for e in events if e.kind == 'post'],["old"])
+        self.assertIsNone(after)
+
+    # Tests that thread and citation post counts and last activity follow post creation and deletion
+    def test_activity_stats(self):
+        first = self.add_reply(self.base,"first")
+        second = self.add_reply(first,"second")
+        thread = Thread.objects.get(pk=self.thread.pk)
+        citation = thread.owner
+        self.assertEqual((thread.post_count,citation.post_count),(2,2))
+        self.assertEqual(citation.last_activity,Post.objects.get(pk=second.pk).time_created)
+
+        self.assertTrue(first.mark_deleted())
+        self.assertFalse(first.mark_deleted())
+        second.delete()
+        thread = Thread.objects.get(pk=self.thread.pk)
+        self.assertEqual((thread.num_posts(),thread.owner.num_posts()),(0,0))
+
+        Thread.objects.update(post_count=5)
+        Citation.objects.update(post_count=5)
+        self.add_reply(self.base,"third")
+        call_command('backfill_activity_stats',stdout=StringIO())
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).post_count,1)
+        self.assertEqual(Citation.objects.get(pk=citation.pk).post_count,1)
+
+class citationAuthorTests(TestCase):
+
+    authors = [{'first_name':'Michael C','initials':'MC','last_name':'Chiang'},
+               {'first_name':'Jane','initials':'J','last_name':'Doe'}]
+
+    # Tests that authors are stored as json and display strings are formatted when saving
+    def test_author_lists(self):
+        citation = Citation(title="my citation",authors=self.authors,pubmedID=1)
+        self.assertEqual(citation.get_author_list_truncated(),'Chiang et al') # not saved yet
+        citation.save()
+        citation = Citation.objects.get(pk=citation.pk)
+        self.assertEqual(json.loads(citation.authors),self.authors)
+        self.assertEqual(citation.get_author_list(),'Michael C. Chiang, and Jane Doe.')
+        self.assertEqual(citation.get_author_list_truncated(),'Chiang et al')
+
+    # Tests that convert_citation_authors converts python literals left by older versions
+    def test_convert_authors(self):
+        citation = Citation(title="my citation",pubmedID=1)
+        citation.save()
+        Citation.objects.filter(pk=citation.pk).update(authors=str(self.authors[1:]),author_list='',author_list_truncated='')
+        call_command('convert_citation_authors',stdout=StringIO())
+        citation = Citation.objects.get(pk=citation.pk)
+        self.assertEqual(json.loads(citation.authors),self.authors[1:])
+        self.assertEqual(citation.author_list_truncated,'J Doe')
+
+    # Tests that authors which are not a list of author dicts are kept as a single author's last name
+    def test_malformed_authors(self):
+        for authors in ('2015','None','{[1]: 2}','"x"','[1, 2]'):
+            citation = Citation(title="my citation",authors=authors,pubmedID=1)
+            citation.save()
+            self.assertEqual(citation.author_list,authors)
+            citation.delete()
+
+    # Tests that decoded fields are cached per instance and dropped when the field changes
+    def test_decoded_fields(self):
+        citation = Citation(title="my citation",pubDate=str({'Year':'2015'}),pubmedID=1)
+        citation.save()
+        pubDate = citation.eval('pubDate')
+        self.assertIs(citation.eval('pubDate'),pubDate)
+        citation.pubDate = str({'Year':'2016'})
+        self.assertEqual(citation.eval('pubDate')['Year'],'2016')
+        Citation.objects.filter(pk=citation.pk).update(pubDate=str({'Year':'2017'}))
+        citation.refresh_from_db()
+        self.assertEqual(citation.eval('pubDate')['Year'],'2017')
+        self.assertEqual(citation.eval('pubmedID'),1)
+        citation.pubDate = '{[1]: 2}' # literal_eval raises TypeError for unhashable keys
+        self.assertEqual(citation.eval('pubDate'),'{[1]: 2}')
+        self.assertNotIn('_decoded_fields',citation.serialize())
+
+    # Tests that citations survive the search page wire format and that tampered citations are rejected
+    def test_citation_codec(self):
+        citation = Citation(title="my citation",authors=self.authors,pubmedID=26000000,
+                            pubDate={'Year':'2015'},abstract='<b>"quoted"</b>')
+        copy = Citation()
+        copy.deserialize(citation.serialize())
+        self.assertEqual((copy.title,copy.authors,copy.pubmedID,copy.pubDate,copy.abstract),
+                         (citation.title,citation.authors,citation.pubmedID,citation.pubDate,citation.abstract))
+        self.assertIsNone(copy.pk)
+
+        self.assertRaises(CitationCodecError,copy.deserialize,citation.serialize().replace('my citation','evil'))
+        self.assertRaises(CitationCodecError,decode_citation,'1:{"title":"my citation"}',signed=False)
+        self.assertRaises(CitationCodecError,decode_citation,'0:[]',signed=False)
+
+        response = self.client.post(reverse('papers:addCitation'),{'citation_serialized':citation.serialize()})
+        self.assertEqual(Citation.objects.get(pubmedID=26000000).get_author_list_truncated(),'Chiang et al')
+        response = self.client.post(reverse('papers:addCitation'),{'citation_serialized':"{'title': 'x'}"})
+        self.assertEqual(response.status_code,400)
+
+    # Tests that import_pubmed creates new citations with their threads and base nodes, and skips known ones
+    def test_import_pubmed(self):
+        article = '''<PubmedArticle><MedlineCitation><PMID Version="1">%d</PMID><Article>
+                       <Journal><Title>Science</Title><JournalIssue><PubDate><Year>2015</Year></PubDate></JournalIssue></Journal>
+                       <ArticleTitle>paper %d</ArticleTitle>
+                       <AuthorList><Author><LastName>Chiang</LastName><ForeName>Michael C</ForeName><Initials>MC</Initials></Author>
+                                   <Author><LastName>Doe</LastName><ForeName>Jane</ForeName><Initials>J</Initials></Author></AuthorList>
+                     </Article></MedlineCitation></PubmedArticle>'''
+        Citation(title="already imported",pubmedID=2).save()
+        with tempfile.NamedTemporaryFile(mode='w',suffix='.xml') as f:
+            f.write('<PubmedArticleSet>%s</PubmedArticleSet>' % ''.join(article % (i,i) for i in (1,2,3,3)))
+            f.flush()
+            call_command('import_pubmed',f.name,stdout=StringIO())
+        citation = Citation.objects.get(pubmedID=3)
+        self.assertEqual(citation.title,'paper 3')
+        self.assertEqual(citation.get_author_list_truncated(),'Chiang et al')
+        self.assertEqual(citation.get_year_published(),'2015')
+        self.assertEqual(Citation.objects.get(pubmedID=2).title,'already imported')
+        self.assertEqual(Citation.objects.count(),3)
+        self.assertEqual(list(citation.thread_set.order_by('order').values_list('title',flat=True)),
+                         [title for title,description,order in Citation.default_threads])
+        self.assertEqual(Post.objects.filter(thread__owner=citation,node_depth=0).count(),4)
+
+    # Tests that titles and abstracts keep the text of their inline markup
+    def test_import_inline_markup(self):
+        article = ElementTree.fromstring('''<Article><ArticleTitle><i>C. elegans</i> longevity and CO<sub>2</sub></ArticleTitle>
+                                              <Abstract><AbstractText>Role of <i>p53</i> in aging<sup>14</sup>.</AbstractText></Abstract>
+                                              <Journal><Title>Science</Title></Journal></Article>''')
+        article = element_to_json(article)
+        self.assertEqual(article['ArticleTitle'],'C. elegans longevity and CO2')
+        self.assertEqual(article['Abstract'],{'AbstractText':'Role of p53 in aging14.'})
+        self.assertEqual(article['Journal'],{'Title':'Science'})
+        self.assertEqual(element_to_json(ElementTree.fromstring('<ArticleTitle><i>Drosophila</i></ArticleTitle>')),
+                         'Drosophila')
+
+class citationIdentifierTests(TestCase):
+
+    # Tests that citations are unique by pubmed ID and by DOI, in any of the forms pubmed gives it
+    def test_save_if_unique(self):
+        citation = Citation(title="my citation",pubmedID=1,doi=str(['S0092-8674(15)00001-1','10.1016/J.CELL.2015.01.001']))
+        pk = citation.save_if_unique()
+        self.assertEqual(Citation.objects.get(pk=pk).normalized_doi,'10.1016/j.cell.2015.01.001')
+        self.assertEqual(Citation(pubmedID=1).save_if_unique(),pk)
+        self.assertEqual(Citation(pubmedID=2,doi='doi: 10.1016/j.cell.2015.01.001').save_if_unique(),pk)
+        self.assertEqual(Citation(pubmedID='1').preExistingEntryExists(),pk)
+        self.assertEqual(Citation(pubmedID=3).preExistingEntryExists(),-1)
+        self.assertEqual(Thread.objects.filter(owner=pk).count(),4)
+
+    # Tests that a citation saved by a concurrent request between lookup and insert is returned
+    def test_save_if_unique_race(self):
+        pk = Citation(title="my citation",pubmedID=1).save_if_unique()
+        citation = Citation(title="my citation",pubmedID=1)
+        with mock.patch.object(Citation,'get_existing_pk',side_effect=[None,pk]):
+            self.assertEqual(citation.save_if_unique(),pk)
+        self.assertEqual(Citation.objects.count(),1)
+        self.assertEqual(Thread.objects.count(),4)
+
+    # Tests that dedupe_citations moves discussions of duplicates to the oldest citation
+    def test_dedupe(self):
+        user = User.objects.create_user(username='user1', email='user1@gmail.com', password='password1')
+        keeper = Citation.objects.get(pk=Citation(title="keeper",pubmedID=1,doi='10.1000/abc').save_if_unique())
+        Citation.objects.update(normalized_doi=None) # as before the column existed
+        duplicate = Citation.objects.get(pk=Citation(title="duplicate",pubmedID=2,doi='10.1000/ABC').save_if_unique())
+        Citation.objects.update(normalized_doi=None)
+        thread = duplicate.thread_set.get(order=2)
+        base = thread.post_set.get(node_depth=0)
+        post = Post(creator=user,thread=thread,isReplyToPost=True,mother=base,text="",node_depth=1)
+        post.save()
+        reply = Post(creator=user,thread=thread,isReplyToPost=True,mother=post,text="",node_depth=2)
+        reply.save()
+
+        call_command('dedupe_citations',stdout=StringIO())
+        self.assertEqual(list(Citation.objects.values_list('pk','normalized_doi')),[(keeper.pk,'10.1000/abc')])
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.thread,keeper.thread_set.get(order=2))
+        self.assertEqual(post.mother,post.thread.post_set.get(node_depth=0))
+        self.assertEqual(Post.objects.get(pk=reply.pk).get_ancestors(),[post])
+        self.assertEqual(Citation.objects.get(pk=keeper.pk).post_count,2)
+
+    # Tests that search results are matched to saved citations with at most one query per page
+    def test_annotate_existing_citations(self):
+        known_pubmed_ids.clear()
+        pk = Citation(title="my citation",pubmedID=1).save_if_unique()
+        results = [Citation(pubmedID=1),Citation(pubmedID='2'),Citation(pubmedID=None)]
+        with self.assertNumQueries(2): # known pubmed IDs are loaded once
+            annotate_existing_citations(results)
+        self.assertEqual([c.preExistingEntryExists() for c in results],[pk,-1,-1])
+        with self.assertNumQueries(0):
+            annotate_existing_citations(results[1:])
+
+        pk2 = Citation(title="second",pubmedID=2).save_if_unique()
+        with self.assertNumQueries(1):
+            annotate_existing_citations(results)
+        self.assertEqual([c.existing_pk for c in results],[pk,pk2,-1])
+
+class citationSearchTests(TestCase):
+
+    def setUp(self):
+        self.worms = Citation(title="Aging of worms",journal="Science",pubmedID=1,pubDate=str({'Year':'2015'}),
+                              authors=[{'first_name':'Jane','initials':'J','last_name':'Doe'}],
+                              mesh_keywords=str([{'DescriptorName':'Caenorhabditis elegans'}]))
+        self.worms.save()
+        self.mice = Citation(title="Aging of mice",journal="Nature",pubmedID=2,pubDate=str({'Year':'2016'}),
+                             abstract=str(['Mice age like worms do.']))
+        self.mice.save()
+
+    # Tests that citations are ranked by BM25 over their weighted fields
+    def test_search(self):
+        self.assertEqual(tokenize('The C. elegans-of Worms'),['elegans','worms'])
+        self.assertEqual(search_citations('worms'),[self.worms,self.mice]) # title beats abstract
+        self.assertEqual(search_citations('aging mice'),[self.mice,self.worms])
+        self.assertEqual(search_citations('elegans doe'),[self.worms])
+        self.assertEqual(search_citations('the'),[])
+        self.assertEqual(search_citations('worms',limit=1,offset=1),[self.mice])
+
+    # Tests that the index follows citation saves and deletes, and that rebuild_search_index recreates it
+    def test_index_updates(self):
+        self.mice.title = "Longevity of mice"
+        self.mice.save()
+        self.assertEqual(search_citations('aging'),[self.worms])
+        self.worms.delete()
+        self.assertEqual(search_citations('aging worms'),[self.mice])
+        call_command('rebuild_search_index',stdout=StringIO())
+        self.assertEqual(search_citations('longevity'),[self.mice])
+
+    def test_search_view(self):
+        response = self.client.get(reverse('papers:search_catalog'),{'q':'worms','format':'json'})
+        self.assertEqual([result['pk'] for result in json.loads(response.content.decode())['results']],
+                         [self.worms.pk,self.mice.pk])
+        response = self.client.get(reverse('papers:search_catalog'),{'q':'worms'})
+        self.assertContains(response,'Aging of mice')
+
+class catalogTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.citations = []
+        for i in range(5):
+            citation = Citation(title="paper %d" % i,pubmedID=i+1,pubDate=str({'Year':'2015'}))
+            citation.save()
+            self.citations.append(citation)
+        # paper 1 was discussed most, paper 3 most recently. Equal sort keys are broken by pk
+        activity = [(0,now),(3,now),(1,now),(0,now + datetime.timedelta(seconds=1)),(0,now)]
+        for citation,(post_count,last_activity) in zip(self.citations,activity):
+            Citation.objects.filter(pk=citation.pk).update(post_count=post_count,last_activity=last_activity)
+
+    def get_all_pages(self, sort):
+        titles = []
+        after = None
+        while True:
+            with self.assertNumQueries(2): # the page, and the tags of its citations
+                citations,after = get_catalog_page(sort,after,page_size=2)
+            titles += [citation.title for citation in citations]
+            if after is None:
+                return titles
+
+    # Tests that keyset pages list every citation once, in sort order
+    def test_catalog_pages(self):
+        self.assertEqual(self.get_all_pages('added'),['paper 4','paper 3','paper 2','paper 1','paper 0'])
+        self.assertEqual(self.get_all_pages('activity'),['paper 3','paper 4','paper 2','paper 1','paper 0'])
+        self.assertEqual(self.get_all_pages('discussed'),['paper 1','paper 2','paper 4','paper 3','paper 0'])
+        self.assertRaises(ValueError,get_catalog_page,'activity','12')
+
+    # Tests that readers are counted without grouping the catalog, so page cost does not grow with it
+    def test_num_readers(self):
+        for username in ('a','b'):
+            profile = UserProfile(user=User.objects.create_user(username=username,password='password1'))
+            profile.save()
+            profile.library.add(self.citations[4])
+        with CaptureQueriesContext(connection) as queries:
+            citations,after = get_catalog_page('added',page_size=2)
+        self.assertEqual([citation.num_readers for citation in citations],[2,0])
+        self.assertNotIn('GROUP BY',queries.captured_queries[0]['sql'].upper())
+
+    def test_index_view(self):
+        response = self.client.get(reverse('papers:index'),{'sort':'activity'})
+        self.assertContains(response,'paper 3')
+        response = self.client.get(reverse('papers:index'),{'sort':'activity','after':'x'})
+        self.assertEqual(response.status_code,400)
+        response = self.client.get(reverse('papers:index'),{'sort':'activity','after':'99999999999999999999:1'})
+        self.assertEqual(response.status_code,400)
+
+    # Tests that the year shown in listings is stored when citations are saved
+    def test_year_published(self):
+        self.assertEqual(Citation.objects.get(pk=self.citations[0].pk).year_published,'2015')
+        Citation.objects.filter(pk=self.citations[0].pk).update(year_published='',pubDate=str({'MedlineDate':'2014 Dec'}))
+        call_command('backfill_citation_years',stdout=StringIO())
+        citation = Citation.objects.get(pk=self.citations[0].pk)
+        self.assertEqual(citation.year_published,'2014 Dec')
+        citation.pubDate = 'not a date'
+        citation.save()
+        self.assertEqual(citation.get_year_published(),'')
+
+class tagTests(TestCase):
+
+    def setUp(self):
+        self.citations = []
+        for i in range(3):
+            citation = Citation(title="paper %d" % i,pubmedID=i+1)
+            citation.save()
+            self.citations.append(citation)
+
+    # Tests that tag names are matched by key and that citation counts follow the tag/citation table
+    def test_tag_counts(self):
+        User.objects.create_superuser(username='admin', email='admin@gmail.com', password='password1')
+        self.client.login(username='admin', password='password1')
+        for citation_pk,name in ((self.citations[0].pk,'Cell Biology'),(self.citations[0].pk,' cell  biology'),
+                                 (self.citations[1].pk,'CELL biology')):
+            self.client.post(reverse('papers:add_tag'),{'citation_pk':citation_pk,'current_thread':0,'tag_name':name})
+        tag = Tag.objects.get()
+        self.assertEqual((tag.name,tag.key,tag.citation_count),('Cell Biology','cell biology',2))
+        self.citations[2].tags.add(tag)
+        tag.citations.remove(self.citations[0].pk,self.citations[2].pk,12345)
+        self.assertEqual(Tag.objects.get().citation_count,1)
+        self.citations[1].delete()
+        self.assertEqual(Tag.objects.get().citation_count,0)
+
+    def test_autocomplete(self):
+        for name,citations in (('cell biology',self.citations[:1]),('Cell cycle',self.citations),('cancer',[])):
+            tag = Tag(name=name)
+            tag.save()
+            tag.citations.add(*citations)
+        tag_index.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(tag_index.complete('CELL'),[('Cell cycle',3),('cell biology',1)])
+            self.assertEqual(tag_index.complete('c',limit=1),[('Cell cycle',3)])
+            self.assertEqual(tag_index.complete('x'),[])
+        response = self.client.get(reverse('papers:tag_autocomplete'),{'q':'ca'})
+        self.assertEqual(json.loads(response.content.decode()),{'tags':[{'name':'cancer','count':0}]})
+
+    # Tests that backfill_tag_keys merges tags created before keys existed
+    def test_backfill_tag_keys(self):
+        for name in ('Aging','aging '):
+            tag = Tag(name=name)
+            tag.save()
+            tag.citations.add(self.citations[0])
+            Tag.objects.filter(pk=tag.pk).update(key=None,citation_count=0)
+        call_command('backfill_tag_keys',stdout=StringIO())
+        self.assertEqual(list(Tag.objects.values_list('name','key','citation_count')),[('Aging','aging',1)])
+
+class facetTests(TestCase):
+
+    def setUp(self):
+        facet_index.clear()
+        self.citations = []
+        for i,(journal,year,mesh) in enumerate((('Science','2014',['Aging','Mice']),('Science','2015',['Aging']),
+                                                ('Nature',None,['Mice']))):
+            citation = Citation(title="paper %d" % i,pubmedID=i+1,journal=journal,
+                                pubDate=str({'Year':year} if year else {'MedlineDate':'2015 Jan-Feb'}),
+                                mesh_keywords=str([{'DescriptorName':name,'MajorTopicYN':'N'} for name in mesh]))
+            citation.save()
+            self.citations.append(citation)
+        self.tag = Tag(name='worms')
+        self.tag.save()
+        self.tag.citations.add(self.citations[1])
+
+    def browse(self, filters):
+        matching_pks,counts = facet_index.browse(filters)
+        titles = None if matching_pks is None else [c.title for c in Citation.objects.filter(pk__in=list(matching_pks)).order_by('pk')]
+        return titles,counts
+
+    # Tests that filters intersect across facets and that counts cover the matching citations
+    def test_browse(self):
+        titles,counts = self.browse({})
+        self.assertIsNone(titles)
+        self.assertEqual(counts['year'],[('2015',2),('2014',1)])
+        self.assertEqual(counts['mesh'],[('Aging',2),('Mice',2)])
+        with self.assertNumQueries(0): # the index was loaded by the first browse
+            facet_index.browse({'year':['2014']})
+        titles,counts = self.browse({'journal':['Science'],'mesh':['Mice','Aging']})
+        self.assertEqual(titles,['paper 0','paper 1'])
+        self.assertEqual(counts['tag'],[('worms',1)])
+        self.assertEqual(self.browse({'year':['2015'],'mesh':['Mice']})[0],['paper 2'])
+        self.assertEqual(self.browse({'year':['1999']})[0],[])
+
+    # Tests that the loaded index follows citation saves and tag changes
+    def test_index_updates(self):
+        facet_index.load()
+        self.citations[2].journal = 'Science'
+        self.citations[2].save()
+        self.citations[0].tags.add(self.tag)
+        self.tag.citations.remove(self.citations[1])
+        titles,counts = self.browse({'journal':['Science'],'tag':['worms']})
+        self.assertEqual(titles,['paper 0'])
+        self.assertEqual(counts['journal'],[('Science',1)])
+        facet_index.clear()
+        self.assertEqual(self.browse({'journal':['Science'],'tag':['worms']}),(titles,counts))
+
+    def test_browse_view(self):
+        response = self.client.get(reverse('papers:browse'),{'journal':'Science','format':'json'})
+        data = json.loads(response.content.decode())
+        self.assertEqual((data['count'],[c['title'] for c in data['citations']]),(2,['paper 1','paper 0']))
+        self.assertEqual(data['facets']['journal'],[{'value':'Science','count':2}])
+        response = self.client.get(reverse('papers:browse'),{'journal':'Science'})
+        self.assertContains(response,'paper 1')
+        self.client.get(reverse('papers:browse'))
+
+class pubmedXmlTests(TestCase):
+    xml = '''<?xml version="1.0" ?>
+<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" "https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">
+<PubmedArticleSet>
+<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">25525000</PMID>
+<Article PubModel="Print"><Journal><JournalIssue CitedMedium="Internet"><Volume>347</Volume><Issue>6217</Issue>
+<PubDate><Year>2015</Year><Month>Jan</Month><Day>2</Day></PubDate></JournalIssue><Title>Science (New York, N.Y.)</Title></Journal>
+<ArticleTitle>Aging in <i>C. elegans</i> worms.</ArticleTitle><Pagination><MedlinePgn>1-2</MedlinePgn></Pagination>
+<ELocationID EIdType="pii" ValidYN="Y">science.1</ELocationID><ELocationID EIdType="doi" ValidYN="Y">10.1126/science.1</ELocationID>
+<Abstract><AbstractText Label="BACKGROUND" NlmCategory="BACKGROUND">Worms age.</AbstractText><AbstractText Label="RESULTS">They do.</AbstractText></Abstract>
+<AuthorList CompleteYN="Y"><Author ValidYN="Y"><LastName>Chiang</LastName><ForeName>Michael C</ForeName><Initials>MC</Initials></Author>
+<Author><CollectiveName>Worm Consortium</CollectiveName></Author></AuthorList></Article>
+<MedlineJournalInfo><MedlineTA>Science</MedlineTA></MedlineJournalInfo>
+<KeywordList Owner="NOTNLM"><Keyword MajorTopicYN="N">aging</Keyword><Keyword MajorTopicYN="N">worms</Keyword></KeywordList>
+</MedlineCitation></PubmedArticle>
+<PubmedArticle><MedlineCitation><PMID Version="1">2</PMID><Article><Journal><JournalIssue>
+<PubDate><MedlineDate>1998 Dec-1999 Jan</MedlineDate></PubDate></JournalIssue></Journal><ArticleTitle>paper 2</ArticleTitle></Article>
+<MedlineJournalInfo><MedlineTA>Cell</MedlineTA></MedlineJournalInfo></MedlineCitation></PubmedArticle>
+</PubmedArticleSet>'''
+
+    # Tests that articles are parsed to the values of the medline tags
+    def test_parse(self):
+        record,other = iter_pubmed_records(StringIO(self.xml))
+        self.assertEqual((record.pubmedID,record.title,record.author,record.fullAuthorNames),
+                         (25525000,'Aging in C. elegans worms.',['Chiang MC'],['Chiang, Michael C']))
+        self.assertEqual((record.journal,record.volume,record.number,record.pages,record.date),
+                         ('Science','347','6217','1-2','2015 Jan 2'))
+        self.assertEqual(record.fullSource,'Science. 2015 Jan 2;347(6217):1-2. doi: 10.1126/science.1.')
+        self.assertEqual((record.keywords,record.doi),(['aging','worms'],'10.1126/science.1 [doi]'))
+        self.assertEqual(record.abstract,'BACKGROUND: Worms age. RESULTS: They do.')
+        self.assertEqual((other.pubmedID,other.date,other.author,other.abstract,other.fullSource),
+                         (2,'1998 Dec-1999 Jan',None,None,'Cell. 1998 Dec-1999 Jan.'))
+        self.assertFalse(hasattr(record,'__dict__'))
+        copy = PubmedRecord.loads(record.dumps())
+        self.assertEqual([getattr(copy,name) for name in PubmedRecord.__slots__],
+                         [getattr(record,name) for name in PubmedRecord.__slots__])
+        self.assertEqual(list(iter_pubmed_records(StringIO('<ERROR>Unable to obtain query #1</ERROR>'))),[])
+
+# Local stand-in for the NCBI E-utilities with 25 search results, pubmed IDs 1 to 25
+class StubEutilsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive like NCBI does
+
+    medline = 'PMID- %s\nTI  - paper %s\nAU  - Chiang MC\nTA  - Science\nDP  - 2015\n\n'
+    article = ('<PubmedArticle><MedlineCitation><PMID>%s</PMID><Article><ArticleTitle>paper %s</ArticleTitle>'
+               '<AuthorList><Author><LastName>Chiang</LastName><Initials>MC</Initials></Author></AuthorList>'
+               '</Article><MedlineJournalInfo><MedlineTA>Science</MedlineTA></MedlineJournalInfo>'
+               '</MedlineCitation></PubmedArticle>')
+
+    # returns efetch response with the records of pmids, medline text or xml like the request asks
+    def get_records(self, pmids, params):
+        if params.get('retmode') == ['xml']:
+            return '<PubmedArticleSet>%s</PubmedArticleSet>' % ''.join(self.article % (pmid,pmid) for pmid in pmids)
+        return ''.join(self.medline % (pmid,pmid) for pmid in pmids)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        self.server.requests.append((url.path,params))
+        self.server.connections.add(self.client_address)
+        if url.path == '/esearch.fcgi':
+            retstart,retmax = int(params['retstart'][0]),int(params['retmax'][0])
+            ids = [str(pmid) for pmid in range(1,26)][retstart:retstart+retmax]
+            result = {'count':'25','idlist':ids}
+            if params.get('usehistory') == ['y']:
+                self.server.searches += 1
+                self.server.webenv = 'WEBENV%d' % self.server.searches
+                result.update(webenv=self.server.webenv,querykey='1')
+            body = json.dumps({'esearchresult':result})
+        elif url.path == '/efetch.fcgi' and 'WebEnv' in params:
+            if params['WebEnv'] != [self.server.webenv]:
+                body = '<ERROR>Unable to obtain query #1</ERROR>\n' # what NCBI sends for expired sessions
+            else:
+                retstart,retmax = int(params['retstart'][0]),int(params['retmax'][0])
+                body = self.get_records(range(1,26)[retstart:retstart+retmax],params)
+        elif url.path == '/efetch.fcgi':
+            body = self.get_records(params['id'][0].split(','),params)
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubEutilsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class pubmedClientTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(pubmedClientTests, cls).setUpClass()
+        cls.server = StubEutilsServer(('127.0.0.1',0),StubEutilsHandler)
+        threading.Thread(target=cls.server.serve_forever,daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(pubmedClientTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.searches = 0
+        self.client = EutilsClient(base_url='http://127.0.0.1:%d/' % self.server.server_port,max_workers=2)
+
+    def tearDown(self):
+        self.client.session.close()
+
+    # Tests that a results page takes one esearch (count and IDs) and one efetch
+    def test_search_page(self):
+        pubmed = PubmedInterface(self.client,cache=None)
+        pubmed.getRecords('worms',10,5)
+        self.assertEqual(pubmed.numberSearchResults,25)
+        self.assertEqual([(entry.pubmedID,entry.title) for entry in pubmed.entries],
+                         [(pmid,'paper %d' % pmid) for pmid in range(11,16)])
+        self.assertEqual([path for path,params in self.server.requests],['/esearch.fcgi','/efetch.fcgi'])
+        self.assertEqual(self.server.requests[0][1]['term'],['worms'])
+
+    # Tests that long ID lists are fetched in parallel batches over reused connections
+    def test_parallel_efetch(self):
+        for i in range(3):
+            texts = self.client.efetch(range(1,8),batch_size=2)
+        self.assertEqual([text.count('PMID-') for text in texts],[2,2,2,1])
+        self.assertTrue(texts[0].startswith('PMID- 1\n') and texts[3].startswith('PMID- 7\n'))
+        self.assertEqual(len(self.server.requests),12)
+        self.assertLessEqual(len(self.server.connections),2)
+        self.assertRaises(EutilsError,self.client.get,'einfo',{})
+
+    # Tests that later pages are fetched from the history server with one request, without searching again
+    def test_history_paging(self):
+        pubmed = PubmedInterface(self.client,cache=None)
+        history = pubmed.startSearch('worms',10)
+        self.assertEqual(history,{'search_str':'worms','webenv':'WEBENV1','query_key':'1','count':25})
+        self.assertEqual([entry.pubmedID for entry in pubmed.entries],list(range(1,11)))
+        self.server.requests = []
+        pubmed = PubmedInterface(self.client,cache=None)
+        pubmed.getPage(history,20,10)
+        self.assertEqual([entry.pubmedID for entry in pubmed.entries],list(range(21,26)))
+        self.assertEqual(pubmed.numberSearchResults,25)
+        path,params = self.server.requests[0]
+        self.assertEqual(len(self.server.requests),1)
+        self.assertEqual((path,params['WebEnv'],params['query_key'],params['retstart']),('/efetch.fcgi',['WEBENV1'],['1'],['20']))
+
+    # Tests that a search dropped by the history server is run again
+    def test_expired_history(self):
+        pubmed = PubmedInterface(self.client,cache=None)
+        history = dict(pubmed.startSearch('worms',10),webenv='EXPIRED')
+        self.server.requests = []
+        pubmed = PubmedInterface(self.client,cache=None)
+        pubmed.getPage(history,10,10)
+        self.assertEqual([entry.pubmedID for entry in pubmed.entries],list(range(11,21)))
+        self.assertEqual([path for path,params in self.server.requests],['/efetch.fcgi','/esearch.fcgi','/efetch.fcgi'])
+        self.assertEqual(pubmed.history['webenv'],'WEBENV2')
+
+    # Tests that the next page is fetched in the background and then served without requests
+    def test_prefetch(self):
+        history = PubmedInterface(self.client,cache=None).startSearch('worms',10)
+        prefetcher = SearchPrefetcher(self.client,cache=None,max_workers=1)
+        prefetcher.prefetch('user',history,10,10)
+        prefetcher.prefetches['user'].future.result()
+        self.server.requests = []
+        self.assertIsNone(prefetcher.get('user',history,20,10)) # not the prefetched page
+        prefetcher.prefetch('user',history,10,10) # already prefetched
+        pubmed = prefetcher.get('user',history,10,10)
+        self.assertEqual([entry.pubmedID for entry in pubmed.entries],list(range(11,21)))
+        self.assertEqual(len(self.server.requests),0)
+        self.assertIsNone(prefetcher.get('user',history,10,10)) # handed out once
+
+    # Tests that prefetches are dropped for new searches and bounded per user
+    def test_prefetch_cancel(self):
+        pubmed = PubmedInterface(self.client,cache=None)
+        history,other_history = pubmed.startSearch('worms',10),pubmed.startSearch('flies',10)
+        prefetcher = SearchPrefetcher(self.client,cache=None,max_workers=1,max_users=2)
+        prefetcher.prefetch('user',history,10,10)
+        prefetcher.prefetch('user',other_history,10,10)
+        self.assertIsNone(prefetcher.get('user',history,10,10))
+        prefetcher.prefetch('user2',history,10,10)
+        prefetcher.prefetch('user3',history,10,10)
+        self.assertEqual(list(prefetcher.prefetches),['user2','user3'])
+        prefetcher.cancel('user2')
+        self.assertIsNone(prefetcher.get('user2',history,10,10))
+        self.assertIsNotNone(prefetcher.get('user3',history,10,10))
+
+    # Tests that search pages and records are served from the shared cache once fetched
+    def test_cached_search(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as f:
+            first_cache = SqliteCache(f.name)
+            pubmed = PubmedInterface(self.client,first_cache)
+            pubmed.getRecords('Worms  AND aging',0,5)
+            # another worker process with its own connection to the same file
+            pubmed = PubmedInterface(self.client,SqliteCache(f.name))
+            pubmed.getRecords('worms AND Aging',0,5)
+            self.assertEqual(len(self.server.requests),2)
+            self.assertEqual([entry.pubmedID for entry in pubmed.entries],[1,2,3,4,5])
+            pubmed.getRecords('worms AND aging',3,5) # records 4 and 5 are cached
+            self.assertEqual(self.server.requests[-1][1]['id'],['6,7,8'])
+            first_cache.flush() # counts are written by each process
+            stats = pubmed.cache.stats()
+            self.assertEqual((stats['hits'],stats['misses'],stats['entries']),(8,10,10))
+
+    # Tests expiry and least recently used eviction
+    def test_shared_cache(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as f:
+            cache = SqliteCache(f.name,max_bytes=10)
+            cache.set_many({'a':'1234','b':'1234'},ttl=60)
+            cache.set('expired','1',ttl=-1)
+            connection = cache.connect()
+            changes = connection.total_changes
+            self.assertEqual(cache.get_many(['a','b','expired']),{'a':'1234','b':'1234'})
+            self.assertEqual(connection.total_changes,changes) # recently accessed hits do not write
+            SqliteCache(f.name).connect().execute("UPDATE entries SET accessed = 0 WHERE key = 'a'").connection.commit()
+            cache.set('c','1234',ttl=60) # over 10 bytes, a was used least recently
+            self.assertEqual(cache.get_many(['a','b','c']),{'b':'1234','c':'1234'})
+            stats = cache.stats()
+            self.assertEqual((stats['evictions'],stats['bytes']),(1,8)) # the expired entry went too
+
+class voteCountTests(TestCase):
+
+    def setUp(self):
+        citation = Citation(title="my citation", pubmedID=12345)
+        citation.save()
+        thread = Thread(owner=citation, title="discussion", order=1)
+        thread.save()
+        self.user1 = User.objects.create_user(username='user1', email='user1@gmail.com', password='password1')
+        self.user2 = User.objects.create_user(username='user2', email='user2@gmail.com', password='password2')
+        self.post = Post(time_created=datetime.datetime.now(),creator=self.user1,thread=thread,
+                         isReplyToPost=False,text="",node_depth=0)
+        self.post.save()
+
+    def counts(self):
+        post = Post.objects.get(pk=self.post.pk)
+        return (post.upvote_count,post.downvote_count,post.vote_score)
+
+    # Tests that vote counts follow changes made from either side of the m2m relation
+    def test_counts_follow_votes(self):
+        self.post.upvoters.add(self.user1,self.user2)
+        self.post.upvoters.add(self.user1) # already upvoted, no change
+        self.assertEqual(self.counts(),(2,0,2))
+        self.user2.upvoted.remove(self.post)
+        self.user2.downvoted.add(self.post)
+        self.assertEqual(self.counts(),(1,1,0))
+        self.post.downvoters.remove(self.user1) # never downvoted, no change
+        self.assertEqual(self.counts(),(1,1,0))
+        self.post.upvoters.clear()
+        self.assertEqual(self.counts(),(0,1,-1))
+        self.assertEqual(Post.objects.get(pk=self.post.pk).score(),-1)
+
+    # Tests that saving a stale post instance does not overwrite vote counts
+    def test_save_keeps_counts(self):
+        stale = Post.objects.get(pk=self.post.pk)
+        self.post.upvoters.add(self.user2)
+        stale.deleted = True
+        stale.save()
+        self.assertEqual(self.counts(),(1,0,1))
+
+    # Tests that reconcile_vote_counts repairs drifted counts
+    def test_reconcile(self):
+        self.post.downvoters.add(self.user2)
+        Post.objects.filter(pk=self.post.pk).update(upvote_count=5,vote_score=7)
+        call_command('reconcile_vote_counts',stdout=StringIO())
+        self.assertEqual(self.counts(),(0,1,-1))
+
+    # Tests that preloaded viewer votes answer post_vote_state without queries, and that it falls back without them
+    def test_viewer_votes(self):
+        self.post.downvoters.add(self.user2)
+        template = Template("{% load templatetags %}{% post_vote_state p as vote %}[{{ vote }}]")
+        with self.assertNumQueries(2):
+            viewer_votes = get_viewer_votes(self.user2, thread=self.post.thread_id)
+        self.assertEqual(viewer_votes,{'up':set(),'down':set([self.post.pk])})
+        with self.assertNumQueries(0):
+            html = template.render(Context({'p':self.post,'user':self.user2,'viewer_votes':viewer_votes}))
+        self.assertEqual(html,'[down]')
+        self.assertEqual(template.render(Context({'p':self.post,'user':self.user2})),'[down]')
+        self.assertEqual(template.render(Context({'p':self.post,'user':self.user1})),'[]')
+        self.assertEqual(get_viewer_votes(AnonymousUser(), thread=self.post.thread_id),None)
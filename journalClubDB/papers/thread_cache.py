@@ -0,0 +1,74 @@
+# Caches the rendered html of discussion threads on the detail page
+# Cache keys contain Thread.version, which is incremented whenever a post of the thread is added, edited,
+# deleted or voted on, so a stale thread is never served and only the thread that changed is re-rendered.
+# The html is rendered once for all viewers: parts that depend on who is looking (vote state, reply forms,
+# edit/delete links) are kept between markers and picked for each request (see viewer_blocks.py)
+# Example usage:
+# from papers.thread_cache import get_thread_html, bump_thread_version
+# html,num_depth1_posts,next_cursor = get_thread_html(request,thread)
+# bump_thread_version(post.thread_id)   # after changing a post
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.template.context_processors import csrf
+from django.template.loader import render_to_string
+from .models import Thread, Post
+from .post_tree import get_thread_page, get_viewer_votes, decode_thread_cursor
+from .ranking import DEFAULT_RANKING
+from .viewer_blocks import apply_viewer_blocks, new_viewer_block_nonce
+
+# rendered html contains relative times ("5 minutes ago"), so entries also expire after a while
+THREAD_HTML_CACHE_TIMEOUT = getattr(settings, 'THREAD_HTML_CACHE_TIMEOUT', 60*10)
+
+# number of depth 1 posts (with all of their replies) rendered per page
+THREAD_PAGE_SIZE = getattr(settings, 'THREAD_PAGE_SIZE', 20)
+
+# rendered html is shared between requests, so the csrf token is filled in when it is served
+# the placeholder ends with the nonce of the render (see viewer_blocks.py), so post text cannot contain it
+CSRF_TOKEN_PLACEHOLDER = 'THREAD-HTML-CSRF-TOKEN'
+
+def bump_thread_version(thread_pk):
+    Thread.objects.filter(pk=thread_pk).update(version=F('version') + 1)
+
+# one entry per page of a thread, shared by all viewers
+# the cursor is decoded so that equivalent spellings of it share the entry, raises ValueError for malformed cursors
+def get_thread_cache_key(thread,after=None,ranking=None):
+    if after is None:
+        page = 'first'
+    else:
+        page = '%d:%r:%d:%r' % decode_thread_cursor(after)
+    return 'thread-html:2:%d:%d:%s:%s' % (thread.pk,thread.version,ranking or thread.ranking,page)
+
+# returns (html,number of depth 1 posts,cursor of next page) for a page of a thread (see post_tree.get_thread_page)
+# pages are only rendered if the thread changed since they were last cached
+# after is the cursor returned with the previous page, or None for the first page
+# number of depth 1 posts is only counted for the first page, it is None otherwise
+# ranking is one of ranking.RANKERS, defaults to Thread.ranking
+# viewer_votes are the votes of request.user (see post_tree.get_viewer_votes), queried for the thread if not given
+# html ranked by time (hot, newest) is cached too, it is at most THREAD_HTML_CACHE_TIMEOUT stale
+def get_thread_html(request,thread,after=None,ranking=None,viewer_votes=None):
+    ranking = ranking or thread.ranking
+    key = get_thread_cache_key(thread,after,ranking)
+    cached = cache.get(key)
+    if cached is None:
+        cached = render_thread_html(thread,after,ranking)
+        cache.set(key,cached,THREAD_HTML_CACHE_TIMEOUT)
+    html,nonce,num_depth1_posts,next_cursor = cached
+    if viewer_votes is None:
+        viewer_votes = get_viewer_votes(request.user, thread=thread.pk)
+    html = apply_viewer_blocks(html,nonce,request.user,viewer_votes)
+    csrf_token = str(csrf(request)['csrf_token']) # same token {% csrf_token %} would render
+    return html.replace(CSRF_TOKEN_PLACEHOLDER + nonce,csrf_token),num_depth1_posts,next_cursor
+
+# renders html for all viewers, {% viewer_block %} contents are kept between markers
+# returns (html,nonce of its markers,number of depth 1 posts,cursor of next page)
+def render_thread_html(thread,after=None,ranking=DEFAULT_RANKING):
+    events,next_cursor = get_thread_page(thread.pk,after,THREAD_PAGE_SIZE,ranking)
+    num_depth1_posts = None
+    if after is None:
+        num_depth1_posts = Post.objects.filter(thread=thread.pk,node_depth=1).count()
+    nonce = new_viewer_block_nonce()
+    context = {'posts':events,'viewer_block_nonce':nonce,'csrf_token':CSRF_TOKEN_PLACEHOLDER + nonce}
+    html = render_to_string('post_tree_template_condensed.html', context)
+    return html,nonce,num_depth1_posts,next_cursor
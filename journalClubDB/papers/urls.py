@@ -18,6 +18,8 @@ urlpatterns = [
 
     # ex: /papers/index/
     url(r'^index/$', views.index, name='index'),
+    url(r'^search_catalog/$', views.search_catalog, name='search_catalog'),
+    url(r'^browse/$', views.browse, name='browse'),
 
     # ex: /papers/self_user_profile/
     url(r'^self_user_profile/$', views.self_user_profile, name='self_user_profile'),
@@ -33,6 +35,7 @@ urlpatterns = [
     # ex:
     url(r'^post_context/(?P<post_pk>[0-9]+)/$', views.post_context, name='post_context'),
     url(r'^post_single/(?P<post_pk>[0-9]+)/$', views.post_single, name='post_single'),
+    url(r'^post_history/(?P<post_pk>[0-9]+)/$', views.post_history, name='post_history'),
 
     # ex:
     url(r'^user_posts/(?P<user_pk>[0-9]+)/$', views.user_posts, name='user_posts'),
@@ -60,11 +63,13 @@ urlpatterns = [
 
     # ex: /papers/detail/0/0/
     url(r'^detail/(?P<pk>[0-9]+)/(?P<current_thread>[0-9]+)/$', views.detail, name='detail'),
+    url(r'^thread_page/(?P<thread_pk>[0-9]+)/$', views.thread_page, name='thread_page'),
 
     url(r'^register/$', views.register, name='register'), # ADD NEW PATTERN!
     url(r'^user_login/$', views.user_login, name='user_login'),
     url(r'^user_logout/$', views.user_logout, name='user_logout'),
     url(r'^add_tag/$', views.add_tag, name='add_tag'),
+    url(r'^tag_autocomplete/$', views.tag_autocomplete, name='tag_autocomplete'),
 
     url(r'^paperOfTheWeek_admin/$', views.paperOfTheWeek_admin, name='paperOfTheWeek_admin'),
 
@@ -0,0 +1,61 @@
+# Parts of post html that depend on who is looking: vote buttons and reply forms of logged in users, edit and
+# delete links of the post's creator, and the state of the viewer's votes. Templates wrap them in
+# {% viewer_block %} (see templatetags.py). Html rendered once for all viewers keeps every alternative between
+# markers such as <!--viewer:NONCE:upvoted:12-->...<!--/viewer:NONCE:upvoted:12-->, and apply_viewer_blocks keeps
+# the ones matching the viewer of a request, a single regular expression pass over the html.
+# NONCE is drawn for each render, so markers typed into post text (rendered |safe) are left alone
+# Example usage:
+# nonce = new_viewer_block_nonce()   # in the context of the shared render as viewer_block_nonce
+# html = apply_viewer_blocks(shared_html,nonce,request.user,get_viewer_votes(request.user,thread=thread.pk))
+
+import re
+from django.utils.crypto import get_random_string
+
+VOTE_CONDITIONS = ('upvoted','not_upvoted','downvoted','not_downvoted')
+
+def new_viewer_block_nonce():
+    return get_random_string(24)
+
+def get_viewer_block_pattern(nonce):
+    return re.compile(r'<!--viewer:%s:(\w+):(\d*)-->(.*?)<!--/viewer:%s:\1:\2-->' % (nonce,nonce),re.DOTALL)
+
+def viewer_block_start(nonce, condition, pk=None):
+    return '<!--viewer:%s:%s:%s-->' % (nonce,condition,'' if pk is None else pk)
+
+def viewer_block_end(nonce, condition, pk=None):
+    return '<!--/viewer:%s:%s:%s-->' % (nonce,condition,'' if pk is None else pk)
+
+# returns True if the content of a block is shown to user
+# pk is the pk of the owner for 'owner', of the post for vote conditions
+# vote is 'up', 'down' or '' for the viewer's vote on the post (see templatetags.post_vote_state)
+# the content of blocks with unknown conditions is never shown
+def viewer_block_matches(condition, pk, user, vote):
+    member = user is not None and user.is_authenticated()
+    if condition == 'member':
+        return member
+    elif condition == 'anonymous':
+        return not member
+    elif condition == 'owner':
+        return member and user.pk == pk
+    elif condition in VOTE_CONDITIONS:
+        direction = 'up' if condition.endswith('upvoted') else 'down'
+        return (vote == direction) != condition.startswith('not_')
+    return False
+
+# returns html with the blocks user does not see removed and the markers of the others dropped
+# nonce is the one the html was rendered with
+# viewer_votes are the sets of post pks user voted on (see post_tree.get_viewer_votes), None for anonymous users
+def apply_viewer_blocks(html, nonce, user, viewer_votes):
+    pattern = get_viewer_block_pattern(nonce)
+    def replace(match):
+        condition,pk = match.group(1),int(match.group(2)) if match.group(2) else None
+        vote = ''
+        if viewer_votes is not None and pk is not None:
+            if pk in viewer_votes['up']:
+                vote = 'up'
+            elif pk in viewer_votes['down']:
+                vote = 'down'
+        if viewer_block_matches(condition,pk,user,vote):
+            return pattern.sub(replace,match.group(3)) # blocks nested in it
+        return ''
+    return pattern.sub(replace,html)
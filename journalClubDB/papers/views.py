@@ -1,13 +1,24 @@
-from django.shortcuts import render, redirect, render_to_response
+from django.shortcuts import render, redirect, render_to_response, get_object_or_404
 from django.views import generic
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest
 from django.core.urlresolvers import reverse
 import logging
 import math
 from .models import *
 #from .forms import UserForm #, UserProfileForm
 from .Pubmed import PubmedInterface
+from .templatetags.templatetags import age
+from .thread_cache import get_thread_html, bump_thread_version
+from .post_tree import select_post_related, iter_greedy_thread_events, get_viewer_votes
+from .ranking import rank_posts, is_ranking, RANKING_CHOICES
+from .citation_codec import CitationCodecError
+from .citation_lookup import get_existing_citation_pks, annotate_existing_citations
+from .citation_search import search_citations
+from .catalog import get_catalog_page, get_catalog_page_of_pks, is_catalog_sort, CATALOG_SORTS, DEFAULT_SORT
+from .facets import facet_index, FACETS, FACET_NAMES
+from .tag_index import tag_index
+from .search_prefetch import search_prefetcher
 logger = logging.getLogger(__name__)
 import time
 import pickle # used to debug, remove later
@@ -15,55 +26,18 @@ import os
 from django.http import JsonResponse
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
+from django.db import transaction
 #from datetime import datetime, timedelta, timezone
 import datetime
 import json
 import re
 
 
-def add_indent_dedent_to_post_list(post_list):
-    rn =  add_indent_dedent_to_post_list_recursive(post_list,0,0,[])
-    return rn
-
-def add_indent_dedent_to_post_list_recursive(post_list,i,position_post,rn):
-    if i>=len(post_list):
-        return rn
-    elif i==0:
-        post = post_list[i]
-        rn = ['in-'+str(post.node_depth),post,'out-'+str(post.node_depth)] # note that position of post = 1
-        position_post = 1
-        return add_indent_dedent_to_post_list_recursive(post_list,i+1,position_post,rn)
-    else:
-        post = post_list[i]
-        previous_post = post_list[i-1]
-        insert = ['in-'+str(post.node_depth),post,'out-'+str(post.node_depth)]
-        if post.node_depth == previous_post.node_depth:
-            rn[position_post+2:position_post+2] = insert
-            position_post = (position_post+2) + 1
-        elif post.node_depth > previous_post.node_depth:
-            rn[position_post+1:position_post+1] = insert
-            position_post = (position_post+1) + 1
-        elif post.node_depth < previous_post.node_depth:
-            for j in range(position_post+2,len(post_list)):
-                if post_list[j] == 'out-'+str(post.node_depth):
-                    rn[j+1:j+1] = insert
-                    position_post = (j+1) + 1
-                    break
-        return add_indent_dedent_to_post_list_recursive(post_list,i+1,position_post,rn)
-
-# rn should start an empty list
+# returns list of posts from depth 1 down to post, using the materialized path (single query regardless of depth)
 def get_post_chain(post):
-    rn = get_post_chain_recursive(post,[])
-    return rn[::-1] # reverse list so that most recent post is at end of the list
-
-# rn should start an empty list
-def get_post_chain_recursive(post,rn):
-    rn.append(post)
-    mother = post.mother
-    if mother.node_depth == 0:
-        return rn
-    else:
-        return get_post_chain_recursive(mother,rn)
+    chain_pks = post.get_ancestor_pks() + [post.pk]
+    chain = select_post_related(Post.objects.filter(pk__in=chain_pks))
+    return sorted(chain, key=lambda p: p.node_depth) # most recent post is at end of the list
 
 def post_single(request,post_pk):
 
@@ -71,9 +45,29 @@ def post_single(request,post_pk):
     post = Post.objects.get(pk=post_pk)
 
     # return html
-    context = {'p':post}
+    context = {'p':post,'num_replies':post.num_replies()}
     return render(request, 'papers/post_single.html', context)
 
+# ranking strategy requested with ?sort=<one of ranking.RANKERS>, otherwise the thread's own ranking
+def get_requested_ranking(request,thread):
+    ranking = request.GET.get('sort')
+    if ranking is not None and is_ranking(ranking):
+        return ranking
+    return thread.ranking
+
+# orders a tree of posts so that each post is followed by its replies, best discussion first
+# posts are ranked by aggregate score, the highest score in their subtree, which is stored on
+# each post as aggregate_score_tmp
+# returns (ordered list of posts, list of ranked posts)
+def order_post_list(post_list):
+    post_list = list(post_list)
+    scores = rank_posts(post_list, 'aggregate')
+    for post in post_list:
+        post.aggregate_score_tmp = scores[post.pk]
+    ordered_post_list = [event.post for event in iter_greedy_thread_events(post_list, scores=scores)
+                         if event.kind == 'post']
+    return ordered_post_list,post_list
+
 def post_context(request,post_pk):
 
     # get post
@@ -82,13 +76,28 @@ def post_context(request,post_pk):
     # get mother post chain
     posts = get_post_chain(post)
 
+    # get which posts in the chain the user voted on
+    viewer_votes = get_viewer_votes(request.user, pk__in=[p.pk for p in posts])
+
     # insert indents and dedents to post list
-    posts =  add_indent_dedent_to_post_list(posts)
+    posts = iter_greedy_thread_events(posts)
 
     # return html
-    context = {'posts':posts,'post':post}
+    context = {'posts':posts,'post':post,'viewer_votes':viewer_votes}
     return render(request, 'papers/post_context.html', context)
 
+# returns edit history of a post as json. Loaded by post_template.js when the history dropdown is opened
+def post_history(request,post_pk):
+    post = Post.objects.select_related('creator').get(pk=post_pk)
+    revisions = []
+    if not post.deleted:
+        for i,revision in enumerate(post.get_revisions()):
+            label = 'posted' if i == 0 else 'edited'
+            if post.creator is not None and revision.editor_name != post.creator.username:
+                label = revision.editor_name + ' ' + label
+            revisions.append({'text':revision.text, 'label':label + ' ' + age(revision.time_created)})
+    return JsonResponse({'revisions':revisions})
+
 def user_notifications(request):
     # get notifications
     user_profile = UserProfile().get_user_profile(request.user)
@@ -217,10 +226,86 @@ def index_deprecated(request):
     context = {'citations': citations,'navbar':'index','num_pages':int(paginator.num_pages),'active_page':active_page}
     return render(request, 'papers/index.html', context)
 
-# see all citations in database
+# see all citations in database, one page at a time (see catalog.py)
+# ?sort=added|activity|discussed, ?after=cursor of the next page
 def index(request):
-    citations = Citation.objects.all()
-    context = {'citations': citations,'navbar':'search','show_detail_link':True}
+    sort = request.GET.get('sort')
+    if not is_catalog_sort(sort):
+        sort = DEFAULT_SORT
+    after = request.GET.get('after')
+    try:
+        citations,next_cursor = get_catalog_page(sort,after)
+    except ValueError:
+        return HttpResponseBadRequest('invalid cursor')
+    context = {'citations': citations,'navbar':'search','show_detail_link':True,'sort':sort,
+               'sorts':CATALOG_SORTS,'after':after,'next_cursor':next_cursor}
+    return render(request, 'papers/index.html', context)
+
+# browse citations by tag, journal, year and MeSH term (see facets.py), newest first
+# ?tag=..&journal=..&year=..&mesh=.. (each can be repeated), ?after=cursor of the next page
+# add &format=json for {'facets':{facet:[{'value','count'}]},'count','citations':[...],'next'}
+def browse(request):
+    filters = dict((facet,request.GET.getlist(facet)) for facet in FACET_NAMES if request.GET.getlist(facet))
+    after = request.GET.get('after')
+    matching_pks,counts = facet_index.browse(filters)
+    try:
+        if matching_pks is None:
+            citations,next_cursor = get_catalog_page(DEFAULT_SORT,after)
+        else:
+            citations,next_cursor = get_catalog_page_of_pks(matching_pks,after)
+    except ValueError:
+        return HttpResponseBadRequest('invalid cursor')
+    count = len(matching_pks) if matching_pks is not None else None
+
+    if request.GET.get('format') == 'json':
+        citations = [{'pk':citation.pk,
+                      'title':citation.title,
+                      'authors':citation.author_list_truncated,
+                      'journal':citation.journal,
+                      'url':reverse('papers:detail',args=[citation.pk,0])} for citation in citations]
+        facets = dict((facet,[{'value':value,'count':n} for value,n in values]) for facet,values in counts.items())
+        return JsonResponse({'facets':facets,'count':count,'citations':citations,'next':next_cursor})
+
+    # links that add or remove one facet value from the current filters
+    facets = []
+    for facet,label in FACETS:
+        values = []
+        for value,n in counts[facet]:
+            query = request.GET.copy()
+            query.pop('after',None)
+            selected = value in filters.get(facet,[])
+            query.setlist(facet,[v for v in filters.get(facet,[]) if v != value] + ([] if selected else [value]))
+            values.append({'value':value,'count':n,'selected':selected,'url':'?' + query.urlencode()})
+        facets.append({'label':label,'values':values})
+    query = request.GET.copy()
+    query['after'] = next_cursor or ''
+    context = {'citations':citations,'navbar':'search','facets':facets,'count':count,
+               'next_url':'?' + query.urlencode() if next_cursor else None}
+    return render(request, 'papers/browse.html', context)
+
+# full-text search of saved citations, best match first (see citation_search.py)
+# ?q=query&page=n, add &format=json for {'results':[...],'next_page'}
+def search_catalog(request):
+    results_per_page = 20
+    query = request.GET.get('q','')
+    try:
+        page = max(int(request.GET.get('page',1)),1)
+    except ValueError:
+        page = 1
+    # one extra result tells whether there is a next page
+    citations = search_citations(query,results_per_page + 1,(page - 1) * results_per_page)
+    next_page = page + 1 if len(citations) > results_per_page else None
+    citations = citations[:results_per_page]
+    if request.GET.get('format') == 'json':
+        results = [{'pk':citation.pk,
+                    'title':citation.title,
+                    'authors':citation.author_list_truncated,
+                    'journal':citation.journal,
+                    'score':citation.search_score,
+                    'url':reverse('papers:detail',args=[citation.pk,0])} for citation in citations]
+        return JsonResponse({'results':results,'next_page':next_page})
+    context = {'citations': citations,'navbar':'search','show_detail_link':True,
+               'query':query,'page':page,'next_page':next_page}
     return render(request, 'papers/index.html', context)
 
 # returns a string, otherwise returns None
@@ -254,8 +339,9 @@ def self_user_profile(request):
 # display user posts
 def user_posts(request, user_pk):
     user = User.objects.get(pk=user_pk)
-    posts = Post.objects.filter(creator=user)
-    context = {'posts': posts, 'navbar':'user_profile'}
+    posts = select_post_related(Post.objects.filter(creator=user))
+    viewer_votes = get_viewer_votes(request.user, creator=user)
+    context = {'posts': posts, 'navbar':'user_profile', 'viewer_votes':viewer_votes}
     return render(request, 'papers/user_posts.html', context)
 
 # list all papers of the week
@@ -341,21 +427,21 @@ def add_tag(request):
     if request.method == 'POST':
         citation_pk = request.POST.get('citation_pk',False)
         current_thread = request.POST.get('current_thread',False)
-        tag_name = request.POST.get('tag_name',False)
-        # check if tag already exists
-        if Tag.objects.filter(name=tag_name).exists():
-            tag = Tag.objects.filter(name=tag_name)[0]
-            if not tag.citations.filter(pk=citation_pk).exists():
-                tag.citations.add(citation_pk)
-                tag.save()
-        else:
-            tag = Tag()
-            setattr(tag,'name',tag_name)
-            tag.save()
-            tag.citations.add(citation_pk)
-            tag.save()
+        tag_name = request.POST.get('tag_name','')
+        if Tag.normalize_key(tag_name) != '':
+            tag = Tag.get_or_create_by_name(tag_name)
+            tag.citations.add(int(citation_pk)) # does nothing if the citation already has the tag
         return HttpResponseRedirect(reverse('papers:detail', args=[citation_pk,current_thread]))
 
+# ?q=prefix, returns {'tags':[{'name','count'}]} of the most used tags starting with prefix (see tag_index.py)
+def tag_autocomplete(request):
+    try:
+        limit = min(int(request.GET.get('limit',10)),50)
+    except ValueError:
+        limit = 10
+    tags = tag_index.complete(request.GET.get('q',''),limit)
+    return JsonResponse({'tags':[{'name':name,'count':count} for name,count in tags]})
+
 # To open: import pickle; favorite_color = pickle.load( open( "save.p", "rb" ) )
 def save_object(obj, filename):
     with open(filename, 'wb') as output:
@@ -424,8 +510,8 @@ def deletePost(request):
     if request.user.pk != post.creator.pk:
         return HttpResponse("Invalid user")
     else:
-        post.deleted = True
-        post.save()
+        post.mark_deleted()
+        bump_thread_version(post.thread_id)
         return HttpResponse("deleted")
 
 # add post
@@ -442,6 +528,7 @@ def addPost(request):
         post.add_post(new_text,request.user.pk,datetime.datetime.now(datetime.timezone.utc),request.user.username)
         setattr(post,'time_created',datetime.datetime.now())
         post.save()
+        bump_thread_version(post.thread_id)
         return HttpResponseRedirect(reverse('papers:detail', args=[citation_pk,thread_number])+'#post-'+str(post.pk))
     elif edit_or_reply == "reply" or edit_or_reply == "add":
         # get POST data
@@ -467,6 +554,7 @@ def addPost(request):
         post.upvoters.add(request.user)
         post.save()
         post.notify_mother_author()         # notify author of mother post that you replied to him
+        bump_thread_version(thread_pk)
         return HttpResponseRedirect(reverse('papers:detail', args=[citation_pk,thread_number])+'#post-'+str(post.pk))
 
 def addCitation_deprecated(request):
@@ -511,97 +599,33 @@ def addCitation_deprecated(request):
 def addCitation(request):
     citation_data_serialized = request.POST['citation_serialized']
     citation = Citation()
-    citation.deserialize(citation_data_serialized)
+    try:
+        citation.deserialize(citation_data_serialized)
+    except CitationCodecError:
+        return HttpResponseBadRequest("Invalid citation")
     citation_pk = citation.save_if_unique()
     # Return url to new citation detail page
     new_citation_url = reverse('papers:detail',args=[citation_pk,0])
     return HttpResponse(new_citation_url)
 
-# returns ordered list of posts.  Ordering is greedy
-# Input post_list should constitute a full tree with a single base node (no error checking)
-def order_greedy_post_list_with_indents(post_list):
-    # childrenIdx_list[i] gives the indices of children of post_list[i]
-    childrenIdx_list = [None] * len(post_list)
-    for j,post in enumerate(post_list):
-        children = post.post_set.all()
-        children_idx = []
-        for child in children:
-            child_idx = None
-            for i,p in enumerate(post_list):
-                if child.pk is p.pk:
-                    child_idx = i
-                    break
-            children_idx.append(child_idx)
-        childrenIdx_list[j] = children_idx
-
-    # get base node of post tree
-    idx_baseNode = None
-    for i,post in enumerate(post_list):
-        if post.node_depth is 0:
-            idx_baseNode = i
-            break
-
-    # order post_list
-    ordered_indices = orderGreedyPostlist_with_indents(idx_baseNode, post_list, childrenIdx_list,True)
-    ordered_post_list = []
-    for i,post in enumerate(ordered_indices):
-        if type(ordered_indices[i]) is str: #.startswith('in') or ordered_indices[i].startswith('out'):
-            ordered_post_list.append(ordered_indices[i])
-        else:
-            ordered_post_list.append(post_list[ ordered_indices[i] ])
-    return ordered_post_list # note this is no longer a queryset
-
-
-# Returns a list of indices corresponding to an ordered post_list
-# ordered[i] = j means that the jth element of post_list belongs in slot i of ordered list
-def orderGreedyPostlist_with_indents(node_idx, post_list, childrenIdx_list,withIndents):
-    children_indices = childrenIdx_list[node_idx]
-    num_children = len(children_indices)
-
-    if num_children is 0:
-        if withIndents:
-            return ['in-'+str(post_list[node_idx].node_depth),node_idx,'out-'+str(post_list[node_idx].node_depth)]
-        else:
-            return [node_idx]
-    else:
-        # create tuple list [ (aggregateScore, index), ...] which is sorted by aggregateScore
-        tup = [None] * len(children_indices)
-        for i,child_idx in enumerate(children_indices):
-            score = post_list[child_idx].score()
-            tup[i] = (score,child_idx)
-        tup = sorted(tup, reverse=True)
-        if withIndents:
-            ordered = ['in-'+str(post_list[node_idx].node_depth),node_idx]
-        else:
-            ordered = [node_idx]
-        for t in tup:
-            score = t[0]
-            child_idx = t[1]
-            o = orderGreedyPostlist_with_indents(child_idx,post_list,childrenIdx_list,withIndents)
-            if withIndents:
-                ordered = ordered + o
-            else:
-                ordered = ordered + o
-        if withIndents:
-            ordered = ordered + ['out-'+str(post_list[node_idx].node_depth)]
-        return ordered
-
-
 # internal citation information
 def detail(request,pk,current_thread):
     citation = Citation.objects.get(pk=pk)
     threads = Thread.objects.filter(owner=pk).order_by('order')
     associated_tags = citation.tags.all()
-    unused_tags = Tag.objects.exclude(id__in=associated_tags)
-    posts_vector = []
+    thread_html_vector = []
     num_depth1_posts = [] # number of depth 1 comments used for display
+    next_cursors = [] # used to load more comments, see thread_page
+    rankings = [] # how comments are sorted, see ranking.py
+    viewer_votes = get_viewer_votes(request.user, thread__in=threads) # votes of all threads in one query per direction
     for thread in threads:
-        posts = Post.objects.filter(thread=thread.pk)
-        ordered_posts = order_greedy_post_list_with_indents(posts) # ordered_posts is not a queryset
-        ordered_posts = ordered_posts[2:-1] # exclude first entry (dummy post) along with indents/dedents
-        posts_vector.append(ordered_posts)
-        num_depth1_posts.append(len(posts.filter(node_depth=1)))
-    threadsPostsIndents = zip(threads,posts_vector,num_depth1_posts)
+        ranking = get_requested_ranking(request,thread)
+        thread_html,num_depth1,next_cursor = get_thread_html(request,thread,ranking=ranking,viewer_votes=viewer_votes) # only rendered if thread changed
+        thread_html_vector.append(thread_html)
+        num_depth1_posts.append(num_depth1)
+        next_cursors.append(next_cursor)
+        rankings.append(ranking)
+    threadsPostsIndents = zip(threads,thread_html_vector,num_depth1_posts,next_cursors,rankings)
 
     # check if citation already is in user library
     # citationIsInLibrary True if user is authenticated and citation is in library, false otherwise
@@ -616,54 +640,71 @@ def detail(request,pk,current_thread):
     # get user's personal note for the citation
     personalNote = PersonalNote().get_personal_note(request.user,citation)
 
-    context = {'personalNote':personalNote,'citation': citation,'threads': threads,'posts_vector':posts_vector,'threadsPostsIndents':threadsPostsIndents,'current_thread':int(current_thread),'associated_tags':associated_tags,'unused_tags':unused_tags, 'citationIsInLibrary':citationIsInLibrary}
+    context = {'personalNote':personalNote,'citation': citation,'threads': threads,'threadsPostsIndents':threadsPostsIndents,'current_thread':int(current_thread),'associated_tags':associated_tags, 'citationIsInLibrary':citationIsInLibrary,'ranking_choices':RANKING_CHOICES}
     return render(request, 'papers/detail.html', context)
 
+# returns next page of depth 1 posts of a thread as json: {'html': ..., 'next': cursor of next page or null}
+# used by detail.js to load more comments
+def thread_page(request,thread_pk):
+    thread = get_object_or_404(Thread,pk=thread_pk)
+    after = request.GET.get('after')
+    try:
+        html,dummy,next_cursor = get_thread_html(request,thread,after,get_requested_ranking(request,thread))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+    return JsonResponse({'html':html,'next':next_cursor})
+
 # upvote comment
 # assumes that user is authenticated
+# vote counts on the post are updated by models.update_vote_counts
 def upvote(request):
     post_pk = request.POST.get("post_pk")
-    post = Post.objects.get(pk=post_pk)
+    with transaction.atomic():
+        post = Post.objects.select_for_update().get(pk=post_pk) # serialize votes on the same post
 
-    # clear upvote if user already upvoted
-    if post.upvoters.filter(id=request.user.pk).exists():
-        post.upvoters.remove(request.user)
-    # upvote if user has not already upvoted
-    else:
-        post.upvoters.add(request.user)
-        post.downvoters.remove(request.user)
+        # clear upvote if user already upvoted
+        if post.upvoters.filter(id=request.user.pk).exists():
+            post.upvoters.remove(request.user)
+        # upvote if user has not already upvoted
+        else:
+            post.upvoters.add(request.user)
+            post.downvoters.remove(request.user)
+        bump_thread_version(post.thread_id)
 
     return JsonResponse({'score':post.score()})
 
 def downvote(request):
     post_pk = request.POST.get("post_pk")
-    post = Post.objects.get(pk=post_pk)
+    with transaction.atomic():
+        post = Post.objects.select_for_update().get(pk=post_pk) # serialize votes on the same post
 
-    # clear downvote if user already downvoted
-    if post.downvoters.filter(id=request.user.pk).exists():
-        post.downvoters.remove(request.user)
-    # downvote if user has not already downvoted
-    else:
-        post.downvoters.add(request.user)
-        post.upvoters.remove(request.user)
+        # clear downvote if user already downvoted
+        if post.downvoters.filter(id=request.user.pk).exists():
+            post.downvoters.remove(request.user)
+        # downvote if user has not already downvoted
+        else:
+            post.downvoters.add(request.user)
+            post.upvoters.remove(request.user)
+        bump_thread_version(post.thread_id)
 
     return JsonResponse({'score':post.score()})
 
 
 # check pubmed search results against internal database
 def checkPubmedEntriesForPreexistingCitations(pubmed):
+    existing_pks = get_existing_citation_pks(entry.pubmedID for entry in pubmed.entries) # at most one query
     for i,entry in enumerate(pubmed.entries):
-        pubmedID = entry.pubmedID
-        matches = Citation.objects.filter(pubmedID=pubmedID)
-        num_matches = len(matches)
-        if num_matches is 0:
-            pubmed.entries[i].preexistingEntry = False
-            pubmed.entries[i].preexistingEntry_pk = None
-        else:
-            pubmed.entries[i].preexistingEntry = True
-            pubmed.entries[i].preexistingEntry_pk = matches[0].pk
+        pk = existing_pks.get(entry.pubmedID)
+        pubmed.entries[i].preexistingEntry = pk is not None
+        pubmed.entries[i].preexistingEntry_pk = pk
     return pubmed
 
+# prefetched search pages are kept per session (see search_prefetch.py)
+def get_prefetch_key(request):
+    if request.session.session_key is None:
+        request.session.save()
+    return request.session.session_key
+
 # search interface
 def search0(request,page):
     pubmed = PubmedInterface()
@@ -674,27 +715,36 @@ def search0(request,page):
         searchInitiated = request.POST.get("searchInitiated")
         if searchInitiated == "True": # search initiated
             search_str = request.POST.get("search_str")
-            pubmed.countNumberSearchResults(search_str)
-            numberSearchResults = pubmed.numberSearchResults
-            totalPages = math.ceil(numberSearchResults/10)
             pageNumber=1
             retMin = 0
             retMax = 10
-            citations = Citation.objects.all()
-            pubmed.getRecords(search_str,retMin,retMax)
+            # the results stay on the NCBI history server, later pages are fetched from there without searching again
+            search_prefetcher.cancel(get_prefetch_key(request))
+            request.session['pubmed_search'] = pubmed.startSearch(search_str,retMax) # also counts the search results
+            totalPages = math.ceil(pubmed.numberSearchResults/10)
         else: # page change
             search_str = request.POST.get("search_str")
             pageNumber = int(request.POST.get("pageNumber"))
             retMin = (pageNumber - 1)*10
             retMax = 10
-            citations = Citation.objects.all()
-            pubmed.getRecords(search_str,retMin,retMax)
+            history = request.session.get('pubmed_search')
+            if history is None or history['search_str'] != search_str: # e.g., the session expired
+                history = pubmed.startSearch(search_str,0)
+            prefetched = search_prefetcher.get(get_prefetch_key(request),history,retMin,retMax)
+            if prefetched is not None: # usually the user clicked "next"
+                pubmed = prefetched
+            else:
+                pubmed.getPage(history,retMin,retMax)
+            if request.session.get('pubmed_search') != pubmed.history: # new search, or NCBI dropped the old one
+                request.session['pubmed_search'] = pubmed.history
             totalPages = int(request.POST.get("totalPages"))
         freshSearch=False
     else:
         freshSearch=True
 
     totalPages = min([totalPages,15+1]) # maximum of 15 pages
+    if pubmed.history is not None and pageNumber + 1 < totalPages: # fetch the next page while this one is read
+        search_prefetcher.prefetch(get_prefetch_key(request),pubmed.history,pageNumber*10,10)
     pubmed = checkPubmedEntriesForPreexistingCitations(pubmed)
     context = {'entries': pubmed.entries, 'search_str': search_str, 'totalPages':totalPages, 'totalPagesRange': range(1,totalPages), 'pageNumber': pageNumber, 'freshSearch': freshSearch, 'navbar':'addCitation'}
     return render(request, 'papers/search0.html', context)
@@ -756,6 +806,7 @@ def search(request,page):
                 citation = Citation()
                 citation.parse_pubmedJson(articles_json)
                 citations.append(citation)
+            annotate_existing_citations(citations) # used by citation_summary_template.html
             total_number_search_results = int(request.POST.get("count"))
             total_pages = min(math.ceil(total_number_search_results/results_per_page),max_number_of_pages)
             current_page = request.POST.get("new_page")
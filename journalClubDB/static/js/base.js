@@ -5,7 +5,8 @@ $(document).ready(function() {
 
 
     // this implements upvote functionality. It would be most readable to place this in post_template.js, but multiple scripts will cause race collisions.
-    $( "a[id^='up-'] " ).click(function() {
+    // handlers are delegated so they also apply to posts loaded later (see load-more-posts in detail.js)
+    $( document ).on('click', "a[id^='up-']", function() {
       post_pk = $( this ).prev('input').val()       // get post private key
       var me = this;
       if ( $( me ).hasClass('up-arrow') )  {
@@ -42,7 +43,7 @@ $(document).ready(function() {
     });
 
     // this implements downvote functionality. It would be most readable to place this in post_template.js, but multiple scripts will cause race collisions.
-    $( "a[id^='down-'] " ).click(function() {
+    $( document ).on('click', "a[id^='down-']", function() {
       post_pk = $( this ).prev('input').val()       // get post private key
       var me = this;
       if ( $( me ).hasClass('down-arrow') )  {
@@ -80,7 +81,7 @@ $(document).ready(function() {
 
 
   // this implements functionality to submit succeeding form with hyperlink is clicked
-  $("a.hyperlink-submit-form").click(function() {
+  $( document ).on('click', "a.hyperlink-submit-form", function() {
     $( this ).next('form').submit();
   });
 
@@ -66,5 +66,37 @@ $(document).ready(function() {
   });
 
 
+  // Suggest existing tags while typing a tag name, see views.tag_autocomplete
+  $('.tag-autocomplete').on('input', function(event){
+    var input = $(this)
+    $.getJSON(input.attr("data-url"), {q: input.val()}, function(data) {
+      var datalist = $('#' + input.attr("list")).empty()
+      $.each(data.tags, function(index, tag) {
+        datalist.append($('<option>').attr('value', tag.name).text(tag.count))
+      });
+    });
+  });
+
+
+  // Load next page of depth 1 comments of a thread, see views.thread_page
+  $(document).on('click', '.load-more-posts', function(event){
+    var link = $(this)
+    $.getJSON(link.attr("data-url"), {after: link.attr("data-after")}, function(data) {
+      var page = $(data.html)
+      link.siblings('.thread-posts').append(page)
+      page.find('img').each(function(index) {
+        var img = $(this)
+        img.wrap( "<a href='" + img.attr("src") + "'></a>" );
+      });
+      if (typeof MathJax != "undefined") {
+        MathJax.Hub.Queue(["Typeset", MathJax.Hub, link.siblings('.thread-posts')[0]]);
+      }
+      if (data.next) {
+        link.attr("data-after", data.next)
+      } else {
+        link.remove()
+      }
+    });
+  });
 
 });
@@ -5,19 +5,34 @@ $(document).ready(function() {
   // Upvote, downvote functionality is placed in base.js in order to prevent race conditions
 
   // this implements history button functionality
-  $( ".comment-all").hide()   // only show last post/edit and hide all previous
-  $( ".comment-last").show()
-  $( "a[id*='action-']" ).click(function(e) {   // dropdown to select which revision to view
-    var action_pk_counter = $(this).attr("id")
-    var arr = action_pk_counter.split('-')
-    var pk = arr[1]
-    var counter = arr[2]
-    $( ".li-dropdown-" + pk).removeClass("active");
-    $( ".li-dropdown-"+pk+"-"+counter).addClass("active");
-    var time_text = $( ".li-dropdown-"+pk+"-"+counter+ " > a" ).html();
-    $( "#comment-time-"+pk).html(time_text)
-    $( ".comment-target-all-" + pk).hide()
-    $( "#comment-text-" + pk + "-" + counter).show()
+  // revisions are only fetched from the server the first time the history dropdown of a post is opened
+  // handlers are namespaced because this script is included once per post
+  $(document).off('.posthistory')
+  $(document).on('click.posthistory mouseenter.posthistory', '.post-history-toggle', function(e) {
+    var toggle = $(this)
+    var pk = toggle.attr("data-pk")
+    if (toggle.data("history-requested")) {
+      return
+    }
+    toggle.data("history-requested", true)
+    $.getJSON(toggle.attr("data-url"), function(data) {
+      var menu = $( "#post-history-" + pk )
+      menu.empty()
+      $.each(data.revisions, function(i, revision) {
+        var item = $( "<li class='pointer li-dropdown-" + pk + "'><a></a></li>" )
+        item.children("a").text(revision.label)
+        if (i == data.revisions.length - 1) {
+          item.addClass("active")
+        }
+        item.click(function(e) {   // select which revision to view
+          $( ".li-dropdown-" + pk).removeClass("active");
+          item.addClass("active")
+          $( "#comment-time-" + pk).text(revision.label)
+          $( "#comment-text-" + pk).html(revision.text)
+        });
+        menu.append(item)
+      });
+    });
   });
 
   // this implements delete post functionality